@@ -0,0 +1,130 @@
+"""Where things are in the arena.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+
+Positions are in metres, with x increasing to the "east" and y to the
+"north", and corner 0 at (0, 0). Like every other angle in this code,
+headings are in degrees clockwise: 0 is north (+y) and 90 is east (+x).
+Corner n is where wall n starts; going clockwise round the arena, the walls
+run (0, 0) to (0, 8) to (8, 8) to (8, 0) and back. Zone n is in corner n.
+"""
+
+
+from __future__ import division
+
+import collections
+from math import atan2, degrees, hypot
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List, Tuple
+except ImportError:
+    pass
+
+from trig import sind, cosd
+
+
+# The length of each wall.
+ARENA_SIZE = 8.0
+MARKERS_PER_WALL = 7
+# The distance between neighbouring markers on a wall, and between a corner
+# and the nearest marker.
+MARKER_SPACING = ARENA_SIZE / (MARKERS_PER_WALL + 1)
+MARKER_COUNT = 4 * MARKERS_PER_WALL
+
+# Where each corner is.
+CORNERS = [(0.0, 0.0), (0.0, ARENA_SIZE), (ARENA_SIZE, ARENA_SIZE), (ARENA_SIZE, 0.0)]
+# The direction each wall runs in, from its corner.
+WALL_DIRECTIONS = [0, 90, 180, 270]
+
+# How far from the corner (along the diagonal) to aim for when going home.
+HOME_DISTANCE = 0.75
+
+# Where the robot starts in zone 0, as (x, y, heading): facing along wall 3,
+# so that driving 3.25 metres and turning 90 degrees left faces the first
+# B cube, 1.5 metres away (see `strategies.route_b_c_a`).
+ZONE_0_START = (0.75, 1.0, 90)
+# Where the cubes nearest zone 0 start, as (name, kind, x, y), where kind is
+# "A", "B" or "C". The other zones' are the same, turned round the arena
+# (see `from_zone`).
+ZONE_0_CUBES = [("A", "A", 2.5, 2.5), ("B1", "B", 4.0, 2.5), ("B2", "B", 2.5, 4.0), ("C", "C", 4.0, 4.0)]
+
+
+# Where an arena marker is, and which way it faces (a heading, into the arena).
+MarkerPlace = collections.namedtuple("MarkerPlace", ["code", "x", "y", "facing"])
+
+
+def wall_of(code):
+    # type: (int) -> int
+    """Return which wall an arena marker is on."""
+    return code // MARKERS_PER_WALL
+
+
+def marker_place(code):
+    # type: (int) -> MarkerPlace
+    """Return where an arena marker is."""
+    if not 0 <= code < MARKER_COUNT:
+        raise ValueError("{} is not an arena marker code".format(code))
+    wall = wall_of(code)
+    along = (code % MARKERS_PER_WALL + 1) * MARKER_SPACING
+    corner_x, corner_y = CORNERS[wall]
+    direction = WALL_DIRECTIONS[wall]
+    # Markers face into the arena, which is to the right of the wall.
+    return MarkerPlace(code, corner_x + along * sind(direction), corner_y + along * cosd(direction), (direction + 90) % 360)
+
+
+MARKER_PLACES = [marker_place(code) for code in xrange(MARKER_COUNT)]
+
+
+def zone_markers(zone):
+    # type: (int) -> Tuple[int, int]
+    """Return the codes of the markers either side of a zone's corner, as (left, right) looking into the corner."""
+    right = zone * MARKERS_PER_WALL
+    return (right - 1) % MARKER_COUNT, right
+
+
+def home(zone):
+    # type: (int) -> Tuple[float, float]
+    """Return the point to drive to to be home in a zone."""
+    corner_x, corner_y = CORNERS[zone]
+    # The corner's diagonal points at the centre of the arena.
+    centre = ARENA_SIZE / 2
+    diagonal = hypot(centre - corner_x, centre - corner_y)
+    return (corner_x + (centre - corner_x) / diagonal * HOME_DISTANCE,
+            corner_y + (centre - corner_y) / diagonal * HOME_DISTANCE)
+
+
+def from_zone(zone, x, y):
+    # type: (int, float, float) -> Tuple[float, float]
+    """Return where the point (x, y) relative to zone 0 is, relative to `zone`."""
+    for _ in xrange(zone % 4):
+        # Corner 0 goes to corner 1, and so on.
+        x, y = y, ARENA_SIZE - x
+    return x, y
+
+
+def start_pose(zone):
+    # type: (int) -> Tuple[float, float, float]
+    """Return where the robot starts in `zone`, as (x, y, heading)."""
+    x, y, heading = ZONE_0_START
+    x, y = from_zone(zone, x, y)
+    return x, y, (heading + 90 * (zone % 4)) % 360
+
+
+def cubes(zone):
+    # type: (int) -> List[Tuple[str, str, float, float]]
+    """Return where the cubes nearest `zone` start, like `ZONE_0_CUBES`."""
+    return [(name, kind) + from_zone(zone, x, y) for name, kind, x, y in ZONE_0_CUBES]
+
+
+def heading_to(x, y, to_x, to_y):
+    # type: (float, float, float, float) -> float
+    """Return the heading from (x, y) to (to_x, to_y)."""
+    return degrees(atan2(to_x - x, to_y - y)) % 360
+
+
+def in_arena(x, y, margin=0.0):
+    # type: (float, float, float) -> bool
+    """Return whether (x, y) is in the arena, at least `margin` metres from the walls."""
+    return margin <= x <= ARENA_SIZE - margin and margin <= y <= ARENA_SIZE - margin
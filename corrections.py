@@ -9,8 +9,14 @@ from __future__ import division
 
 from math import sqrt
 
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for the batch corrections.
+    np = None
+
 from trig import sind, cosd, asind
-from vector import Vector
+from vector import Vector, VectorArray
 
 
 # The width/length/height of a cube.
@@ -30,6 +36,37 @@ def correct_all_cube(vec, beta):
     return vec
 
 
+def correct_all_cube_batch(distances, angles, betas):
+    # type: (...) -> VectorArray
+    """
+    Apply `correct_all_cube` to many markers at once.
+
+    Takes array-likes of the distances and angles of the vectors to the
+    markers (as from `marker2vector`) and of their orientation.rot_y, and
+    returns a VectorArray. Requires NumPy.
+    """
+    if np is None:
+        raise ImportError("correct_all_cube_batch requires NumPy")
+    distances = np.asarray(distances, dtype=float)
+    angles = np.asarray(angles, dtype=float)
+    betas = np.asarray(betas, dtype=float)
+    # Rotational placement of the webcam.
+    alpha = np.radians(angles + camera_angular_offset)
+    d = distances
+    # Placement of the marker on the cube: the triangle has an angle of
+    # 180 - beta at the marker, whose cosine and sine are -cos(beta) and sin(beta).
+    beta = np.radians(betas)
+    r = cube_width / 2
+    m = np.sqrt(d ** 2 + r ** 2 + 2 * d * r * np.cos(beta))
+    alpha = np.arcsin(r * np.sin(beta) / m) + alpha
+    d = m
+    # Horizontal placement of the webcam, likewise with an angle of 180 - alpha.
+    r = webcam_horizontal_offset
+    m = np.sqrt(d ** 2 + r ** 2 + 2 * d * r * np.cos(alpha))
+    gamma = np.arcsin(d * np.sin(alpha) / m)
+    return VectorArray(m, np.degrees(gamma))
+
+
 def correct_for_webcam_horizontal_placement(vec):
     # type: (Vector) -> Vector
     """
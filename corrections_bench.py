@@ -0,0 +1,58 @@
+"""Checks and times the batch cube corrections against the scalar ones.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+
+Run this file directly (with NumPy installed) to check that
+`correct_all_cube_batch` matches `correct_all_cube`, and to measure the
+speedup at various numbers of observations.
+"""
+
+
+from __future__ import division
+
+import argparse
+import logging
+import random
+import time
+
+import corrections
+from vector import Vector
+
+
+def random_observations(count, seed=None):
+    """Return lists of the distances, angles and orientations of `count` made-up cube markers."""
+    rng = random.Random(seed)
+    distances = [rng.uniform(0.3, 6) for _ in xrange(count)]
+    angles = [rng.uniform(-30, 30) for _ in xrange(count)]
+    betas = [rng.uniform(-60, 60) for _ in xrange(count)]
+    return distances, angles, betas
+
+
+def scalar(distances, angles, betas):
+    return [corrections.correct_all_cube(Vector(distance=d, angle=a), b) for d, a, b in zip(distances, angles, betas)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sizes", type=int, nargs="*", default=[10000, 1000000], help="numbers of observations")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(module)s:%(lineno)d - %(levelname)s: %(message)s")
+    log = logging.getLogger(__name__)
+    for size in args.sizes:
+        distances, angles, betas = random_observations(size, seed=size)
+        start = time.time()
+        expected = scalar(distances, angles, betas)
+        scalar_time = time.time() - start
+        start = time.time()
+        result = corrections.correct_all_cube_batch(distances, angles, betas)
+        batch_time = time.time() - start
+        error = max(max(abs(vec.distance - d), abs(vec.angle - a))
+                    for vec, d, a in zip(expected, result.distance, result.angle))
+        log.info("%s observations: scalar %.3f s, batch %.3f s (%.0fx faster), max difference %.2g",
+                 size, scalar_time, batch_time, scalar_time / batch_time, error)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,39 @@
 
 This file is part of the code for the Hills Road/Systemetric entry to
 the 2017 Student Robotics competition "Easy as ABC".
+
+Run this file directly with --check to check the motions driven on a
+pretend motor board.
 """
 
 
 from __future__ import division
 
+import argparse
+import logging
+from math import copysign
 import time
 
+from mbed_link import Arc, Motion
+from trig import arc_length, arc_radius
+from vector import Vector
+
 
 class DCMotors():
     def __init__(self, log, motors):
         self.log = log
         self.motors = motors
         self.lastTurn = ''
+        # Functions called with each Motion the robot has carried out, like `Mbed.motion_listeners`.
+        self.motion_listeners = []
+
+    def notify_motion(self, motion):
+        # type: (Motion) -> None
+        for listener in self.motion_listeners:
+            try:
+                listener(motion)
+            except Exception:
+                self.log.exception("Motion listener %s failed", listener)
 
     def forwards(self, distance, speed=0.75, ratio=-1.05, speed_power=80):
         """
@@ -56,12 +76,15 @@ class DCMotors():
         t_end = time.time() + 0.04
         while time.time() < t_end:
             self.log.info("current draw is %s Amps, voltage draw is %s Volts", self.power.battery.current, self.power.battery.voltage)
+        self.notify_motion(Motion("move", distance))
 
     def turn(self, degrees, power=40, ratio=-1, sleep_360=2.14):
         """
         Turn degrees anticlockwise.
         If passed negative, turn clockwise
         """
+        # Motions are clockwise, like everywhere else.
+        motion = Motion("turn", -degrees)
         if degrees < 0:
             self.lastTurn = "Left"
             power = -power
@@ -81,3 +104,83 @@ class DCMotors():
 
         self.motors[0].m0.power = 0
         self.motors[1].m1.power = 0
+        self.notify_motion(motion)
+
+    def drive_to(self, vec, speed=0.75, ratio=-1.05, speed_power=80, track_width=0.4, max_arc_angle=45):
+        """
+        Drive to the point `vec` away along a smooth arc (see `Mbed.drive_to`).
+
+        Positive angles are to the right (clockwise), unlike `turn`. Arcs are
+        driven by running the outer wheel faster than the inner one, in the
+        ratio of their distances from the centre of the arc; `track_width` is
+        the distance between the wheels in metres.
+        """
+        angle = (vec.angle + 180) % 360 - 180
+        arc_angle = copysign(min(abs(angle), max_arc_angle), angle)
+        if vec.distance == 0:
+            # There's no arc to drive, so just turn to face the point (like `Mbed.motion_commands`).
+            arc_angle = 0
+        if angle != arc_angle:
+            # Turn on the spot first if the arc would be too sharp.
+            self.turn(-(angle - arc_angle))
+        if vec.distance == 0:
+            return
+        if arc_angle == 0:
+            self.forwards(vec.distance, speed, ratio, speed_power)
+            return
+        radius = arc_radius(vec.distance, arc_angle)
+        inner = max(0, (radius - track_width / 2) / radius)
+        outer = (radius + track_width / 2) / radius
+        # Going by turn(), m0 drives the left wheel and m1 the right wheel.
+        if arc_angle > 0:
+            left, right = outer, inner
+        else:
+            left, right = inner, outer
+        power = speed * speed_power
+        sleep_time = arc_length(vec.distance, arc_angle) / speed
+        self.log.info("Driving along an arc of radius %s metres for %s seconds", radius, sleep_time)
+        self.motors[0].m0.power = power * ratio * left
+        self.motors[1].m1.power = power * right
+        time.sleep(sleep_time)
+        self.motors[0].m0.power = 0
+        self.motors[1].m1.power = 0
+        self.notify_motion(Motion("drive", Arc(vec.distance, arc_angle)))
+
+
+class FakeMotorBoard(object):
+    """Stands in for both of the robot's motor boards, and the power board, in checks."""
+
+    def __init__(self):
+        self.m0 = self.m1 = self
+        self.power = 0
+        self.battery = self
+        self.current = self.voltage = 0
+
+
+def check_zero_distance_drive(log):
+    """Check that driving to a point no distance away just turns to face it."""
+    board = FakeMotorBoard()
+    quiet_log = log.getChild("motors")
+    quiet_log.setLevel(logging.WARNING)
+    motors = DCMotors(quiet_log, [board, board])
+    motors.power = board
+    motions = []
+    motors.motion_listeners.append(motions.append)
+    motors.drive_to(Vector(distance=0, angle=30))
+    assert motions == [Motion("turn", 30)], "expected one 30 degree turn, got {}".format(motions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--check", action="store_true", help="check the motions driven on a pretend motor board")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(module)s:%(lineno)d - %(levelname)s: %(message)s")
+    log = logging.getLogger(__name__)
+    if args.check:
+        check_zero_distance_drive(log)
+        log.info("%s: ok", check_zero_distance_drive.__name__)
+
+
+if __name__ == "__main__":
+    main()
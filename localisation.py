@@ -0,0 +1,189 @@
+"""Working out where the robot is from the arena markers it can see.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+"""
+
+
+from __future__ import division
+
+from sr.robot import *
+
+import collections
+from math import atan2, degrees, hypot, sqrt
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List, Optional, Tuple
+except ImportError:
+    pass
+
+import arena
+import corrections
+from motion_optimiser import normalise_angle
+from trig import sind, cosd
+
+
+# Where the robot's centre of rotation is, and which way it's facing (see `arena`).
+Pose = collections.namedtuple("Pose", ["x", "y", "heading"])
+
+
+class PoseEstimate(collections.namedtuple("PoseEstimate", ["pose", "covariance", "codes", "rms"])):
+    """
+    A pose worked out from some markers.
+
+    `covariance` is the 3x3 covariance of (x, y, heading), as a list of rows,
+    in square metres and square degrees. `codes` are the markers used, and
+    `rms` is the root mean square of the residuals, in standard deviations
+    (around 1 if the markers agree as well as expected).
+    """
+    __slots__ = ()
+
+    @property
+    def position_sd(self):
+        # type: () -> float
+        """The standard deviation of the position, in metres (along its worst direction, roughly)."""
+        return sqrt(max(self.covariance[0][0], self.covariance[1][1]))
+
+    @property
+    def heading_sd(self):
+        # type: () -> float
+        """The standard deviation of the heading, in degrees."""
+        return sqrt(self.covariance[2][2])
+
+
+def invert(matrix):
+    # type: (List[List[float]]) -> List[List[float]]
+    """Return the inverse of a 3x3 matrix, or None if it's singular."""
+    (a, b, c), (d, e, f), (g, h, i) = matrix
+    cofactors = [[e * i - f * h, c * h - b * i, b * f - c * e],
+                 [f * g - d * i, a * i - c * g, c * d - a * f],
+                 [d * h - e * g, b * g - a * h, a * e - b * d]]
+    determinant = a * cofactors[0][0] + b * cofactors[1][0] + c * cofactors[2][0]
+    if abs(determinant) < 1e-12:
+        return None
+    return [[value / determinant for value in row] for row in cofactors]
+
+
+class Localiser(object):
+    """
+    Works out the robot's pose from every arena marker in a picture at once.
+
+    Each marker gives its distance, its angle (`rot_y`) and, if the marker has
+    one, which way it's facing (`orientation.rot_y`), each of which is
+    compared with what the marker would look like from a given pose. The pose
+    is the one that best fits all of them (by Gauss-Newton least squares), with
+    each residual measured in standard deviations of its noise. So that one
+    misread marker doesn't drag the pose off, residuals more than `huber`
+    standard deviations out count less (a Huber loss).
+
+    Two markers are enough to fix the pose; one is enough if it has an
+    orientation, though that is much noisier than its angle.
+    """
+
+    def __init__(self, log, camera_offset=corrections.webcam_horizontal_offset,
+                 dist_noise=0.05, angle_noise=1.5, orientation_noise=10.0, huber=1.5, iterations=20):
+        self.log = log
+        # How far in front of the robot's centre of rotation the camera is, in metres.
+        self.camera_offset = camera_offset
+        # How noisy each reading is (standard deviations, in metres, degrees
+        # and degrees). Distances get noisier further away, so the noise on a
+        # distance is `dist_noise` times one more than the distance.
+        self.dist_noise = dist_noise
+        self.angle_noise = angle_noise
+        self.orientation_noise = orientation_noise
+        self.huber = huber
+        self.iterations = iterations
+
+    def predict(self, pose, place):
+        # type: (Pose, arena.MarkerPlace) -> Tuple[float, float, float]
+        """Return what a marker would look like from `pose`, as (dist, rot_y, orientation.rot_y)."""
+        camera_x = pose.x + self.camera_offset * sind(pose.heading)
+        camera_y = pose.y + self.camera_offset * cosd(pose.heading)
+        bearing = degrees(atan2(place.x - camera_x, place.y - camera_y))
+        # A marker seen head-on has an orientation of 0 (see `MarkerFilter.transform_observation`).
+        return (hypot(place.x - camera_x, place.y - camera_y),
+                normalise_angle(bearing - pose.heading),
+                normalise_angle(place.facing + 180 - bearing))
+
+    def residuals(self, pose, markers):
+        # type: (Pose, List[Marker]) -> List[float]
+        """Return how far `pose` is from explaining each reading of each marker, in standard deviations."""
+        residuals = []
+        for marker in markers:
+            dist, rot_y, orientation = self.predict(pose, arena.MARKER_PLACES[marker.info.code])
+            residuals.append((dist - marker.dist) / (self.dist_noise * (1 + marker.dist)))
+            residuals.append(normalise_angle(rot_y - marker.rot_y) / self.angle_noise)
+            if getattr(marker, "orientation", None) is not None:
+                residuals.append(normalise_angle(orientation - marker.orientation.rot_y) / self.orientation_noise)
+        return residuals
+
+    def initial_guess(self, markers):
+        # type: (List[Marker]) -> Pose
+        """
+        Guess the pose well enough for the fit to start from.
+
+        For each of a few headings, each marker says where the robot must be;
+        the heading where they agree best wins. With only one marker, its
+        orientation gives the heading.
+        """
+        def position(heading, marker):
+            # type: (float, Marker) -> Tuple[float, float]
+            place = arena.MARKER_PLACES[marker.info.code]
+            bearing = heading + marker.rot_y
+            return (place.x - marker.dist * sind(bearing) - self.camera_offset * sind(heading),
+                    place.y - marker.dist * cosd(bearing) - self.camera_offset * cosd(heading))
+
+        if len(markers) == 1:
+            marker = markers[0]
+            place = arena.MARKER_PLACES[marker.info.code]
+            heading = normalise_angle(place.facing + 180 - marker.rot_y - marker.orientation.rot_y)
+            x, y = position(heading, marker)
+            return Pose(x, y, heading)
+        best = None
+        for heading in xrange(-180, 180, 15):
+            positions = [position(heading, marker) for marker in markers]
+            x = sum(p[0] for p in positions) / len(positions)
+            y = sum(p[1] for p in positions) / len(positions)
+            spread = sum((p[0] - x) ** 2 + (p[1] - y) ** 2 for p in positions)
+            if best is None or spread < best[0]:
+                best = (spread, Pose(x, y, heading))
+        return best[1]
+
+    def locate(self, markers, guess=None):
+        # type: (List[Marker], Pose) -> Optional[PoseEstimate]
+        """
+        Return the pose that best explains the arena markers in `markers` (others are ignored).
+
+        Starts from `guess` if given (e.g. where we think we are), otherwise
+        from `initial_guess`. Returns None if there aren't enough markers to
+        fix the pose.
+        """
+        markers = [marker for marker in markers if marker.info.marker_type == MARKER_ARENA]
+        with_orientation = [marker for marker in markers if getattr(marker, "orientation", None) is not None]
+        if len(markers) < 2 and not with_orientation:
+            return None
+        pose = guess if guess is not None else self.initial_guess(markers)
+        steps = (1e-4, 1e-4, 1e-3)
+        for _ in xrange(self.iterations):
+            residuals = self.residuals(pose, markers)
+            # Numerical Jacobian of the residuals, one column per pose variable.
+            columns = []
+            for index, step in enumerate(steps):
+                moved = list(pose)
+                moved[index] += step
+                columns.append([(after - before) / step for after, before in zip(self.residuals(Pose(*moved), markers), residuals)])
+            weights = [1 if abs(residual) <= self.huber else self.huber / abs(residual) for residual in residuals]
+            normal = [[sum(w * a * b for w, a, b in zip(weights, columns[i], columns[j])) for j in xrange(3)] for i in xrange(3)]
+            gradient = [sum(w * a * r for w, a, r in zip(weights, columns[i], residuals)) for i in xrange(3)]
+            inverse = invert(normal)
+            if inverse is None:
+                self.log.debug("Can't fix the pose from markers %s", [marker.info.code for marker in markers])
+                return None
+            step = [-sum(inverse[i][j] * gradient[j] for j in xrange(3)) for i in xrange(3)]
+            pose = Pose(pose.x + step[0], pose.y + step[1], normalise_angle(pose.heading + step[2]))
+            if abs(step[0]) < 1e-4 and abs(step[1]) < 1e-4 and abs(step[2]) < 1e-3:
+                break
+        residuals = self.residuals(pose, markers)
+        rms = sqrt(sum(residual ** 2 for residual in residuals) / len(residuals))
+        return PoseEstimate(pose, inverse, [marker.info.code for marker in markers], rms)
@@ -0,0 +1,188 @@
+"""Fusing sightings of each marker over several pictures and motions.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+"""
+
+
+from __future__ import division
+
+import collections
+from math import atan2, degrees, hypot, pi, sqrt
+import time
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List
+except ImportError:
+    pass
+
+import corrections
+from mbed_link import Motion
+from trig import sind, cosd
+from vector import Vector
+
+
+# One sighting of a marker, from the camera's point of view.
+Observation = collections.namedtuple("Observation", ["time", "dist", "rot_y", "orientation_rot_y"])
+
+
+class MarkerEstimate(collections.namedtuple("MarkerEstimate", [
+        "code", "dist", "rot_y", "orientation_rot_y", "dist_variance", "rot_y_variance", "orientation_variance", "count"])):
+    """
+    The filtered position of a marker, from the camera's point of view.
+
+    The fields are like the marker fields of the same names; the variances
+    are of the estimates, in square metres or square degrees. `count` is
+    how many sightings the estimate is based on.
+    """
+    __slots__ = ()
+
+    @property
+    def vector(self):
+        # type: () -> Vector
+        """The Vector from the camera to the marker, like `marker2vector`."""
+        return Vector(distance=self.dist, angle=self.rot_y)
+
+
+def median(values):
+    # type: (List[float]) -> float
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def variance(values):
+    # type: (List[float]) -> float
+    mean = sum(values) / len(values)
+    return sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+
+
+class MarkerFilter(object):
+    """
+    Keeps the last few sightings of each marker, and combines them into an estimate.
+
+    When the robot moves, the sightings we already have are moved with it
+    (see `motion`), so sightings from before a turn still count after it.
+    The estimate is the median of the sightings, so one bad reading doesn't
+    throw it off.
+
+    Sightings older than `max_age` seconds, and all sightings after the
+    robot moves by an unknown amount, are forgotten.
+    """
+
+    # How noisy a single sighting is assumed to be (standard deviations, in
+    # metres and degrees), when there aren't enough sightings to tell.
+    dist_noise = 0.05
+    angle_noise = 1.0
+
+    def __init__(self, log, window=5, max_age=15.0, camera_offset=corrections.webcam_horizontal_offset):
+        self.log = log
+        self.window = window
+        self.max_age = max_age
+        # How far in front of the robot's centre of rotation the camera is, in metres.
+        self.camera_offset = camera_offset
+        self.observations = {}
+
+    def add(self, markers, when=None):
+        # type: (List[Marker], float) -> None
+        """Add sightings of markers, seen at time `when` (default: now)."""
+        when = time.time() if when is None else when
+        for marker in markers:
+            code = marker.info.code
+            if code not in self.observations:
+                self.observations[code] = collections.deque(maxlen=self.window)
+            self.observations[code].append(Observation(when, marker.dist, marker.rot_y, marker.orientation.rot_y))
+
+    def forget(self, code=None):
+        # type: (int) -> None
+        """Forget the sightings of one marker, or of every marker if `code` is None."""
+        if code is None:
+            self.observations.clear()
+        else:
+            self.observations.pop(code, None)
+
+    def motion(self, motion):
+        # type: (Motion) -> None
+        """
+        Update every sighting for a motion of the robot.
+
+        Can be used as a motion listener (see `Mbed.motion_listeners`);
+        None means the robot moved by an unknown amount.
+        """
+        if motion is None:
+            if self.observations:
+                self.log.debug("Robot moved by an unknown amount; forgetting %s markers", len(self.observations))
+            self.forget()
+        elif motion.kind == "turn":
+            self.transform(motion.amount, 0)
+        elif motion.kind in ("move", "low_power_move"):
+            self.transform(0, motion.amount)
+        elif motion.kind == "drive":
+            # Driving along an arc ends in the same place as turning half
+            # way, moving straight there, then turning the rest of the way.
+            self.transform(motion.amount.angle, 0)
+            self.transform(0, motion.amount.distance)
+            self.transform(motion.amount.angle, 0)
+
+    def transform(self, angle, distance):
+        # type: (float, float) -> None
+        """Update every sighting for turning `angle` degrees clockwise then moving `distance` metres forwards."""
+        for code, observations in self.observations.items():
+            moved = [self.transform_observation(observation, angle, distance) for observation in observations]
+            observations.clear()
+            observations.extend(moved)
+
+    def transform_observation(self, observation, angle, distance):
+        # type: (Observation, float, float) -> Observation
+        # Work in the robot's frame, with x to the right and y forwards.
+        x = observation.dist * sind(observation.rot_y)
+        y = observation.dist * cosd(observation.rot_y) + self.camera_offset
+        # Turning clockwise makes everything swing anticlockwise, relative to us.
+        x, y = x * cosd(angle) - y * sind(angle), x * sind(angle) + y * cosd(angle)
+        y -= distance + self.camera_offset
+        rot_y = degrees(atan2(x, y))
+        # orientation.rot_y is relative to the line of sight (see
+        # `corrections.correct_for_cube_marker_placement`), so the marker's
+        # facing in our frame is their sum.
+        facing = observation.rot_y + observation.orientation_rot_y - angle
+        return Observation(observation.time, hypot(x, y), rot_y, facing - rot_y)
+
+    def estimate(self, code):
+        # type: (int) -> MarkerEstimate
+        """Return the estimated position of a marker, or None if we haven't seen it recently."""
+        observations = self.observations.get(code)
+        if observations:
+            cutoff = time.time() - self.max_age
+            while observations and observations[0].time < cutoff:
+                observations.popleft()
+        if not observations:
+            return None
+        n = len(observations)
+        dists = [observation.dist for observation in observations]
+        rot_ys = [observation.rot_y for observation in observations]
+        orientations = [observation.orientation_rot_y for observation in observations]
+
+        def estimate_variance(values, noise):
+            # The variance of the median of n samples is about pi / 2 times that of their mean.
+            spread = max(variance(values), noise ** 2) if n > 1 else noise ** 2
+            return pi / 2 * spread / n
+
+        return MarkerEstimate(code, median(dists), median(rot_ys), median(orientations),
+                              estimate_variance(dists, self.dist_noise),
+                              estimate_variance(rot_ys, self.angle_noise),
+                              estimate_variance(orientations, self.angle_noise), n)
+
+    @staticmethod
+    def confident(estimate, max_sd=1.5, min_count=2):
+        # type: (MarkerEstimate, float, int) -> bool
+        """
+        Return whether an estimate is good enough to act on.
+
+        It must be based on at least `min_count` sightings, and the standard
+        deviation of its angle must be at most `max_sd` degrees. By default,
+        two sightings that agree to within a degree or so are enough.
+        """
+        return estimate is not None and estimate.count >= min_count and sqrt(estimate.rot_y_variance) <= max_sd
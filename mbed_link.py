@@ -7,36 +7,881 @@ the 2017 Student Robotics competition "Easy as ABC".
 
 from __future__ import division
 
+import collections
+import glob
+from math import ceil, copysign
+import os
+import select
 import serial
+import struct
+import threading
 import time
 
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List, Tuple
+except ImportError:
+    pass
+
+from metrics import Metrics
+from speed_model import NON_MOTION_TIMEOUT, SpeedModel
+from trig import arc_length
+
 
 class CommandFailureError(Exception):
     """The mbed responded with an error."""
 
 
+class FramingError(CommandFailureError):
+    """A frame from the mbed was corrupted or truncated."""
+
+
+class CommandTimeoutError(CommandFailureError):
+    """The mbed didn't respond to a command in time."""
+
+
+class ConnectionLostError(CommandFailureError):
+    """The serial connection to the mbed died, e.g. because its USB link reset."""
+
+
 class MovementInterruptedError(CommandFailureError):
     """The robot's movement was interrupted."""
 
 
+class MovementTimeoutError(MovementInterruptedError, CommandTimeoutError):
+    """The mbed didn't finish a movement in time."""
+
+
+def movement_error(error):
+    # type: (CommandFailureError) -> MovementInterruptedError
+    """Return the movement error corresponding to a failed command."""
+    if isinstance(error, CommandTimeoutError):
+        return MovementTimeoutError(*error.args)
+    return MovementInterruptedError(*error.args)
+
+
+class PlanInterruptedError(MovementInterruptedError):
+    """One step of a motion plan was interrupted.
+
+    `step` is the index into the plan of the motion that failed, and `seq`
+    is the sequence number of the mbed command that failed. `timed_out` is
+    True if the mbed didn't respond to the command in time, rather than
+    responding with an error.
+    """
+
+    def __init__(self, step, seq, timed_out=False):
+        super(PlanInterruptedError, self).__init__(step, seq)
+        self.step = step
+        self.seq = seq
+        self.timed_out = timed_out
+
+
+# A single motion primitive, for use in a plan passed to `Mbed.run_plan`.
+# `kind` is "move", "low_power_move", "turn" or "drive"; `amount` is in
+# metres or degrees clockwise, as for the methods of the same names, or a
+# Vector for "drive" (see `Mbed.drive_to`).
+Motion = collections.namedtuple("Motion", ["kind", "amount"])
+# The amount of a "drive" motion reported to motion listeners (see
+# `Mbed.motion_listeners`); it has the same fields as a Vector.
+Arc = collections.namedtuple("Arc", ["distance", "angle"])
+
+# The furthest a single low power move can go in the original protocol, in metres.
+MAX_LOW_POWER_MOVE = 2.55
+
+
+def low_power_moves(distance):
+    # type: (float) -> List[Motion]
+    """Return the low power moves that go `distance` metres, each short enough for either protocol."""
+    count = max(1, int(ceil(distance / MAX_LOW_POWER_MOVE)))
+    return [Motion("low_power_move", distance / count)] * count
+
+
+# The framed protocol
+# ===================
+#
+# The original protocol is one command character followed by one byte of
+# data, and one response byte ("e" for an error). This limits movements to
+# 2.55 m and turns to 255 degrees, and a corrupted byte is indistinguishable
+# from a real response.
+#
+# In the framed protocol, both commands and responses are sent as frames:
+#
+#     STX | seq | kind | length | payload (length bytes) | checksum
+#
+# where STX is 0x02, seq is the command's sequence number modulo 256, kind is
+# the command character (or, in a response, "k" for success and "e" for
+# failure), and checksum is the sum of every byte after the STX, modulo 256.
+# Motion commands have a 16-bit signed big-endian payload, in millimetres
+# or tenths of a degree, so any motion takes exactly one command.
+#
+# At startup, we send a "H" (hello) frame whose payload is our protocol
+# version. An mbed that speaks the framed protocol replies with a "k" frame
+# containing its version; if there is no valid reply, we fall back to the
+# original protocol. None of the bytes in the hello frame are valid
+# commands in the original protocol, so old firmware ignores it.
+#
+# Version 2 adds the "a" (arc) command, whose payload is two 16-bit signed
+# integers: the straight-line distance to the target in millimetres, and
+# the angle to the target in tenths of a degree (see `Mbed.drive_to`).
+#
+# Version 3 adds telemetry. The "t" command's payload is a 16-bit rate in
+# Hz (0 to stop). While a motion command runs, the mbed then streams "T"
+# frames, with the sequence number of the running command and a payload of
+# the left and right encoder ticks since the command started (16-bit
+# signed) and the motor current in milliamps (16-bit unsigned). Telemetry
+# frames are interleaved with responses, so a reader thread separates them
+# (see `Mbed.start_telemetry`).
+#
+# Version 4 adds the "x" (stop) command, which has no payload. The mbed acts
+# on it as soon as it arrives, even in the middle of a motion: the running
+# motion command stops where it is and fails, and so does every motion
+# command queued behind it. "x" itself has no response, so it can be sent
+# while other commands are in flight (see `Mbed.stop_motion`).
+FRAME_START = "\x02"
+PROTOCOL_VERSION = 4
+# The first versions of the framed protocol that support arcs, telemetry and stopping.
+ARC_PROTOCOL_VERSION = 2
+TELEMETRY_PROTOCOL_VERSION = 3
+STOP_PROTOCOL_VERSION = 4
+# Encoder ticks per metre travelled by each wheel.
+TICKS_PER_METRE = 1000
+
+# Where the mbed may reappear after its USB link resets. It usually comes
+# back as the next free ttyACM device, not necessarily the one it had.
+DEFAULT_PORT_PATTERNS = ["/dev/ttyACM*"]
+# How long to keep looking for the mbed after losing the connection, and
+# how often to look, in seconds.
+RECONNECT_TIMEOUT = 5.0
+RECONNECT_INTERVAL = 0.05
+# Interrupted moves with less than this far left to go (in metres) aren't resumed.
+MIN_RESUME_DISTANCE = 0.01
+# How long to wait for the mbed to reply to the hello frame.
+NEGOTIATION_TIMEOUT = 0.5
+# How long to wait for the rest of a frame once it has started arriving.
+FRAME_TIMEOUT = 0.1
+
+# How far each motion command moves per unit of data, in metres or degrees,
+# in the original and framed protocols.
+ORIGINAL_UNITS = {"f": 0.01, "F": 0.1, "b": 0.01, "A": 0.01, "l": 1, "r": 1}
+FRAMED_UNITS = {"f": 0.001, "b": 0.001, "A": 0.001, "l": 0.1, "r": 0.1}
+
+
+# A telemetry sample from the mbed. `time` is when we received it, `seq` is
+# the sequence number of the command that was running, `left` and `right`
+# are encoder ticks since that command started, and `current` is the motor
+# current in amps.
+TelemetrySample = collections.namedtuple("TelemetrySample", ["time", "seq", "left", "right", "current"])
+
+
+def frame_checksum(body):
+    # type: (str) -> int
+    """Return the checksum of the part of a frame between the STX and the checksum."""
+    return sum(bytearray(body)) & 0xFF
+
+
+def encode_frame(seq, kind, payload=""):
+    # type: (int, str, str) -> str
+    """Return a frame, ready to be sent to (or by) the mbed."""
+    body = chr(seq % 256) + kind + chr(len(payload)) + payload
+    return FRAME_START + body + chr(frame_checksum(body))
+
+
+class PendingCommand(object):
+    """A command that has been sent to the mbed but not yet acknowledged.
+
+    Returned by `Mbed.start_command` and friends. The robot carries on
+    moving while the caller does something else (e.g. looks for markers);
+    call `wait` to block until the mbed responds. Waiting is done with
+    select(), so a motion in progress costs no CPU.
+
+    `fileno` is provided so that pending commands can be passed straight
+    to select() alongside other file descriptors.
+    """
+
+    def __init__(self, mbed, seq, command, data, send_time, error=None, amount=None, allowed=None):
+        self.mbed = mbed
+        self.seq = seq
+        self.command = command
+        self.data = data
+        self.send_time = send_time
+        self.error = error
+        # How far this command moves the robot, in metres or degrees.
+        self.amount = amount
+        # How long the mbed may take to carry out this command, in seconds.
+        self.allowed = allowed
+        self.response = None
+        # Called once this command succeeds; may return another PendingCommand to wait on.
+        self.follow_up = None
+
+    def fileno(self):
+        # type: () -> int
+        return self.mbed.response_fileno()
+
+    @property
+    def is_motion(self):
+        # type: () -> bool
+        """Whether this command moves the robot."""
+        return self.amount is not None or self.command == "c"
+
+    def done(self):
+        # type: () -> bool
+        """Return whether the mbed has responded, without blocking."""
+        return self.response is not None or self.mbed.response_waiting()
+
+    def deadline(self):
+        # type: () -> float
+        """
+        Return the time by which the mbed must have responded to this command.
+
+        The mbed only starts a command once it has finished the previous
+        one, so the allowed time counts from whichever is later.
+        """
+        if self.allowed is None:
+            return None
+        return max(self.send_time, self.mbed.last_response_time) + self.allowed
+
+    def wait(self, timeout=None):
+        # type: (float) -> str
+        """
+        Block until the mbed responds to this command, then return the response.
+
+        Returns None if `timeout` seconds pass without a response.
+
+        Raises:
+            CommandFailureError: The mbed responded with an error. If this
+                command was started by a movement method, the more specific
+                MovementInterruptedError is raised instead.
+            CommandTimeoutError: The mbed didn't respond before the command's
+                deadline. If this command was started by a movement method,
+                MovementTimeoutError is raised instead.
+            ConnectionLostError: The connection to the mbed died, and we
+                couldn't reconnect (see `Mbed.reconnect`). If we did
+                reconnect, the command is resumed and waited for, ignoring
+                `timeout`.
+        """
+        if self.response is None:
+            deadline = self.deadline()
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            try:
+                if timeout is not None and (remaining is None or timeout < remaining):
+                    if not self.mbed.wait_for_response(timeout):
+                        return None
+                elif not self.mbed.wait_for_response(remaining):
+                    self.mbed.command_timed_out(self)
+                    if self.error is not None:
+                        raise MovementTimeoutError(self.seq)
+                    raise CommandTimeoutError(self.seq)
+                self.response = self.mbed.read_response(self)
+            except ConnectionLostError:
+                self.mbed.log.exception("Lost connection to the mbed during command #%s", self.seq)
+                self.response = self.mbed.recover(self)
+            except FramingError:
+                if self.error is not None:
+                    self.mbed.log.exception("Corrupted response to mbed command #%s", self.seq)
+                    raise self.error()
+                raise
+        if self.response == "e":
+            if self.error is not None:
+                raise self.error()
+            raise CommandFailureError(self.response)
+        if self.follow_up is not None:
+            follow_up, self.follow_up = self.follow_up, None
+            pending = follow_up()
+            if pending is not None:
+                return pending.wait(timeout)
+        return self.response
+
+
 class Mbed(object):
-    def __init__(self, log, timeout=None):
+    def __init__(self, log, timeout=None, framed=None, port="/dev/ttyACM0", max_arc_angle=45, telemetry_size=512,
+                 port_patterns=None, reconnect_timeout=RECONNECT_TIMEOUT):
+        """
+        Connect to the mbed on the given serial port.
+
+        If the connection dies (e.g. the mbed's USB link resets), we look
+        for the mbed on `port` and on any port matching one of the glob
+        `port_patterns` (by default, any ttyACM device), for at most
+        `reconnect_timeout` seconds (see `reconnect`).
+
+        If `framed` is None, ask the mbed whether it speaks the framed
+        protocol (see above) and use it if so. Otherwise, `framed` says
+        which protocol to use.
+
+        `max_arc_angle` is the sharpest arc (see `drive_to`) the robot will
+        drive, in degrees. `telemetry_size` is how many telemetry samples
+        (see `start_telemetry`) to keep.
+
+        To talk to a simulated mbed instead, pass the port of an
+        `mbed_sim.MbedSimulator`.
+        """
         self.log = log
-        port = "/dev/ttyACM0"
-        baudrate = 115200
-        self.conn = serial.Serial(port, baudrate=baudrate, timeout=timeout, writeTimeout=timeout)
+        # Latency histograms per command character ("rtt.f", "rtt.r", ...),
+        # and counts of commands, failures, retries, timeouts and framing
+        # errors. For commands in a plan, latency includes time spent queued
+        # behind earlier commands.
+        self.metrics = Metrics()
+        self.port = port
+        self.port_patterns = DEFAULT_PORT_PATTERNS if port_patterns is None else port_patterns
+        self.timeout = timeout
+        self.reconnect_timeout = reconnect_timeout
+        self.conn = self.open_port(port)
+        # Held while writing to the port, since `stop_motion` may be called from another thread.
+        self.write_lock = threading.Lock()
+        # The sequence number of the next command sent to the mbed.
+        self.seq = 0
+        # How fast the robot moves, for working out command deadlines.
+        self.speed_model = SpeedModel()
+        # When the mbed last responded to a command.
+        self.last_response_time = 0
+        # The last motion command, as (command, amount), so we know how
+        # long retrying it ("c") should take.
+        self.last_motion = None
+        # How many motion commands we haven't had a response to, and when
+        # the mbed last finished one (so we know when pictures are valid).
+        self.motions_in_flight = 0
+        self.last_motion_end = 0
+        # How many commands timed out whose responses may still arrive, in
+        # the original protocol (see `read_response`).
+        self.late_responses = 0
+        # Functions called with each Motion the robot has carried out, once
+        # the mbed says it's done, or with None if the robot moved by an
+        # unknown amount (e.g. a motion failed part way through).
+        self.motion_listeners = []
+        self.max_arc_angle = max_arc_angle
+        # The most recent telemetry samples, oldest first.
+        self.telemetry = collections.deque(maxlen=telemetry_size)
+        self.ticks_per_metre = TICKS_PER_METRE
+        # While telemetry is enabled, a reader thread reads every frame from
+        # the mbed. It keeps telemetry samples, and puts everything else in
+        # self.responses (writing a byte to a pipe for each, so that we can
+        # still wait for responses with select()).
+        self.reader = None
+        self.responses = collections.deque()
+        self.responses_lock = threading.Lock()
+        self.responses_r, self.responses_w = None, None
+        # How often telemetry was asked for, so it can be restarted after reconnecting.
+        self.telemetry_rate = None
+        # Whether to ask the mbed which protocol it speaks again after reconnecting.
+        self.negotiate = framed is None
+        if framed is None:
+            self.protocol_version = self.negotiate_protocol()
+        else:
+            self.protocol_version = PROTOCOL_VERSION if framed else 0
+        self.framed = self.protocol_version > 0
+        self.log.info("Using the %s protocol (version %s) to talk to the mbed",
+                      "framed" if self.framed else "original", self.protocol_version)
+
+    def open_port(self, port):
+        # type: (str) -> serial.Serial
+        return serial.Serial(port, baudrate=115200, timeout=self.timeout, writeTimeout=self.timeout)
+
+    def candidate_ports(self):
+        # type: () -> List[str]
+        """Return the ports the mbed might be on, most likely first."""
+        ports = [self.port]
+        for pattern in self.port_patterns:
+            ports.extend(port for port in sorted(glob.glob(pattern)) if port not in ports)
+        return ports
+
+    def reconnect(self):
+        # type: () -> None
+        """
+        Reopen the connection to the mbed, after it died.
+
+        Every candidate port (see `candidate_ports`) is tried until one
+        opens, or until `reconnect_timeout` seconds pass. The protocol is
+        then negotiated again, and telemetry restarted. How long this took
+        is recorded in the "reconnect" histogram.
+
+        Anything in flight when the connection died is lost; the caller is
+        responsible for resuming it (see `resume_commands`).
 
-    def get_switch_state(self):
+        Raises:
+            ConnectionLostError: The mbed didn't come back in time.
+        """
+        start = time.time()
+        self.metrics.increment("reconnects")
+        self.stop_reader()
+        # The mbed has stopped whatever it was doing, part way through.
+        if self.motions_in_flight:
+            self.notify_motion(None)
+        self.motions_in_flight = 0
+        self.last_motion_end = start
+        self.late_responses = 0
+        try:
+            self.conn.close()
+        except (serial.SerialException, EnvironmentError):
+            pass
+        deadline = start + self.reconnect_timeout
+        while True:
+            for port in self.candidate_ports():
+                try:
+                    conn = self.open_port(port)
+                except (serial.SerialException, EnvironmentError):
+                    continue
+                self.log.info("Reopened connection to the mbed on %s", port)
+                self.port = port
+                self.conn = conn
+                break
+            else:
+                if time.time() > deadline:
+                    self.metrics.increment("reconnect_failures")
+                    raise ConnectionLostError("Couldn't find the mbed within {} seconds".format(self.reconnect_timeout))
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+            break
+        if self.negotiate:
+            self.protocol_version = self.negotiate_protocol()
+            self.framed = self.protocol_version > 0
+        if self.telemetry_rate is not None:
+            self.start_telemetry(self.telemetry_rate)
+        recovery_time = time.time() - start
+        self.metrics.record("reconnect", recovery_time)
+        self.log.info("Reconnected to the mbed in %.3f seconds (protocol version %s)", recovery_time, self.protocol_version)
+
+    def resume_commands(self, pending):
+        # type: (PendingCommand) -> List[Tuple[str, int]]
+        """
+        Return the (command, data) pairs needed to finish a command that was interrupted by losing the connection.
+
+        Straight moves are resumed from how far telemetry says the wheels
+        got; anything else is replayed from the start.
+        """
+        if pending.command in "fbA" and self.framed and pending.amount is not None:
+            travelled = self.distance_travelled(pending.seq)
+            if travelled is not None:
+                remaining = abs(pending.amount) - travelled
+                self.log.info("Resuming command #%s %s after %s of %s metres", pending.seq, pending.command, travelled, pending.amount)
+                if remaining < MIN_RESUME_DISTANCE:
+                    return []
+                return [(pending.command, self.distance_data(remaining))]
+        self.log.info("Replaying command #%s %s(%s)", pending.seq, pending.command, pending.data if pending.data is not None else "")
+        return [(pending.command, pending.data)]
+
+    def recover(self, pending):
+        # type: (PendingCommand) -> str
+        """
+        Reconnect to the mbed, then finish a command that was in flight, returning its response.
+
+        Raises:
+            ConnectionLostError: The mbed didn't come back in time.
+            CommandFailureError: The resumed command failed (see `PendingCommand.wait`).
+        """
+        self.reconnect()
+        commands = self.resume_commands(pending)
+        if not commands:
+            return "k"
+        resumed = self.start_commands(commands, error=pending.error)
+        if resumed is None:
+            raise ConnectionLostError("Couldn't resume command #{}".format(pending.seq))
+        return resumed.wait()
+
+    def read_port(self, size):
+        # type: (int) -> str
+        """
+        Read `size` bytes from the serial port.
+
+        Raises:
+            ConnectionLostError: The port has gone away.
+        """
+        try:
+            data = self.conn.read(size)
+        except (serial.SerialException, EnvironmentError) as e:
+            raise ConnectionLostError(str(e))
+        if len(data) < size and self.timeout is None:
+            # A blocking read only returns early if the device has gone.
+            raise ConnectionLostError("Read {} of {} bytes".format(len(data), size))
+        return data
+
+    def write_port(self, data):
+        # type: (str) -> None
+        """
+        Write to the serial port.
+
+        Raises:
+            serial.SerialTimeoutException: The write timed out.
+            ConnectionLostError: The port has gone away.
+        """
+        try:
+            with self.write_lock:
+                self.conn.write(data)
+        except serial.SerialTimeoutException:
+            raise
+        except (serial.SerialException, EnvironmentError) as e:
+            raise ConnectionLostError(str(e))
+
+    def negotiate_protocol(self):
+        # type: () -> int
+        """
+        Ask the mbed which version of the framed protocol it speaks, and return it.
+
+        Returns 0 if the mbed only speaks the original protocol.
+        """
+        self.flush_input()
         try:
-            self.conn.write("s")
+            self.write_port(encode_frame(0, "H", chr(PROTOCOL_VERSION)))
+        except serial.SerialTimeoutException:
+            self.log.exception("Timeout sending hello frame to mbed")
+            return 0
+        version = 0
+        if self.wait_for_response(NEGOTIATION_TIMEOUT):
+            try:
+                _, kind, payload = self.read_frame()
+            except FramingError:
+                self.log.debug("mbed sent an invalid reply to the hello frame")
+            else:
+                self.log.debug("mbed replied to the hello frame with %s(%r)", kind, payload)
+                if kind == "k" and len(payload) == 1:
+                    version = min(ord(payload), PROTOCOL_VERSION)
+        self.flush_input()
+        return version
+
+    def read_exactly(self, size, timeout=FRAME_TIMEOUT):
+        # type: (int, float) -> str
+        """
+        Read `size` bytes from the mbed, waiting at most `timeout` seconds for them.
+
+        Raises:
+            FramingError: The bytes didn't arrive in time.
+            ConnectionLostError: The port has gone away.
+        """
+        data = ""
+        deadline = time.time() + timeout
+        while len(data) < size:
+            if not self.port_readable(max(0, deadline - time.time())):
+                raise FramingError("Timed out with {} of {} bytes read".format(len(data), size))
+            try:
+                waiting = self.conn.inWaiting()
+            except (serial.SerialException, EnvironmentError) as e:
+                raise ConnectionLostError(str(e))
+            # If nothing is waiting, the port has probably gone away; reading will tell us.
+            data += self.read_port(max(1, min(size - len(data), waiting)))
+        return data
+
+    def read_frame(self):
+        # type: () -> Tuple[int, str, str]
+        """
+        Read a frame from the mbed, returning its (seq, kind, payload).
+
+        While telemetry is enabled, this returns the next response passed on
+        by the reader thread, so it must only be called once
+        `wait_for_response` says there is one.
+
+        Raises:
+            FramingError: The frame was corrupted or truncated.
+            ConnectionLostError: The connection to the mbed died.
+        """
+        if self.reader is None:
+            return self.read_frame_from_port()
+        with self.responses_lock:
+            frame = self.responses.popleft()
+            os.read(self.responses_r, 1)
+        if isinstance(frame, CommandFailureError):
+            raise frame
+        return frame
+
+    def read_frame_from_port(self):
+        # type: () -> Tuple[int, str, str]
+        """
+        Read a frame straight from the serial port, returning its (seq, kind, payload).
+
+        Raises:
+            FramingError: The frame was corrupted or truncated.
+        """
+        start = self.read_exactly(1)
+        if start != FRAME_START:
+            raise FramingError("Expected the start of a frame, got {!r}".format(start))
+        header = self.read_exactly(3)
+        seq, kind, length = ord(header[0]), header[1], ord(header[2])
+        payload = self.read_exactly(length)
+        checksum = ord(self.read_exactly(1))
+        if checksum != frame_checksum(header + payload):
+            raise FramingError("Bad checksum {} in frame {!r}".format(checksum, header + payload))
+        return seq, kind, payload
+
+    def command_amount(self, command, data):
+        # type: (str, int) -> float
+        """
+        Return how far a command moves the robot, in metres or degrees.
+
+        Returns None if the command doesn't move the robot.
+        """
+        if command == "a":
+            distance, angle = data
+            return arc_length(distance * FRAMED_UNITS["f"], angle * FRAMED_UNITS["r"])
+        units = FRAMED_UNITS if self.framed else ORIGINAL_UNITS
+        if data is None or command not in units:
+            return None
+        return data * units[command]
+
+    def distance_data(self, amount):
+        # type: (float) -> int
+        """Return the data to send to the mbed to move `amount` metres."""
+        if self.framed:
+            return int(round(amount * 1000))
+        return int(amount * 100)
+
+    def angle_data(self, amount):
+        # type: (float) -> int
+        """Return the data to send to the mbed to turn `amount` degrees."""
+        if self.framed:
+            return int(round(amount * 10))
+        return int(round(amount))
+
+    def response_waiting(self):
+        # type: () -> bool
+        """Return whether the mbed has sent something we haven't read yet."""
+        if self.reader is not None:
+            return bool(self.responses)
+        try:
+            return bool(self.conn.inWaiting())
+        except (serial.SerialException, EnvironmentError):
+            # Let whoever reads next find out that the port has gone away.
+            return True
+
+    def response_fileno(self):
+        # type: () -> int
+        """Return a file descriptor that is readable when a response is waiting."""
+        if self.reader is not None:
+            return self.responses_r
+        return self.conn.fileno()
+
+    def wait_for_response(self, timeout=None):
+        # type: (float) -> bool
+        """
+        Sleep until the mbed sends something, or until `timeout` seconds pass.
+
+        Returns whether there is something to read.
+        """
+        if self.response_waiting():
+            return True
+        readable, _, _ = select.select([self.response_fileno()], [], [], timeout)
+        return bool(readable)
+
+    def port_readable(self, timeout=None):
+        # type: (float) -> bool
+        """Sleep until there is something to read from the serial port, or until `timeout` seconds pass."""
+        try:
+            if self.conn.inWaiting():
+                return True
+        except (serial.SerialException, EnvironmentError):
+            return True
+        readable, _, _ = select.select([self.conn], [], [], timeout)
+        return bool(readable)
+
+    def flush_input(self):
+        # type: () -> None
+        """Discard anything the mbed has sent that we haven't read yet, apart from telemetry."""
+        if self.reader is None:
+            try:
+                if self.late_responses:
+                    self.late_responses = max(0, self.late_responses - self.conn.inWaiting())
+                self.conn.flushInput()
+            except (serial.SerialException, EnvironmentError):
+                # The next read or write will notice that the port has gone away.
+                pass
+            return
+        with self.responses_lock:
+            if self.responses:
+                os.read(self.responses_r, len(self.responses))
+                self.responses.clear()
+
+    def start_telemetry(self, rate=50):
+        # type: (int) -> bool
+        """
+        Ask the mbed to stream telemetry `rate` times a second while it moves.
+
+        Samples are kept in `self.telemetry`, a ring buffer of the most
+        recent samples. Returns whether telemetry was started; it can't be
+        if the mbed doesn't support it.
+        """
+        if self.protocol_version < TELEMETRY_PROTOCOL_VERSION:
+            self.log.info("mbed doesn't support telemetry (protocol version %s)", self.protocol_version)
+            return False
+        self.telemetry_rate = rate
+        if self.reader is None:
+            self.responses_r, self.responses_w = os.pipe()
+            self.reader = threading.Thread(target=self.read_frames, name="mbed reader")
+            self.reader.daemon = True
+            self.reader.start()
+        try:
+            self.send_command("t", rate)
+        except CommandFailureError:
+            self.log.exception("Failed to start telemetry")
+            self.stop_reader()
+            return False
+        self.log.info("Streaming telemetry from the mbed at %s Hz", rate)
+        return True
+
+    def stop_reader(self):
+        # type: () -> None
+        """Stop the reader thread, and go back to reading responses directly."""
+        reader, self.reader = self.reader, None
+        if reader is not None:
+            reader.join()
+            os.close(self.responses_r)
+            os.close(self.responses_w)
+            self.responses.clear()
+
+    def read_frames(self):
+        # type: () -> None
+        """Read frames until told to stop, separating telemetry from responses (for the reader thread)."""
+        while self.reader is threading.current_thread():
+            try:
+                if not self.port_readable(0.1):
+                    continue
+                frame = self.read_frame_from_port()
+            except ConnectionLostError as e:
+                # Wake up whoever is waiting for a response, so that they reconnect.
+                self.log.error("Lost connection to the mbed: %s", e)
+                with self.responses_lock:
+                    self.responses.append(e)
+                    os.write(self.responses_w, "x")
+                return
+            except FramingError as e:
+                # Counted by read_response, when it gets the error.
+                self.conn.flushInput()
+                frame = e
+            else:
+                seq, kind, payload = frame
+                if kind == "T":
+                    left, right, current = struct.unpack(">hhH", payload)
+                    self.telemetry.append(TelemetrySample(time.time(), seq, left, right, current / 1000))
+                    continue
+            with self.responses_lock:
+                self.responses.append(frame)
+                os.write(self.responses_w, "x")
+
+    def telemetry_samples(self, seq=None, since=None):
+        # type: (int, float) -> List[TelemetrySample]
+        """
+        Return the telemetry samples for command `seq` (all commands if None), received after `since`.
+        """
+        samples = list(self.telemetry)
+        return [sample for sample in samples
+                if (seq is None or sample.seq == seq % 256) and (since is None or sample.time > since)]
+
+    def distance_travelled(self, seq=None):
+        # type: (int) -> float
+        """
+        Return how far the robot's wheels have travelled during a command, in metres.
+
+        `seq` defaults to the command the mbed is running (or last ran).
+        Returns None if there is no telemetry for that command.
+        """
+        if seq is None:
+            if not self.telemetry:
+                return None
+            seq = self.telemetry[-1].seq
+        samples = self.telemetry_samples(seq)
+        if not samples:
+            return None
+        last = samples[-1]
+        return (abs(last.left) + abs(last.right)) / 2 / self.ticks_per_metre
+
+    def distance_since(self, seq):
+        # type: (int) -> float
+        """
+        Return how far the robot's wheels have travelled during command `seq` and every command since, in metres.
+
+        Commands with no telemetry count as not moving the robot.
+        """
+        distances = [self.distance_travelled(s) for s in xrange(seq, self.seq)]
+        return sum(distance for distance in distances if distance is not None)
+
+    @property
+    def telemetry_enabled(self):
+        # type: () -> bool
+        return self.reader is not None
+
+    def is_stalled(self, window=0.3, min_distance=0.01):
+        # type: (float, float) -> bool
+        """
+        Return whether the robot seems to be stuck, from telemetry.
+
+        The robot is stuck if the mbed is running a command, but the wheels
+        have moved less than `min_distance` metres in the last `window`
+        seconds. Returns False if there isn't enough telemetry to tell.
+        """
+        if not self.telemetry:
+            return False
+        now = time.time()
+        latest = self.telemetry[-1]
+        if now - latest.time > window:
+            # The mbed has stopped sending telemetry, so it isn't running anything.
+            return False
+        older = [sample for sample in self.telemetry_samples(latest.seq) if sample.time <= now - window]
+        if not older:
+            return False
+        start = older[-1]
+        moved = (abs(latest.left - start.left) + abs(latest.right - start.right)) / 2 / self.ticks_per_metre
+        return moved < min_distance
+
+    @property
+    def can_stop(self):
+        # type: () -> bool
+        """Whether the mbed can stop a motion part way through (see `stop_motion`)."""
+        return self.protocol_version >= STOP_PROTOCOL_VERSION
+
+    def stop_motion(self):
+        # type: () -> bool
+        """
+        Tell the mbed to stop moving now, and return whether we could.
+
+        The running motion command, and any queued behind it, fail; whoever
+        is waiting for them gets a MovementInterruptedError as usual. This
+        can be called from any thread. Returns False if the mbed doesn't
+        support stopping, or the command couldn't be sent.
+        """
+        if not self.can_stop:
+            return False
+        self.log.warn("Stopping the robot")
+        self.metrics.increment("commands.x")
+        try:
+            self.write_port(encode_frame(self.seq, "x"))
+        except (serial.SerialTimeoutException, ConnectionLostError):
+            self.log.exception("Couldn't tell the mbed to stop")
+            return False
+        return True
+
+    def get_switch_state(self, reconnect=True):
+        try:
+            if self.framed:
+                seq = self.seq % 256
+                self.write_port(encode_frame(seq, "s"))
+                self.seq += 1
+            else:
+                self.write_port("s")
+            if not self.wait_for_response(NON_MOTION_TIMEOUT):
+                self.log.error("Timeout waiting for mbed to respond to command s")
+                self.metrics.increment("timeouts")
+                return
+            if self.framed:
+                try:
+                    response_seq, _, payload = self.read_frame()
+                    if response_seq != seq:
+                        raise FramingError("Expected a response to command #{}, got one to #{}".format(seq, response_seq))
+                    if len(payload) != 1:
+                        raise FramingError("Expected a 1 byte switch state, got {!r}".format(payload))
+                except FramingError:
+                    self.log.exception("Corrupted response to mbed command s")
+                    self.metrics.increment("framing_errors")
+                    self.flush_input()
+                    return
+                response = ord(payload)
+            else:
+                response = ord(self.read_port(1))
         except serial.SerialTimeoutException:
             self.log.error("Timeout sending mbed command s")
             return
-        while not self.conn.inWaiting():
-            pass
-        response = ord(self.conn.read(1))
+        except ConnectionLostError:
+            if not reconnect:
+                raise
+            self.log.exception("Lost connection to the mbed while reading the switch state")
+            self.reconnect()
+            return self.get_switch_state(reconnect=False)
         self.log.debug("mbed sent response %s", response)
-        self.conn.flushInput()
+        self.flush_input()
         return response
 
     def move(self, amount, ignore_crash=False):
@@ -78,37 +923,42 @@ class Mbed(object):
         """
         Go forwards `amount` m.
         """
-        if amount <= 2.55:
+        commands = self.forwards_commands(amount)
+        for phase, (command, data) in enumerate(commands, 1):
             try:
-                self.send_command("f", int(amount * 100))
-            except CommandFailureError:
-                self.log.exception("Failed to move forwards (short movement)")
-                raise MovementInterruptedError
-        else:
-            amount, remainder = divmod(amount * 100, 10)  # decimetres, centimetres
-            try:
-                self.send_command("F", int(amount))
-            except CommandFailureError:
-                self.log.exception("Failed to move forwards (long movement phase 1)")
-                raise MovementInterruptedError
-            else:
-                if remainder >= 2:
-                    try:
-                        self.send_command("f", int(remainder))
-                    except CommandFailureError:
-                        self.log.exception("Failed to move forwards (long movement phase 2)")
-                        raise MovementInterruptedError
-                elif remainder > 0:
-                    self.log.warn("Discarding extra distance of %s cm", remainder)
+                self.send_command(command, data)
+            except CommandFailureError as e:
+                if len(commands) == 1:
+                    self.log.exception("Failed to move forwards (short movement)")
+                else:
+                    self.log.exception("Failed to move forwards (long movement phase %s)", phase)
+                raise movement_error(e)
+
+    def forwards_commands(self, amount):
+        # type: (float) -> List[Tuple[str, int]]
+        """
+        Return the list of (command, data) pairs needed to go forwards `amount` m.
+        """
+        if self.framed:
+            return [("f", self.distance_data(amount))]
+        if amount <= 2.55:
+            return [("f", int(amount * 100))]
+        amount, remainder = divmod(amount * 100, 10)  # decimetres, centimetres
+        commands = [("F", int(amount))]
+        if remainder >= 2:
+            commands.append(("f", int(remainder)))
+        elif remainder > 0:
+            self.log.warn("Discarding extra distance of %s cm", remainder)
+        return commands
 
     def low_power_move(self, amount):
-        assert amount <= 2.55
+        assert self.framed or amount <= MAX_LOW_POWER_MOVE
         self.log.debug("Moving forwards in low power mode")
         try:
-            self.send_command("A", int(amount * 100))
-        except CommandFailureError:
+            self.send_command("A", self.distance_data(amount))
+        except CommandFailureError as e:
             self.log.exception("Failed to move forwards (low power movement)")
-            raise MovementInterruptedError
+            raise movement_error(e)
 
     def backwards(self, amount):
         # type: (float) -> None
@@ -116,10 +966,10 @@ class Mbed(object):
         Go backwards `amount` m.
         """
         try:
-            self.send_command("b", int(amount*100))
-        except CommandFailureError:
+            self.send_command("b", self.distance_data(amount))
+        except CommandFailureError as e:
             self.log.exception("Failed to move backwards")
-            raise MovementInterruptedError()
+            raise movement_error(e)
 
     def turn_left(self, amount):
         # type: (float) -> None
@@ -129,10 +979,10 @@ class Mbed(object):
         """
         self.log.debug("Turning left %s degrees", amount)
         try:
-            self.send_command("l", int(round(amount)))
-        except CommandFailureError:
+            self.send_command("l", self.angle_data(amount))
+        except CommandFailureError as e:
             self.log.exception("Failed to turn left")
-            raise MovementInterruptedError()
+            raise movement_error(e)
 
     def turn_right(self, amount):
         # type: (float) -> None
@@ -142,10 +992,10 @@ class Mbed(object):
         """
         self.log.debug("Turning right %s degrees", amount)
         try:
-            self.send_command("r", int(round(amount)))
-        except CommandFailureError:
+            self.send_command("r", self.angle_data(amount))
+        except CommandFailureError as e:
             self.log.exception("Failed to turn right")
-            raise MovementInterruptedError()
+            raise movement_error(e)
             
     def retry(self):
         """
@@ -154,35 +1004,384 @@ class Mbed(object):
         self.log.debug("Continuing")
         try:
             self.send_command("c")
-        except CommandFailureError:
+        except CommandFailureError as e:
             self.log.exception("Failed to continue")
-            raise MovementInterruptedError()
+            raise movement_error(e)
+
+    def start_move(self, amount):
+        # type: (float) -> PendingCommand
+        """
+        Start moving `amount` metres (backwards if negative) and return immediately.
+
+        Wait for the movement to finish by calling `wait()` on the returned
+        PendingCommand, which raises MovementInterruptedError if the movement
+        fails. If there is nothing to do, None is returned instead.
+        """
+        self.log.debug("Told to start moving %s metres", amount)
+        commands = self.motion_commands(Motion("move", amount))
+        if not commands:
+            return None
+        return self.start_commands(commands, error=MovementInterruptedError)
+
+    def start_turn(self, amount):
+        # type: (float) -> PendingCommand
+        """
+        Start turning `amount` degrees right (clockwise) and return immediately.
+
+        Like `turn`, this will turn whichever way is shortest. See `start_move`
+        for how to wait for the turn to finish.
+        """
+        self.log.debug("Told to start turning %s degrees", amount)
+        commands = self.motion_commands(Motion("turn", amount))
+        if not commands:
+            return None
+        return self.start_commands(commands, error=MovementInterruptedError)
+
+    def motion_commands(self, motion):
+        # type: (Motion) -> List[Tuple[str, int]]
+        """
+        Return the list of (command, data) pairs needed to carry out a motion primitive.
+
+        The list is empty if the motion would do nothing.
+        """
+        if motion.kind == "move":
+            if motion.amount > 0:
+                return self.forwards_commands(motion.amount)
+            elif motion.amount == 0:
+                self.log.debug("Told to move by nothing. No command will be sent.")
+                return []
+            else:
+                return [("b", self.distance_data(abs(motion.amount)))]
+        elif motion.kind == "low_power_move":
+            assert self.framed or 0 <= motion.amount <= MAX_LOW_POWER_MOVE
+            return [("A", self.distance_data(motion.amount))]
+        elif motion.kind == "turn":
+            amount = motion.amount % 360
+            if amount > 180:
+                return [("l", self.angle_data(360 - amount))]
+            elif amount == 0:
+                self.log.debug("Told to turn by nothing. No command will be sent.")
+                return []
+            else:
+                return [("r", self.angle_data(amount))]
+        elif motion.kind == "drive":
+            vec = motion.amount
+            if self.protocol_version < ARC_PROTOCOL_VERSION:
+                self.log.debug("mbed can't drive arcs, turning then moving instead")
+                return self.motion_commands(Motion("turn", vec.angle)) + self.motion_commands(Motion("move", vec.distance))
+            angle = (vec.angle + 180) % 360 - 180
+            arc_angle = copysign(min(abs(angle), self.max_arc_angle), angle)
+            if vec.distance == 0:
+                arc_angle = 0
+            # Turn on the spot first if the arc would be too sharp.
+            commands = self.motion_commands(Motion("turn", angle - arc_angle))
+            if vec.distance != 0:
+                commands.append(("a", (self.distance_data(vec.distance), self.angle_data(arc_angle))))
+            return commands
+        else:
+            raise ValueError("Unknown kind of motion: {}".format(motion.kind))
+
+    def drive_to(self, vec):
+        # type: (Vector) -> None
+        """
+        Drive to the point `vec` away along a smooth arc, instead of turning then moving.
+
+        The arc starts in the direction the robot is facing, so the robot
+        ends up facing `2 * vec.angle` degrees to the right of where it
+        started. If `vec.angle` is more than `max_arc_angle`, the robot turns
+        on the spot by the difference first. If the mbed doesn't support
+        arcs, the robot turns to face the point and moves straight there.
+
+        Raises:
+            MovementInterruptedError: The turn or the arc failed.
+        """
+        self.log.debug("Told to drive to %s", vec)
+        self.run_plan([Motion("drive", vec)], window=1)
+
+    def run_plan(self, plan, window=2):
+        # type: (List[Motion], int) -> None
+        """
+        Carry out a plan of motion primitives, streaming them ahead to the mbed.
+
+        Up to `window` commands are sent to the mbed before the first of
+        them is acknowledged; the mbed buffers them and starts each one as
+        soon as the previous one finishes, so the robot doesn't stall
+        between primitives. A window of 1 sends each command only after the
+        previous one is acknowledged.
+
+        If a command fails, no more commands are sent, and the commands
+        that were already streamed (at most `window - 1`) are allowed to
+        finish so that the link stays in sync. PlanInterruptedError is then
+        raised, pointing at the step of the plan that failed.
+
+        If the connection to the mbed dies, we reconnect, resume the
+        command that was running and carry on with the plan.
+        """
+        assert window > 0
+        commands = [(step, command, data)
+                    for step, motion in enumerate(plan)
+                    for command, data in self.motion_commands(motion)]
+        self.log.debug("Running a plan of %s motions (%s commands), window %s", len(plan), len(commands), window)
+        commands.reverse()
+        in_flight = collections.deque()
+        failure = None
+        while in_flight or (commands and failure is None):
+            while commands and failure is None and len(in_flight) < window:
+                step, command, data = commands.pop()
+                pending = self.start_command(command, data)
+                if pending is None:
+                    failure = PlanInterruptedError(step, self.seq - 1)
+                else:
+                    pending.step = step
+                    in_flight.append(pending)
+            if not in_flight:
+                break
+            pending = in_flight.popleft()
+            try:
+                if not self.wait_for_response(max(0, pending.deadline() - time.time())):
+                    self.command_timed_out(pending)
+                    raise PlanInterruptedError(pending.step, pending.seq, timed_out=True)
+                pending.response = self.read_response(pending, flush=False)
+            except ConnectionLostError:
+                # Everything in flight was lost with the connection; finish
+                # the interrupted command, then send the rest again.
+                self.log.exception("Lost connection to the mbed during step %s of the plan (command %s)", pending.step, pending.seq)
+                try:
+                    self.reconnect()
+                except ConnectionLostError:
+                    raise PlanInterruptedError(pending.step, pending.seq, timed_out=True)
+                for lost in reversed(in_flight):
+                    commands.append((lost.step, lost.command, lost.data))
+                commands.extend((pending.step, command, data) for command, data in reversed(self.resume_commands(pending)))
+                in_flight.clear()
+                continue
+            except FramingError:
+                # We can't tell which commands succeeded, so give up on the rest.
+                self.log.exception("Corrupted response to step %s of the plan (command %s)", pending.step, pending.seq)
+                raise PlanInterruptedError(pending.step, pending.seq)
+            if pending.response == "e" and failure is None:
+                self.log.error("Step %s of the plan (%s, command %s) failed", pending.step, plan[pending.step], pending.seq)
+                failure = PlanInterruptedError(pending.step, pending.seq)
+        if failure is not None:
+            raise failure
+
+    def start_retry(self):
+        # type: () -> PendingCommand
+        """
+        Start retrying the previous command on the mbed and return immediately.
+        """
+        self.log.debug("Starting to continue")
+        return self.start_command("c", error=MovementInterruptedError)
+
+    def start_commands(self, commands, error=None):
+        # type: (List[Tuple[str, int]], type) -> PendingCommand
+        """
+        Start a sequence of commands, each sent once the previous one succeeds.
+
+        The returned PendingCommand only finishes once every command has.
+        """
+        (command, data), rest = commands[0], commands[1:]
+        pending = self.start_command(command, data, error=error)
+        if pending is not None and rest:
+            pending.follow_up = lambda: self.start_commands(rest, error=error)
+        return pending
 
     def send_command(self, command, data=None):
         # type: (str, int) -> None
         """
-        Send a command (character) to the mbed with 1 byte of data.
+        Send a command (character) to the mbed with optional data, and wait for it to finish.
 
         Raises:
             CommandFailureError: The mbed responded with an error.
         """
-        self.log.debug("Starting mbed command %s(%s)", command, data if data is not None else "")
+        pending = self.start_command(command, data)
+        if pending is not None:
+            pending.wait()
+
+    def start_command(self, command, data=None, error=None):
+        # type: (str, int, type) -> PendingCommand
+        """
+        Send a command (character) to the mbed with optional data, and return immediately.
+
+        The data is one byte in the original protocol, or a 16-bit signed
+        integer in the framed protocol.
+
+        If the command fails, waiting on the returned PendingCommand raises
+        `error` (by default, CommandFailureError). Returns None if the
+        command could not be sent.
+        """
+        seq = self.seq
+        self.seq += 1
+        self.metrics.increment("commands." + command)
+        if command == "c":
+            self.metrics.increment("retries")
+        self.log.debug("Starting mbed command #%s %s(%s)", seq, command, data if data is not None else "")
         send_time = time.time()
         try:
-            self.conn.write(command)
-            if data is not None:
-                self.conn.write(chr(data))
+            try:
+                self.write_command(seq, command, data)
+            except ConnectionLostError:
+                self.log.exception("Lost connection to the mbed sending command #%s", seq)
+                self.reconnect()
+                send_time = time.time()
+                self.write_command(seq, command, data)
         except serial.SerialTimeoutException:
             self.log.exception("Timeout sending mbed command %s(%s)!", command, data if data is not None else "")
-            return
-        while not self.conn.inWaiting():
-            pass
-        response = self.conn.read(1)
-        rtt = round(time.time() - send_time, 2)
-        self.log.debug("mbed sent response %s after %s seconds", response, rtt)
-        self.conn.flushInput()
+            self.metrics.increment("timeouts")
+            return None
+        except ConnectionLostError:
+            self.log.exception("Couldn't send mbed command %s(%s)!", command, data if data is not None else "")
+            return None
+        amount = self.command_amount(command, data)
+        if amount is not None:
+            self.last_motion = (command, amount)
+            allowed = self.speed_model.allowed_duration(command, amount)
+        elif command == "c" and self.last_motion is not None:
+            allowed = self.speed_model.allowed_duration(*self.last_motion)
+        else:
+            allowed = NON_MOTION_TIMEOUT
+        pending = PendingCommand(self, seq, command, data, send_time, error=error, amount=amount, allowed=allowed)
+        if pending.is_motion:
+            self.motions_in_flight += 1
+        return pending
+
+    @property
+    def moving(self):
+        # type: () -> bool
+        """Whether the mbed is (as far as we know) carrying out a motion command."""
+        return self.motions_in_flight > 0
+
+    def motion_finished(self, pending, response=None):
+        # type: (PendingCommand, str) -> None
+        """
+        Record that the mbed has finished (or given up on) a command.
+
+        `response` is the mbed's response, or None if there wasn't one.
+        Like `read_response`, anything but "e" counts as success: old
+        firmware doesn't always acknowledge with "k".
+        """
+        if pending.is_motion:
+            self.motions_in_flight = max(0, self.motions_in_flight - 1)
+            self.last_motion_end = time.time()
+            succeeded = response is not None and response != "e"
+            self.notify_motion(self.command_motion(pending.command, pending.data) if succeeded else None)
+
+    def command_motion(self, command, data):
+        # type: (str, int) -> Motion
+        """Return the Motion carried out by a successful command, or None if we don't know."""
+        if command == "c":
+            # We don't know how much of the previous motion had been done before it was retried.
+            return None
+        elif command == "a":
+            distance, angle = data
+            return Motion("drive", Arc(distance * FRAMED_UNITS["f"], angle * FRAMED_UNITS["r"]))
+        else:
+            amount = self.command_amount(command, data)
+        if command in "fFA":
+            return Motion("move", amount)
+        elif command == "b":
+            return Motion("move", -amount)
+        elif command == "r":
+            return Motion("turn", amount)
+        elif command == "l":
+            return Motion("turn", -amount)
+        return None
+
+    def notify_motion(self, motion):
+        # type: (Motion) -> None
+        for listener in self.motion_listeners:
+            try:
+                listener(motion)
+            except Exception:
+                self.log.exception("Motion listener %s failed", listener)
+
+    def write_command(self, seq, command, data=None):
+        # type: (int, str, int) -> None
+        """Write a command to the serial port, in whichever protocol we're using."""
+        if self.framed:
+            if data is None:
+                payload = ""
+            elif isinstance(data, tuple):
+                payload = struct.pack(">" + "h" * len(data), *data)
+            else:
+                payload = struct.pack(">h", data)
+            self.write_port(encode_frame(seq, command, payload))
+        else:
+            self.write_port(command)
+            if data is not None:
+                self.write_port(chr(data))
+
+    def command_timed_out(self, pending):
+        # type: (PendingCommand) -> None
+        """Record that the mbed didn't respond to a command in time."""
+        self.log.error("mbed didn't respond to command #%s %s(%s) within %s seconds",
+                       pending.seq, pending.command, pending.data if pending.data is not None else "", pending.allowed)
+        self.metrics.increment("timeouts")
+        self.metrics.increment("timeouts." + pending.command)
+        if not self.framed:
+            # The mbed may still respond, ahead of its response to the next command.
+            self.late_responses += 1
+        self.motion_finished(pending)
+
+    def read_response(self, pending, flush=True):
+        # type: (PendingCommand, bool) -> str
+        """
+        Read the mbed's response to a pending command.
+
+        This should only be called once `wait_for_response` says there is
+        something to read. Unless `flush` is False, anything else the mbed
+        has sent is discarded; don't flush if other commands are in flight.
+
+        In the original protocol, responses can't be told apart, but the mbed
+        responds to commands in order; so after a command times out, the
+        next response is taken to be the late response to it, and skipped.
+
+        Raises:
+            FramingError: The response was corrupted, or was for a different
+                command (framed protocol), or only late responses to earlier
+                commands arrived before the deadline (original protocol).
+            ConnectionLostError: The connection to the mbed died.
+        """
+        try:
+            if self.framed:
+                seq, response, _ = self.read_frame()
+                while 0 < (pending.seq - seq) % 256 < 128:
+                    # A late response to an earlier command whose response was lost; skip it.
+                    self.log.warn("Skipping stale response %s to command #%s (expected #%s)", response, seq, pending.seq % 256)
+                    if not self.wait_for_response(max(0, pending.deadline() - time.time())):
+                        raise FramingError("Only a stale response arrived before the deadline")
+                    seq, response, _ = self.read_frame()
+                if seq != pending.seq % 256:
+                    raise FramingError("Expected a response to command #{}, got one to #{}".format(pending.seq % 256, seq))
+            else:
+                response = self.read_port(1)
+                while self.late_responses > 0:
+                    self.late_responses -= 1
+                    self.log.warn("Skipping late response %s to a command that timed out (expected #%s)", response, pending.seq)
+                    if not self.wait_for_response(max(0, pending.deadline() - time.time())):
+                        raise FramingError("Only a late response arrived before the deadline")
+                    response = self.read_port(1)
+        except FramingError:
+            self.metrics.increment("framing_errors")
+            self.motion_finished(pending)
+            self.flush_input()
+            raise
+        now = time.time()
+        rtt = now - pending.send_time
+        self.metrics.record("rtt." + pending.command, rtt)
+        if response != "e" and pending.amount is not None:
+            self.speed_model.record(pending.command, pending.amount, now - max(pending.send_time, self.last_response_time))
+        self.last_response_time = now
+        self.motion_finished(pending, response)
+        rtt = round(rtt, 2)
+        self.log.debug("mbed sent response %s to command #%s after %s seconds", response, pending.seq, rtt)
+        if flush:
+            self.flush_input()
+        data = pending.data if pending.data is not None else ""
         if response == "e":
             self.log.warn("Command failed!")
-            raise CommandFailureError(response)
+            self.metrics.increment("failures")
+            self.metrics.increment("failures." + pending.command)
         else:
-            self.log.debug("Completed command %s(%s) -> %s after %s seconds", command, data if data is not None else "", response, rtt)
+            self.log.debug("Completed command #%s %s(%s) -> %s after %s seconds", pending.seq, pending.command, data, response, rtt)
+        return response
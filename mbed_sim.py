@@ -0,0 +1,582 @@
+"""A simulated mbed, for exercising mbed_link without a robot.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+
+The simulator listens on a pseudo-terminal and speaks both the original
+and the framed protocol (see mbed_link.py). Point an Mbed at it with:
+
+    sim = MbedSimulator(log)
+    sim.start()
+    wheels = Mbed(log, port=sim.port)
+
+To simulate the mbed's USB link resetting, give the simulator a directory
+to put ttyACM-style links in, and call `unplug`:
+
+    sim = MbedSimulator(log, link_dir=tempfile.mkdtemp())
+    sim.start()
+    wheels = Mbed(log, port=sim.port, port_patterns=[sim.port_pattern])
+    sim.unplug()
+
+Run this file directly to start a simulator and measure round-trip times,
+or with --check to check that mbed_link copes with awkward responses.
+"""
+
+
+from __future__ import division
+
+import argparse
+import logging
+import os
+import pty
+import random
+import select
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import tty
+
+from math import pi
+
+from mbed_link import (FRAMED_UNITS, FRAME_START, ORIGINAL_UNITS, PROTOCOL_VERSION, STOP_PROTOCOL_VERSION, TELEMETRY_PROTOCOL_VERSION,
+                       TICKS_PER_METRE, Mbed, Motion, MovementInterruptedError, MovementTimeoutError, PlanInterruptedError,
+                       encode_frame, frame_checksum, low_power_moves)
+from path_planner import PathPlanner
+from speed_model import SpeedModel
+from trig import arc_length
+
+
+# Commands that take a byte of data in the original protocol.
+DATA_COMMANDS = "fFblrA"
+# Default speeds of each motion command, in metres or degrees per second.
+DEFAULT_SPEEDS = {"f": 0.5, "F": 0.5, "b": 0.5, "A": 0.25, "l": 180, "r": 180, "a": 0.4}
+# The distance between the wheels, in metres, for working out encoder ticks when turning.
+TRACK_WIDTH = 0.4
+
+
+class MbedSimulator(object):
+    """
+    An mbed that runs on a pseudo-terminal instead of a robot.
+
+    Motion commands take `command_overhead` seconds plus the time to move
+    at the speed given for that command in `speeds`. Every response is
+    delayed by a further `latency` seconds. Each motion command fails with
+    probability `failure_rate`, and each response byte is lost with
+    probability `drop_rate`. Motion commands in `failing_commands` always
+    fail. Successful motions are acknowledged with `ack` (some old firmware
+    doesn't send "k").
+
+    If `framed` is False, the simulator only speaks the original protocol,
+    like old firmware. Otherwise, it speaks version `protocol_version` of
+    the framed protocol.
+
+    While `stalled` is True, the wheels don't turn: motions take as long
+    as usual, but the telemetry shows no movement (and the current is
+    high), until the robot is told to stop.
+
+    If `link_dir` is given, `port` is a link in that directory named like a
+    real mbed's port (ttyACM0), and `unplug` simulates a USB reset.
+    """
+
+    def __init__(self, log, speeds=None, command_overhead=0.05, latency=0.0,
+                 drop_rate=0.0, failure_rate=0.0, switch_state=0, framed=True, seed=None,
+                 protocol_version=PROTOCOL_VERSION, link_dir=None, ack="k"):
+        self.log = log
+        self.speeds = dict(DEFAULT_SPEEDS)
+        if speeds is not None:
+            self.speeds.update(speeds)
+        self.command_overhead = command_overhead
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.failure_rate = failure_rate
+        self.ack = ack
+        self.failing_commands = ""
+        self.switch_state = switch_state
+        self.framed = framed
+        self.protocol_version = protocol_version
+        self.random = random.Random(seed)
+        # How many of each command we have received.
+        self.command_counts = {}
+        # The last motion command, as (command, amount), for "c" to retry.
+        self.last_motion = None
+        self.stalled = False
+        # How many of the frames received before a stop command haven't been
+        # handled yet; motion commands among them fail straight away.
+        self._cancelled = 0
+        # How often to send telemetry while moving, in Hz (0 for never).
+        self.telemetry_rate = 0
+        # The sequence number of the frame being handled.
+        self._seq = 0
+        self.link_dir = link_dir
+        # How many times the simulator has been plugged in.
+        self.enumerations = 0
+        self.master = None
+        self.slave = None
+        self.port = None
+        self._buffer = ""
+        self._running = False
+        self._thread = None
+        # Set while plugged in. Commands being handled when the simulator
+        # is unplugged notice that `_connection` has changed, and give up.
+        self._plugged = threading.Event()
+        self._connection = 0
+        self._handling = 0
+
+    @property
+    def port_pattern(self):
+        # type: () -> str
+        """A glob pattern matching every port the simulator might appear on."""
+        return os.path.join(self.link_dir, "ttyACM*")
+
+    def start(self):
+        # type: () -> str
+        """Start the simulator in a background thread and return its port."""
+        self._plug_in()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="mbed simulator")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        # type: () -> None
+        """Stop the simulator."""
+        self._running = False
+        self._plugged.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._unplug()
+
+    def unplug(self, downtime=0.2):
+        # type: (float) -> str
+        """
+        Simulate the mbed's USB link resetting, and return the port it comes back on.
+
+        The port disappears for `downtime` seconds, and anything in progress
+        (including motions) is abandoned. Like a real mbed, it usually comes
+        back on a different port. The firmware restarts, so it forgets the
+        last motion and stops sending telemetry.
+        """
+        self.log.info("Unplugging simulated mbed from %s", self.port)
+        self._plugged.clear()
+        self._connection += 1
+        self._unplug()
+        time.sleep(downtime)
+        self.last_motion = None
+        self.telemetry_rate = 0
+        self._buffer = ""
+        self._plug_in()
+        return self.port
+
+    def _plug_in(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        if self.link_dir is not None:
+            link = os.path.join(self.link_dir, "ttyACM{}".format(self.enumerations % 2))
+            os.symlink(self.port, link)
+            self.port = link
+        self.enumerations += 1
+        self._plugged.set()
+        self.log.info("Simulated mbed listening on %s", self.port)
+
+    def _unplug(self):
+        if self.link_dir is not None and os.path.islink(self.port):
+            os.remove(self.port)
+        for fd in self.master, self.slave:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def motion_time(self, command, amount):
+        # type: (str, float) -> float
+        """Return how long the given motion takes, in seconds."""
+        speed = self.speeds[command]
+        return self.command_overhead + (abs(amount) / speed if speed else 0)
+
+    def _run(self):
+        while self._running:
+            self._plugged.wait()
+            self._handling = self._connection
+            try:
+                if self.framed and self._peek() == FRAME_START:
+                    self._handle_frame()
+                else:
+                    self._handle_original()
+            except _Stopped:
+                return
+            except (_Unplugged, EnvironmentError, select.error):
+                if self._handling == self._connection and self._running:
+                    raise
+                self.log.debug("Simulated mbed was unplugged mid-command")
+
+    def _peek(self):
+        # type: () -> str
+        """Return the next byte from the host, leaving it to be read."""
+        # The buffer may hold more than one byte once a stop command has been
+        # looked for (see `_stop_requested`), so only look at the first.
+        if not self._buffer:
+            self._buffer = self._read(1)
+        return self._buffer[0]
+
+    def _read(self, size):
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        while len(data) < size:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if not self._running:
+                raise _Stopped()
+            self._check_plugged()
+            if readable:
+                data += os.read(self.master, size - len(data))
+        return data
+
+    def _check_plugged(self):
+        if self._handling != self._connection:
+            raise _Unplugged()
+
+    def _sleep(self, duration):
+        # Like time.sleep, but stop if we're unplugged.
+        end = time.time() + duration
+        while True:
+            self._check_plugged()
+            remaining = end - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.01))
+
+    def _write(self, data):
+        if self.latency:
+            self._sleep(self.latency)
+        self._check_plugged()
+        for byte in data:
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                self.log.debug("Dropping response byte %r", byte)
+                continue
+            os.write(self.master, byte)
+
+    def _handle_original(self):
+        command = self._read(1)
+        self.command_counts[command] = self.command_counts.get(command, 0) + 1
+        if command in DATA_COMMANDS:
+            data = ord(self._read(1))
+            self._write(self._move(command, data * ORIGINAL_UNITS[command]))
+        elif command == "c":
+            self._write(self._retry())
+        elif command == "s":
+            self._write(chr(self.switch_state))
+        else:
+            # Like the real firmware, ignore anything we don't understand.
+            self.log.debug("Ignoring unknown command %r", command)
+
+    def _handle_frame(self):
+        self._read(1)
+        header = self._read(3)
+        seq, kind, length = ord(header[0]), header[1], ord(header[2])
+        payload = self._read(length)
+        checksum = ord(self._read(1))
+        self.command_counts[kind] = self.command_counts.get(kind, 0) + 1
+        self._seq = seq
+        cancelled = self._cancelled > 0
+        if cancelled:
+            self._cancelled -= 1
+        if checksum != frame_checksum(header + payload):
+            self.log.warn("Bad checksum in frame %r", header + payload)
+            self._write(encode_frame(seq, "e"))
+        elif kind == "H":
+            self._write(encode_frame(seq, "k", chr(self.protocol_version)))
+        elif kind == "x" and self.protocol_version >= STOP_PROTOCOL_VERSION:
+            # Nothing is moving, so there's nothing to stop.
+            self.log.debug("Told to stop while idle")
+        elif cancelled and (kind in FRAMED_UNITS or kind in "ac"):
+            self.log.debug("Cancelling queued command %r", kind)
+            self._write(encode_frame(seq, "e"))
+        elif kind in FRAMED_UNITS:
+            data, = struct.unpack(">h", payload)
+            self._write(encode_frame(seq, self._move(kind, data * FRAMED_UNITS[kind])))
+        elif kind == "a" and self.protocol_version >= 2:
+            distance, angle = struct.unpack(">hh", payload)
+            self._write(encode_frame(seq, self._move(kind, arc_length(distance * FRAMED_UNITS["f"], angle * FRAMED_UNITS["r"]))))
+        elif kind == "t" and self.protocol_version >= TELEMETRY_PROTOCOL_VERSION:
+            self.telemetry_rate, = struct.unpack(">h", payload)
+            self._write(encode_frame(seq, "k"))
+        elif kind == "c":
+            self._write(encode_frame(seq, self._retry()))
+        elif kind == "s":
+            self._write(encode_frame(seq, "k", chr(self.switch_state)))
+        else:
+            self.log.debug("Unknown frame kind %r", kind)
+            self._write(encode_frame(seq, "e"))
+
+    def _move(self, command, amount):
+        # type: (str, float) -> str
+        """Carry out a motion command and return the response."""
+        self.last_motion = (command, amount)
+        duration = self.motion_time(command, amount)
+        self.log.debug("Simulating %s(%s) for %s seconds", command, amount, duration)
+        if self.framed and self.telemetry_rate > 0:
+            stopped = self._move_with_telemetry(command, amount, duration)
+        else:
+            stopped = self._motion_sleep(duration)
+        if stopped:
+            self.log.debug("Stopped %s(%s) part way through", command, amount)
+            return "e"
+        if command in self.failing_commands or (self.failure_rate and self.random.random() < self.failure_rate):
+            self.log.debug("Injecting failure of %s(%s)", command, amount)
+            return "e"
+        return self.ack
+
+    def _motion_sleep(self, duration):
+        # type: (float) -> bool
+        """Sleep for `duration` seconds, or until told to stop; return whether we were told to stop."""
+        end = time.time() + duration
+        while True:
+            if self._stop_requested():
+                return True
+            remaining = end - time.time()
+            if remaining <= 0:
+                return False
+            self._sleep(min(remaining, 0.01))
+
+    def _stop_requested(self):
+        # type: () -> bool
+        """
+        Check whether a stop command has arrived (while a motion is running).
+
+        Like the real firmware, this reads ahead: the stop command is taken
+        out of the buffer, and the frames queued before it are cancelled.
+        """
+        if not self.framed or self.protocol_version < STOP_PROTOCOL_VERSION:
+            return False
+        self._check_plugged()
+        while select.select([self.master], [], [], 0)[0]:
+            self._buffer += os.read(self.master, 1024)
+        offset = 0
+        frames = 0
+        while len(self._buffer) >= offset + 5 and self._buffer[offset] == FRAME_START:
+            end = offset + 5 + ord(self._buffer[offset + 3])
+            if len(self._buffer) < end:
+                break
+            if self._buffer[offset + 2] == "x":
+                self._buffer = self._buffer[:offset] + self._buffer[end:]
+                self._cancelled = frames
+                return True
+            offset = end
+            frames += 1
+        return False
+
+    def _move_with_telemetry(self, command, amount, duration):
+        # type: (str, float, float) -> bool
+        """
+        Sleep for `duration` seconds, sending telemetry frames for the given motion.
+
+        Returns whether we were told to stop part way through.
+        """
+        if command in "lr":
+            # Each wheel travels along a circle whose diameter is the track width.
+            distance = abs(amount) * pi * TRACK_WIDTH / 360
+            left, right = (distance, -distance) if command == "r" else (-distance, distance)
+        else:
+            distance = -amount if command == "b" else amount
+            left, right = distance, distance
+        start = time.time()
+        end = start + duration
+        interval = 1 / self.telemetry_rate
+        ticks_left, ticks_right = 0, 0
+        while True:
+            now = time.time()
+            if not self.stalled:
+                progress = min(1, (now - start) / duration) if duration else 1
+                ticks_left = int(left * progress * TICKS_PER_METRE)
+                ticks_right = int(right * progress * TICKS_PER_METRE)
+            current = 3000 if self.stalled else 1000
+            self._check_plugged()
+            os.write(self.master, encode_frame(self._seq, "T", struct.pack(">hhH", ticks_left, ticks_right, current)))
+            if now >= end:
+                return False
+            if self._motion_sleep(min(interval, end - now)):
+                return True
+
+    def _retry(self):
+        # type: () -> str
+        if self.last_motion is None:
+            return "e"
+        return self._move(*self.last_motion)
+
+
+class _Stopped(Exception):
+    """The simulator has been told to stop."""
+
+
+class _Unplugged(Exception):
+    """The simulator was unplugged while handling a command."""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--original", action="store_true", help="only speak the original protocol")
+    parser.add_argument("--latency", type=float, default=0.0, help="extra delay before each response (seconds)")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="probability of dropping each response byte")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability of each motion failing")
+    parser.add_argument("--commands", type=int, default=200, help="number of commands to time")
+    parser.add_argument("--serve", action="store_true", help="just run the simulator until interrupted")
+    parser.add_argument("--unplug", type=int, default=0, metavar="N",
+                        help="instead, unplug the mbed in the middle of N moves and time how long reconnecting takes")
+    parser.add_argument("--check", action="store_true", help="instead, check how mbed_link copes with awkward responses")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(module)s:%(lineno)d - %(levelname)s: %(message)s")
+    log = logging.getLogger(__name__)
+    if args.check:
+        check_link(log)
+        return
+    if args.unplug:
+        reconnect_benchmark(log, args.unplug, framed=not args.original)
+        return
+    sim = MbedSimulator(log, latency=args.latency, drop_rate=args.drop_rate, failure_rate=args.failure_rate,
+                        framed=not args.original)
+    if args.serve:
+        sim.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            sim.stop()
+        return
+    # Time round trips alone, not motions.
+    sim.speeds = dict.fromkeys(sim.speeds, 0)
+    sim.command_overhead = 0
+    sim.start()
+    link_log = logging.getLogger("mbed_link")
+    link_log.setLevel(logging.WARNING)
+    wheels = Mbed(link_log, timeout=1, port=sim.port)
+    failures = 0
+    start = time.time()
+    for i in xrange(args.commands):
+        try:
+            wheels.turn(1 if i % 2 else -1)
+        except Exception:
+            failures += 1
+    elapsed = time.time() - start
+    log.info("%s commands in %.3f seconds: %.2f ms per round trip, %s failures",
+             args.commands, elapsed, elapsed / args.commands * 1000, failures)
+    log.info("Link metrics: %s", wheels.metrics.summary())
+    sim.stop()
+
+
+def reconnect_benchmark(log, moves, framed=True):
+    """Unplug the simulator in the middle of each of `moves` moves, and check that each move still finishes."""
+    link_dir = tempfile.mkdtemp()
+    sim = MbedSimulator(log, framed=framed, link_dir=link_dir)
+    sim.start()
+    link_log = logging.getLogger("mbed_link")
+    link_log.setLevel(logging.CRITICAL)
+    wheels = Mbed(link_log, port=sim.port, port_patterns=[sim.port_pattern])
+    wheels.start_telemetry()
+    failures = 0
+    for i in xrange(moves):
+        unplugger = threading.Timer(sim.motion_time("f", 1) / 2, sim.unplug)
+        unplugger.start()
+        start = time.time()
+        try:
+            wheels.move(1)
+        except Exception:
+            log.exception("Move %s failed", i)
+            failures += 1
+        unplugger.join()
+        log.info("Move %s took %.3f seconds, now on %s", i, time.time() - start, wheels.port)
+    histogram = wheels.metrics.histogram("reconnect")
+    if histogram is not None:
+        log.info("%s reconnects: mean %.1f ms, max %.1f ms", histogram.count, histogram.mean * 1000, histogram.max * 1000)
+    log.info("%s of %s moves failed; the simulator saw %s", failures, moves, sim.command_counts)
+    sim.stop()
+    shutil.rmtree(link_dir)
+
+
+def check_other_ack(log):
+    """Check that a motion acknowledged with something other than "k" still reaches the motion listeners."""
+    sim = MbedSimulator(log, framed=False, command_overhead=0.01, ack="K")
+    sim.start()
+    wheels = Mbed(logging.getLogger("mbed_link"), port=sim.port)
+    motions = []
+    wheels.motion_listeners.append(motions.append)
+    wheels.turn(10)
+    sim.stop()
+    assert motions == [Motion("turn", 10)], "expected one 10 degree turn, got {}".format(motions)
+
+
+def check_long_low_power_move(log):
+    """Check that a low power move too long for one command of the original protocol is split up."""
+    sim = MbedSimulator(log, framed=False, command_overhead=0.01)
+    sim.speeds = dict.fromkeys(sim.speeds, 0)
+    sim.start()
+    wheels = Mbed(logging.getLogger("mbed_link"), port=sim.port)
+    motions = []
+    wheels.motion_listeners.append(motions.append)
+    # Like driving home from the far side of the zone's cubes.
+    wheels.run_plan([Motion("turn", 45)] + low_power_moves(4.2))
+    sim.stop()
+    moved = sum(motion.amount for motion in motions if motion.kind == "move")
+    assert sim.command_counts.get("A") == 2, "expected two low power moves, the mbed saw {}".format(sim.command_counts)
+    assert abs(moved - 4.2) < 0.02, "expected to move 4.2 metres, moved {}".format(moved)
+
+
+def check_late_response(log):
+    """Check that a response arriving after its command timed out isn't taken as the next command's."""
+    sim = MbedSimulator(log, framed=False, command_overhead=0.01, latency=0.8)
+    sim.start()
+    wheels = Mbed(logging.getLogger("mbed_link"), port=sim.port)
+    # Give up on a 10 degree turn after 0.6 seconds.
+    wheels.speed_model = SpeedModel(factor=1, margin=0)
+    try:
+        wheels.turn(10)
+    except MovementTimeoutError:
+        pass
+    else:
+        raise AssertionError("expected the first turn to time out")
+    # The first turn's "k" arrives while this one is running, but this one fails.
+    sim.latency = 0
+    sim.failure_rate = 1
+    try:
+        wheels.turn(10)
+    except MovementInterruptedError:
+        pass
+    else:
+        raise AssertionError("the second turn failed, but the first turn's late response was taken as its")
+    sim.failure_rate = 0
+    wheels.turn(10)
+    sim.stop()
+
+
+def check_failed_turn_in_path(log):
+    """Check that when a turn in a planned path fails, the next leg isn't driven (see `Robot.drive_to_point`)."""
+    sim = MbedSimulator(log, command_overhead=0.01)
+    sim.speeds = dict.fromkeys(sim.speeds, 0)
+    sim.failing_commands = "lr"
+    sim.start()
+    wheels = Mbed(logging.getLogger("mbed_link"), port=sim.port)
+    # Round a cube: north, then east.
+    motions = PathPlanner.motions(0, [(1, 1), (1, 3), (3, 3)])
+    try:
+        wheels.run_plan(motions, window=1)
+    except PlanInterruptedError as e:
+        assert motions[e.step].kind == "turn", "expected the turn to fail, not {}".format(motions[e.step])
+    else:
+        raise AssertionError("expected the turn to fail")
+    sim.stop()
+    assert sim.command_counts.get("f") == 1, "the mbed was told to move {} times, not once".format(sim.command_counts.get("f"))
+
+
+def check_link(log):
+    """Run every check, raising AssertionError if one fails."""
+    link_log = logging.getLogger("mbed_link")
+    link_log.setLevel(logging.CRITICAL)
+    for check in [check_other_ack, check_long_low_power_move, check_late_response, check_failed_turn_in_path]:
+        check(log)
+        log.info("%s: ok", check.__name__)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Lightweight counters and latency histograms.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+"""
+
+
+from __future__ import division
+
+import json
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List
+except ImportError:
+    pass
+
+
+# Upper bounds of histogram buckets, in seconds. Anything slower than the
+# last bound goes in an overflow bucket.
+DEFAULT_BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20]
+
+
+class Histogram(object):
+    """A histogram of durations with fixed buckets."""
+
+    def __init__(self, bounds=None):
+        # type: (List[float]) -> None
+        self.bounds = list(bounds if bounds is not None else DEFAULT_BOUNDS)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        # type: (float) -> None
+        """Add a duration to the histogram."""
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self):
+        # type: () -> float
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        # type: (float) -> float
+        """
+        Return an upper bound on the `p`th percentile (0-100), from the buckets.
+
+        Returns None if nothing has been recorded.
+        """
+        if not self.count:
+            return None
+        target = self.count * p / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        # type: () -> dict
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.mean,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "buckets": [[bound, count] for bound, count in zip(self.bounds + ["inf"], self.counts)],
+        }
+
+
+class Metrics(object):
+    """
+    A set of named counters and latency histograms.
+
+    Counters are created the first time they are incremented, and
+    histograms the first time something is recorded in them.
+    """
+
+    def __init__(self, bounds=None):
+        # type: (List[float]) -> None
+        self.bounds = bounds
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1):
+        # type: (str, int) -> None
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, name, value):
+        # type: (str, float) -> None
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(self.bounds)
+        self.histograms[name].record(value)
+
+    def count(self, name):
+        # type: (str) -> int
+        return self.counters.get(name, 0)
+
+    def histogram(self, name):
+        # type: (str) -> Histogram
+        """Return the named histogram, or None if nothing has been recorded in it."""
+        return self.histograms.get(name)
+
+    def snapshot(self):
+        # type: () -> dict
+        """Return everything recorded so far, as a JSON-serialisable dict."""
+        return {
+            "counters": dict(self.counters),
+            "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+        }
+
+    def dump(self, path):
+        # type: (str) -> None
+        """Write everything recorded so far to `path`, as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+    def summary(self):
+        # type: () -> str
+        """Return a one-line summary, suitable for logging."""
+        parts = ["{}={}".format(name, count) for name, count in sorted(self.counters.items())]
+        for name, histogram in sorted(self.histograms.items()):
+            parts.append("{}: n={} mean={:.1f}ms max={:.1f}ms".format(name, histogram.count, histogram.mean * 1000, histogram.max * 1000))
+        return ", ".join(parts)
@@ -0,0 +1,175 @@
+"""A peephole optimiser for motion commands.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+"""
+
+
+from __future__ import division
+
+import functools
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List, Tuple
+except ImportError:
+    pass
+
+from mbed_link import Motion, PlanInterruptedError
+from vector import Vector
+
+
+def normalise_angle(angle):
+    # type: (float) -> float
+    """Return `angle` as an equivalent angle in the range (-180, 180]."""
+    angle %= 360
+    if angle > 180:
+        angle -= 360
+    return angle
+
+
+def optimise_plan(plan, min_turn=0.5):
+    # type: (List[Motion], float) -> List[Tuple[int, Motion]]
+    """
+    Merge consecutive turns and drop motions that do nothing.
+
+    Turns just before a drive (see `Mbed.drive_to`) are merged into the
+    drive. Turns smaller than `min_turn` degrees (after merging) are dropped.
+    Returns a list of (index, motion) pairs, where `index` is the index in
+    `plan` of the last motion that contributed to `motion`.
+    """
+    optimised = []
+    for i, motion in enumerate(plan):
+        if motion.kind == "turn":
+            if optimised and optimised[-1][1].kind == "turn":
+                _, previous = optimised.pop()
+                motion = Motion("turn", previous.amount + motion.amount)
+            optimised.append((i, Motion("turn", normalise_angle(motion.amount))))
+        elif motion.kind == "drive":
+            if optimised and optimised[-1][1].kind == "turn":
+                _, previous = optimised.pop()
+                # Turning then driving at an angle is the same as driving at the sum of the angles.
+                motion = Motion("drive", Vector(distance=motion.amount.distance, angle=motion.amount.angle + previous.amount))
+            optimised.append((i, motion))
+        elif motion.amount != 0:
+            if optimised and optimised[-1][1].kind == "turn" and abs(optimised[-1][1].amount) < min_turn:
+                optimised.pop()
+            optimised.append((i, motion))
+    if optimised and optimised[-1][1].kind == "turn" and abs(optimised[-1][1].amount) < min_turn:
+        optimised.pop()
+    return optimised
+
+
+class MotionOptimiser(object):
+    """
+    Sits in front of an Mbed and avoids sending motions that aren't needed.
+
+    Turns are not sent straight away. Instead, they are merged with any
+    other turns that come before the next move, so that (for example)
+    turning 180 degrees twice does nothing, and turning back after a cone
+    search is combined with the next turn. Pending turns are sent (flushed)
+    when the robot moves, or when something calls `flush` because it needs
+    to know which way the robot is facing -- most importantly, before
+    looking for markers. Moves of zero metres are dropped.
+
+    Other Mbed methods are passed through, flushing before they're called.
+    The Mbed's other attributes (such as `moving`) are read without flushing.
+    """
+
+    def __init__(self, log, mbed, min_turn=0.5):
+        self.log = log
+        self.mbed = mbed
+        # Merged turns smaller than this many degrees are not sent at all.
+        self.min_turn = min_turn
+        # The pending turn, in degrees clockwise.
+        self.pending_turn = 0
+        # How many turns have been merged into the pending turn.
+        self.pending_count = 0
+
+    def __getattr__(self, name):
+        # Only called for attributes we don't have, i.e. the Mbed's.
+        if name == "mbed":
+            raise AttributeError(name)
+        attribute = getattr(self.mbed, name)
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def flushed(*args, **kwargs):
+            self.flush()
+            return attribute(*args, **kwargs)
+        return flushed
+
+    def turn(self, amount):
+        # type: (float) -> None
+        """Turn `amount` degrees right (clockwise), once something needs us to."""
+        self.pending_turn = normalise_angle(self.pending_turn + amount)
+        self.pending_count += 1
+        self.log.debug("Deferring turn of %s degrees (%s degrees pending)", amount, self.pending_turn)
+
+    def move(self, amount, ignore_crash=False):
+        # type: (float, bool) -> None
+        """Turn by any pending amount, then move `amount` metres (see `Mbed.move`)."""
+        if amount == 0:
+            self.log.debug("Dropping move of 0 metres")
+            self.mbed.metrics.increment("optimiser.moves_dropped")
+            return
+        try:
+            # Don't stream the move behind the turn: if the turn fails, we
+            # mustn't drive off in the wrong direction.
+            self.run_plan([Motion("move", amount)], window=1)
+        except PlanInterruptedError as e:
+            if not ignore_crash or e.step != 0:
+                raise
+
+    def drive_to(self, vec):
+        # type: (Vector) -> None
+        """Drive along an arc to the point `vec` away, after any pending turn (see `Mbed.drive_to`)."""
+        self.run_plan([Motion("drive", vec)], window=1)
+
+    def run_plan(self, plan, window=2):
+        # type: (List[Motion], int) -> None
+        """
+        Optimise a plan of motions (after any pending turn) and run it.
+
+        If a motion fails, PlanInterruptedError is raised with `step` set to
+        the index of the failed motion in `plan`, or -1 if the pending turn
+        failed.
+        """
+        merged_turns = self.pending_count
+        if merged_turns:
+            plan = [Motion("turn", self.pending_turn)] + list(plan)
+            offset = 1
+        else:
+            offset = 0
+        self.clear_pending()
+        optimised = optimise_plan(plan, self.min_turn)
+        saved = len(plan) - len(optimised) + max(0, merged_turns - 1)
+        if saved:
+            self.log.debug("Optimised plan of %s motions down to %s", len(plan), len(optimised))
+            self.mbed.metrics.increment("optimiser.motions_saved", saved)
+        try:
+            self.mbed.run_plan([motion for _, motion in optimised], window=window)
+        except PlanInterruptedError as e:
+            raise PlanInterruptedError(optimised[e.step][0] - offset, e.seq, e.timed_out)
+
+    def flush(self):
+        # type: () -> None
+        """Send any pending turn to the mbed."""
+        if not self.pending_count:
+            return
+        amount, count = self.pending_turn, self.pending_count
+        self.clear_pending()
+        if abs(amount) < self.min_turn:
+            self.log.debug("Pending turn of %s degrees (from %s turns) is too small to send", amount, count)
+            self.mbed.metrics.increment("optimiser.motions_saved", count)
+            return
+        if count > 1:
+            self.log.debug("Sending %s merged turns as one turn of %s degrees", count, amount)
+            self.mbed.metrics.increment("optimiser.motions_saved", count - 1)
+        self.mbed.turn(amount)
+
+    def clear_pending(self):
+        # type: () -> None
+        self.pending_turn = 0
+        self.pending_count = 0
@@ -0,0 +1,250 @@
+"""Planning the shortest way across the arena, round any cubes in the way.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+
+Run this file directly to time planning across an arena full of cubes.
+"""
+
+
+from __future__ import division
+
+import argparse
+import heapq
+import logging
+from math import ceil, hypot, sqrt
+import random
+import time
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+except ImportError:
+    pass
+
+import arena
+import corrections
+from mbed_link import Motion
+from motion_optimiser import normalise_angle
+
+
+# The eight neighbours of a grid cell, and how far away each is (in cells).
+NEIGHBOURS = [(dx, dy, hypot(dx, dy)) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+
+
+class PathPlanner(object):
+    """
+    Finds the shortest path between two points in the arena, using A* on a grid.
+
+    The arena is divided into square cells `resolution` metres across. A cell
+    is blocked if the robot (a circle of radius `robot_radius` around its
+    centre of rotation) would hit a wall or an obstacle if it was there.
+    Obstacles are cubes (or anything else) we know about, added and removed
+    with `add_obstacle` and `remove_obstacle`; the blocked cells are only
+    worked out again when they change, so planning again after each
+    sighting is cheap.
+
+    Paths are straightened out (see `smooth`), then turned into turns and
+    moves (see `motions`).
+    """
+
+    def __init__(self, log, resolution=0.1, robot_radius=0.3, obstacle_radius=corrections.cube_width / sqrt(2)):
+        self.log = log
+        self.resolution = resolution
+        self.robot_radius = robot_radius
+        self.obstacle_radius = obstacle_radius
+        self.size = int(ceil(arena.ARENA_SIZE / resolution))
+        # Obstacles, as {key: (x, y)}.
+        self.obstacles = {}  # type: Dict[Hashable, Tuple[float, float]]
+        self._blocked = None  # type: Set[Tuple[int, int]]
+
+    def add_obstacle(self, key, x, y):
+        # type: (Hashable, float, float) -> None
+        """Add (or move) an obstacle centred at (x, y)."""
+        if self.obstacles.get(key) != (x, y):
+            self.obstacles[key] = (x, y)
+            self._blocked = None
+
+    def remove_obstacle(self, key):
+        # type: (Hashable) -> None
+        if self.obstacles.pop(key, None) is not None:
+            self._blocked = None
+
+    def cell(self, x, y):
+        # type: (float, float) -> Tuple[int, int]
+        """Return the grid cell that (x, y) is in."""
+        return (min(max(int(x / self.resolution), 0), self.size - 1),
+                min(max(int(y / self.resolution), 0), self.size - 1))
+
+    def centre(self, cell):
+        # type: (Tuple[int, int]) -> Tuple[float, float]
+        return ((cell[0] + 0.5) * self.resolution, (cell[1] + 0.5) * self.resolution)
+
+    def blocked(self, ignore=()):
+        # type: (Tuple[Hashable, ...]) -> Set[Tuple[int, int]]
+        """Return the cells the robot can't be in, except because of obstacles in `ignore`."""
+        if ignore:
+            return self._block(key for key in self.obstacles if key not in ignore)
+        if self._blocked is None:
+            self._blocked = self._block(self.obstacles)
+        return self._blocked
+
+    def _block(self, keys):
+        # type: (Iterable[Hashable]) -> Set[Tuple[int, int]]
+        blocked = set()
+        # Walls.
+        margin = int(ceil(self.robot_radius / self.resolution))
+        for i in xrange(self.size):
+            for j in xrange(margin):
+                blocked.update([(i, j), (j, i), (i, self.size - 1 - j), (self.size - 1 - j, i)])
+        # Obstacles.
+        reach = self.robot_radius + self.obstacle_radius
+        cells = int(ceil(reach / self.resolution))
+        for key in keys:
+            x, y = self.obstacles[key]
+            centre_i, centre_j = self.cell(x, y)
+            for i in xrange(centre_i - cells, centre_i + cells + 1):
+                for j in xrange(centre_j - cells, centre_j + cells + 1):
+                    cell_x, cell_y = self.centre((i, j))
+                    if 0 <= i < self.size and 0 <= j < self.size and hypot(cell_x - x, cell_y - y) < reach:
+                        blocked.add((i, j))
+        return blocked
+
+    def plan(self, start, goal, ignore=()):
+        # type: (Tuple[float, float], Tuple[float, float], Tuple[Hashable, ...]) -> Optional[List[Tuple[float, float]]]
+        """
+        Return the shortest path from `start` to `goal`, as a list of points (including both), or None if there isn't one.
+
+        Obstacles in `ignore` don't count (e.g. the cube we're going to
+        collect, at `goal`). If we're already too close to a wall or an
+        obstacle to be anywhere else, we're still allowed to leave.
+        """
+        blocked = self.blocked(ignore)
+        start_cell = self.cell(*start)
+        goal_cell = self.cell(*goal)
+        if goal_cell in blocked:
+            self.log.debug("Can't get to %s: it's too close to a wall or an obstacle", goal)
+            return None
+        # A*, with the straight-line distance as the heuristic.
+        queue = [(0, 0, start_cell)]
+        came_from = {start_cell: None}
+        cost = {start_cell: 0}
+        while queue:
+            _, so_far, current = heapq.heappop(queue)
+            if current == goal_cell:
+                break
+            if so_far > cost[current]:
+                continue
+            for dx, dy, step in NEIGHBOURS:
+                neighbour = (current[0] + dx, current[1] + dy)
+                if not (0 <= neighbour[0] < self.size and 0 <= neighbour[1] < self.size):
+                    continue
+                # Once out of the blocked cells, stay out.
+                if neighbour in blocked and current not in blocked:
+                    continue
+                new_cost = so_far + step
+                if new_cost < cost.get(neighbour, float("inf")):
+                    cost[neighbour] = new_cost
+                    came_from[neighbour] = current
+                    estimate = new_cost + hypot(goal_cell[0] - neighbour[0], goal_cell[1] - neighbour[1])
+                    heapq.heappush(queue, (estimate, new_cost, neighbour))
+        else:
+            self.log.debug("No way from %s to %s", start, goal)
+            return None
+        cells = []
+        current = goal_cell
+        while current is not None:
+            cells.append(current)
+            current = came_from[current]
+        cells.reverse()
+        return self.smooth([start] + [self.centre(cell) for cell in cells[1:-1]] + [goal], blocked)
+
+    def clear(self, a, b, blocked):
+        # type: (Tuple[float, float], Tuple[float, float], Set[Tuple[int, int]]) -> bool
+        """Return whether the straight line from a to b misses every blocked cell (apart from the one a is in)."""
+        steps = int(ceil(hypot(b[0] - a[0], b[1] - a[1]) / (self.resolution / 2)))
+        start_cell = self.cell(*a)
+        for step in xrange(1, steps + 1):
+            cell = self.cell(a[0] + (b[0] - a[0]) * step / steps, a[1] + (b[1] - a[1]) * step / steps)
+            if cell in blocked and cell != start_cell:
+                return False
+        return True
+
+    def smooth(self, points, blocked):
+        # type: (List[Tuple[float, float]], Set[Tuple[int, int]]) -> List[Tuple[float, float]]
+        """Straighten a path, by skipping every point that can be driven past in a straight line."""
+        smoothed = [points[0]]
+        index = 0
+        while index < len(points) - 1:
+            # Go as far along the path as we can in a straight line.
+            furthest = index + 1
+            for later in xrange(len(points) - 1, index + 1, -1):
+                if self.clear(points[index], points[later], blocked):
+                    furthest = later
+                    break
+            smoothed.append(points[furthest])
+            index = furthest
+        return smoothed
+
+    @staticmethod
+    def motions(heading, path):
+        # type: (float, List[Tuple[float, float]]) -> List[Motion]
+        """Return the turns and moves that follow `path`, starting at its first point facing `heading`."""
+        motions = []
+        for (x, y), (to_x, to_y) in zip(path, path[1:]):
+            dist = hypot(to_x - x, to_y - y)
+            if dist < 1e-3:
+                continue
+            new_heading = arena.heading_to(x, y, to_x, to_y)
+            angle = normalise_angle(new_heading - heading)
+            if abs(angle) > 0.5:
+                motions.append(Motion("turn", angle))
+            motions.append(Motion("move", dist))
+            heading = new_heading
+        return motions
+
+
+def benchmark(log, cubes=12, trials=50, seed=0):
+    # type: (..., int, int, int) -> None
+    """Time planning between random points, with `cubes` random cubes in the way, and replanning after one moves."""
+    rng = random.Random(seed)
+    planner = PathPlanner(log)
+    for key in xrange(cubes):
+        planner.add_obstacle(key, rng.uniform(1, 7), rng.uniform(1, 7))
+    planner.blocked()
+    times = []
+    replan_times = []
+    failures = 0
+    for _ in xrange(trials):
+        start = (rng.uniform(0.5, 7.5), rng.uniform(0.5, 7.5))
+        goal = (rng.uniform(0.5, 7.5), rng.uniform(0.5, 7.5))
+        begin = time.time()
+        path = planner.plan(start, goal)
+        times.append(time.time() - begin)
+        if path is None:
+            failures += 1
+        # Someone knocks a cube somewhere else; plan again.
+        planner.add_obstacle(rng.randrange(cubes), rng.uniform(1, 7), rng.uniform(1, 7))
+        begin = time.time()
+        planner.plan(start, goal)
+        replan_times.append(time.time() - begin)
+    times.sort()
+    replan_times.sort()
+    log.info("Planning: median %.1f ms, worst %.1f ms (%s of %s had no path)",
+             times[len(times) // 2] * 1000, times[-1] * 1000, failures, trials)
+    log.info("Replanning after a cube moved: median %.1f ms, worst %.1f ms",
+             replan_times[len(replan_times) // 2] * 1000, replan_times[-1] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cubes", type=int, default=12, help="number of cubes in the way")
+    parser.add_argument("--trials", type=int, default=50, help="number of paths to plan")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(module)s:%(lineno)d - %(levelname)s: %(message)s")
+    benchmark(logging.getLogger(__name__), args.cubes, args.trials)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Keeping track of where the robot is between sightings of the arena markers.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+"""
+
+
+from __future__ import division
+
+from math import hypot, pi
+import threading
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List
+except ImportError:
+    pass
+
+import arena
+from localisation import Pose, PoseEstimate, invert
+from motion_optimiser import normalise_angle
+from trig import sind, cosd
+from vector import Vector
+
+
+# Degrees to radians, for the derivative of a move with respect to heading.
+RADIANS = pi / 180
+
+
+def multiply(a, b):
+    # type: (List[List[float]], List[List[float]]) -> List[List[float]]
+    """Return the product of two 3x3 matrices."""
+    return [[sum(a[i][k] * b[k][j] for k in xrange(3)) for j in xrange(3)] for i in xrange(3)]
+
+
+def transpose(a):
+    # type: (List[List[float]]) -> List[List[float]]
+    return [list(row) for row in zip(*a)]
+
+
+def add(a, b):
+    # type: (List[List[float]], List[List[float]]) -> List[List[float]]
+    return [[a[i][j] + b[i][j] for j in xrange(3)] for i in xrange(3)]
+
+
+def diagonal(x, y, heading):
+    # type: (float, float, float) -> List[List[float]]
+    return [[x, 0, 0], [0, y, 0], [0, 0, heading]]
+
+
+class PoseTracker(object):
+    """
+    Keeps an estimate of the robot's pose, using an extended Kalman filter.
+
+    Each motion the robot carries out moves the estimate (dead reckoning),
+    and makes it less certain: a move of d metres is off by about
+    `move_noise` times d along the way it went, and a turn of a degrees by
+    about `turn_noise` times a (plus a degree). Moving also makes the
+    heading drift, by `drift` degrees per metre. Motions of unknown size (see
+    `Mbed.motion_listeners`) make the position and heading very uncertain,
+    but leave the estimate where it was.
+
+    Each pose worked out from the arena markers (see `Localiser`) pulls the
+    estimate towards it, by as much as their uncertainties say. Fixes that
+    are too far away to believe (see `max_distance`) are ignored, unless
+    `max_rejections` of them in a row agree that the estimate is wrong.
+
+    `motion` can be used as a motion listener for `Mbed` and `DCMotors`;
+    `pose` and `covariance` are always up to date.
+    """
+
+    def __init__(self, log, pose=None, covariance=None, move_noise=0.05, turn_noise=0.05, drift=2.0,
+                 max_distance=4.0, max_rejections=3):
+        # type: (..., Pose, List[List[float]], float, float, float, float, int) -> None
+        self.log = log
+        self.move_noise = move_noise
+        self.turn_noise = turn_noise
+        self.drift = drift
+        # How far a fix can be from the estimate (in standard deviations,
+        # by Mahalanobis distance) before it's ignored.
+        self.max_distance = max_distance
+        self.max_rejections = max_rejections
+        self.rejections = 0
+        self.lock = threading.Lock()
+        self.pose = pose if pose is not None else Pose(arena.ARENA_SIZE / 2, arena.ARENA_SIZE / 2, 0)
+        # The covariance of (x, y, heading), in square metres and square degrees.
+        self.covariance = covariance if covariance is not None else diagonal(arena.ARENA_SIZE ** 2, arena.ARENA_SIZE ** 2, 180 ** 2)
+
+    def reset(self, pose, covariance):
+        # type: (Pose, List[List[float]]) -> None
+        with self.lock:
+            self.pose = pose
+            self.covariance = covariance
+            self.rejections = 0
+
+    def motion(self, motion):
+        # type: (Motion) -> None
+        """
+        Update the estimate for a motion of the robot.
+
+        Can be used as a motion listener (see `Mbed.motion_listeners`);
+        None means the robot moved by an unknown amount.
+        """
+        if motion is None:
+            self.log.debug("Robot moved by an unknown amount; we could be anywhere near %s", self.pose)
+            with self.lock:
+                self.covariance = add(self.covariance, diagonal(0.5 ** 2, 0.5 ** 2, 45 ** 2))
+        elif motion.kind == "turn":
+            self.turn(motion.amount)
+        elif motion.kind in ("move", "low_power_move"):
+            self.move(motion.amount)
+        elif motion.kind == "drive":
+            # Like `MarkerFilter.motion`: turn half way, move straight, turn the rest.
+            self.turn(motion.amount.angle)
+            self.move(motion.amount.distance)
+            self.turn(motion.amount.angle)
+
+    def turn(self, angle):
+        # type: (float) -> None
+        """Update the estimate for turning `angle` degrees clockwise."""
+        with self.lock:
+            self.pose = self.pose._replace(heading=normalise_angle(self.pose.heading + angle))
+            self.covariance = add(self.covariance, diagonal(0, 0, (self.turn_noise * angle) ** 2 + 1))
+
+    def move(self, distance):
+        # type: (float) -> None
+        """Update the estimate for moving `distance` metres forwards."""
+        with self.lock:
+            x, y, heading = self.pose
+            self.pose = Pose(x + distance * sind(heading), y + distance * cosd(heading), heading)
+            jacobian = [[1, 0, distance * cosd(heading) * RADIANS],
+                        [0, 1, -distance * sind(heading) * RADIANS],
+                        [0, 0, 1]]
+            # The noise is along and across the way we moved, rotated into the arena's axes.
+            along = (self.move_noise * distance) ** 2
+            across = (self.move_noise * distance / 2) ** 2
+            s, c = sind(heading), cosd(heading)
+            noise = [[along * s * s + across * c * c, (along - across) * s * c, 0],
+                     [(along - across) * s * c, along * c * c + across * s * s, 0],
+                     [0, 0, (self.drift * distance) ** 2]]
+            self.covariance = add(multiply(multiply(jacobian, self.covariance), transpose(jacobian)), noise)
+
+    def correct(self, estimate):
+        # type: (PoseEstimate) -> bool
+        """Pull the estimate towards a pose worked out from the markers, and return whether it was believed."""
+        with self.lock:
+            innovation = [estimate.pose.x - self.pose.x, estimate.pose.y - self.pose.y,
+                          normalise_angle(estimate.pose.heading - self.pose.heading)]
+            total = invert(add(self.covariance, estimate.covariance))
+            if total is None:
+                return False
+            distance = sum(innovation[i] * total[i][j] * innovation[j] for i in xrange(3) for j in xrange(3)) ** 0.5
+            if distance > self.max_distance:
+                self.rejections += 1
+                if self.rejections < self.max_rejections:
+                    self.log.debug("Ignoring a fix %.1f standard deviations away (%s, we think we're at %s)", distance, estimate.pose, self.pose)
+                    return False
+                self.log.warn("The last %s fixes disagree with where we think we are; believing them", self.rejections)
+                self.pose = estimate.pose
+                self.covariance = estimate.covariance
+                self.rejections = 0
+                return True
+            self.rejections = 0
+            gain = multiply(self.covariance, total)
+            step = [sum(gain[i][j] * innovation[j] for j in xrange(3)) for i in xrange(3)]
+            self.pose = Pose(self.pose.x + step[0], self.pose.y + step[1], normalise_angle(self.pose.heading + step[2]))
+            identity = diagonal(1, 1, 1)
+            self.covariance = multiply([[identity[i][j] - gain[i][j] for j in xrange(3)] for i in xrange(3)], self.covariance)
+            return True
+
+    def confident(self, max_position_sd=0.5, max_heading_sd=10):
+        # type: (float, float) -> bool
+        """Return whether we know where we are to within `max_position_sd` metres and `max_heading_sd` degrees."""
+        covariance = self.covariance
+        return max(covariance[0][0], covariance[1][1]) <= max_position_sd ** 2 and covariance[2][2] <= max_heading_sd ** 2
+
+    def vector_to(self, x, y):
+        # type: (float, float) -> Vector
+        """Return the Vector from the robot to the point (x, y), relative to the way it's facing."""
+        pose = self.pose
+        return Vector(distance=hypot(x - pose.x, y - pose.y),
+                      angle=normalise_angle(arena.heading_to(pose.x, pose.y, x, y) - pose.heading))
@@ -0,0 +1,120 @@
+"""Choosing the camera resolution from how far away we expect markers to be.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+"""
+
+
+from __future__ import division
+
+import json
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List, Tuple
+except ImportError:
+    pass
+
+from metrics import Metrics
+
+
+# Resolutions we use, smallest (fastest to process) first.
+RESOLUTIONS = [(640, 480), (800, 600), (1296, 976), (1920, 1440)]
+# The resolution `Robot.see` uses by default.
+DEFAULT_RESOLUTION = (800, 600)
+# The furthest away (in metres) that markers are reliably seen at each
+# resolution. Markers appear smaller the further away they are, so this is
+# roughly proportional to the width of the picture.
+DEFAULT_RANGES = {(640, 480): 2.0, (800, 600): 2.5, (1296, 976): 4.0, (1920, 1440): 6.0}
+# Detection statistics are kept for distances in bands this wide, in metres.
+DISTANCE_BAND = 0.5
+
+
+def resolution_name(res):
+    # type: (Tuple[int, int]) -> str
+    return "{}x{}".format(*res)
+
+
+class ResolutionPolicy(object):
+    """
+    Picks the smallest resolution that reliably sees markers at a given distance.
+
+    Smaller pictures are quicker to take and to find markers in, so we only
+    use big ones when the markers we want are far away. If a picture misses
+    the markers we want, `fallback` gives the next resolution up to try.
+
+    How often each resolution sees what we were looking for, and how long
+    it takes, is recorded in `metrics`, by distance, so that `ranges` can be
+    tuned after a run.
+    """
+
+    def __init__(self, log, ranges=None):
+        self.log = log
+        self.ranges = dict(DEFAULT_RANGES)
+        if ranges is not None:
+            self.ranges.update(ranges)
+        # Counters "<resolution>.<band>.attempts" and "<resolution>.<band>.hits"
+        # for each distance band, and a histogram "<resolution>.latency".
+        self.metrics = Metrics()
+
+    def resolutions(self):
+        # type: () -> List[Tuple[int, int]]
+        return sorted(self.ranges, key=lambda res: res[0] * res[1])
+
+    def choose(self, dist=None, dist_tolerance=0.0):
+        # type: (float, float) -> Tuple[int, int]
+        """
+        Return the resolution to look for markers `dist` metres away (give or take `dist_tolerance`).
+
+        If `dist` is None, the default resolution is used.
+        """
+        if dist is None:
+            return DEFAULT_RESOLUTION
+        for res in self.resolutions():
+            if self.ranges[res] >= dist + dist_tolerance:
+                return res
+        return self.resolutions()[-1]
+
+    def fallback(self, res):
+        # type: (Tuple[int, int]) -> Tuple[int, int]
+        """Return the resolution to try after missing at `res`, or None if there are no bigger ones."""
+        bigger = [other for other in self.resolutions() if other[0] * other[1] > res[0] * res[1]]
+        return bigger[0] if bigger else None
+
+    def record(self, res, dist, hit, latency):
+        # type: (Tuple[int, int], float, bool, float) -> None
+        """Record whether a picture at `res` saw what we were looking for `dist` metres away, and how long it took."""
+        name = resolution_name(res)
+        band = "any" if dist is None else "{:.1f}".format(int(dist / DISTANCE_BAND) * DISTANCE_BAND)
+        self.metrics.increment("{}.{}.attempts".format(name, band))
+        if hit:
+            self.metrics.increment("{}.{}.hits".format(name, band))
+        self.metrics.record("{}.latency".format(name), latency)
+
+    def detection_rate(self, res, dist):
+        # type: (Tuple[int, int], float) -> float
+        """Return the fraction of pictures at `res` that saw what we wanted `dist` metres away, or None if we don't know."""
+        name = resolution_name(res)
+        band = "{:.1f}".format(int(dist / DISTANCE_BAND) * DISTANCE_BAND)
+        attempts = self.metrics.count("{}.{}.attempts".format(name, band))
+        if not attempts:
+            return None
+        return self.metrics.count("{}.{}.hits".format(name, band)) / attempts
+
+    def dump(self, path):
+        # type: (str) -> None
+        """Save the ranges and statistics to `path`, as JSON."""
+        with open(path, "w") as f:
+            json.dump({
+                "ranges": {resolution_name(res): dist for res, dist in self.ranges.items()},
+                "stats": self.metrics.snapshot(),
+            }, f, indent=2, sort_keys=True)
+
+    def load(self, path):
+        # type: (str) -> None
+        """Load ranges saved by `dump` (possibly after tuning them by hand)."""
+        with open(path) as f:
+            ranges = json.load(f)["ranges"]
+        for name, dist in ranges.items():
+            width, height = name.split("x")
+            self.ranges[(int(width), int(height))] = dist
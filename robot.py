@@ -10,8 +10,9 @@ from __future__ import division
 from sr.robot import *
 
 import time
-from math import sqrt
+from math import hypot, sqrt
 import logging
+import os
 from operator import attrgetter
 
 try:
@@ -20,11 +21,22 @@ try:
 except ImportError:
     pass
 
-from mbed_link import Mbed, MovementInterruptedError
+import arena
+from localisation import Localiser, Pose, PoseEstimate
+from marker_filter import MarkerEstimate, MarkerFilter
+from mbed_link import Mbed, Motion, MovementInterruptedError, low_power_moves
+from motion_optimiser import MotionOptimiser, normalise_angle
+from path_planner import PathPlanner
+from pose_tracker import PoseTracker, diagonal
+from resolution import ResolutionPolicy
+from settle import SettleDetector
+from stall_detector import StallDetector
+from sweep import SweepResult, Sweeper, cone_headings, plan_sweep
 import strategies
 import corrections
 from trig import sind, cosd, asind
 from vector import Vector, marker2vector
+from vision import MarkerFrame, Snapshot, VisionProcess, VisionWorker, as_frame
 
 
 class CompanionCube(Robot):
@@ -40,11 +52,45 @@ class CompanionCube(Robot):
         args = []
         kwargs = {"opposite_direction": False, "ignore_C": False}
         self.routeChange = False
+        # Find markers in a separate process, leaving this one free for the strategy.
+        multiprocess_vision = False
 
         self.log.info("Start TobyDragon init")
         super(CompanionCube, self).__init__(init=False)
         self.init()
-        self.wheels = Mbed(self.log)
+        # Takes pictures in the background; see `see`.
+        vision_class = VisionProcess if multiprocess_vision else VisionWorker
+        self.vision = vision_class(self.log, super(CompanionCube, self).see)
+        if multiprocess_vision:
+            # Fork the vision process before starting any threads (like the
+            # mbed's telemetry reader), which wouldn't survive the fork.
+            self.vision.start()
+        # Use self.wheels to move; it only talks to self.mbed when it needs to.
+        self.mbed = Mbed(self.log)
+        self.wheels = MotionOptimiser(self.log, self.mbed)
+        self.load_speed_model()
+        self.mbed.start_telemetry()
+        self.last_snapshot = None
+        self.resolutions = ResolutionPolicy(self.log)
+        # Every marker we see is added to this, and it follows the robot's motions.
+        self.marker_filter = MarkerFilter(self.log)
+        self.mbed.motion_listeners.append(self.marker_filter.motion)
+        self.load_resolution_ranges()
+        # Works out where we are from the arena markers; see `localise`.
+        self.localiser = Localiser(self.log)
+        # Keeps track of where we are in between (see `PoseTracker.pose`).
+        # We start roughly where we're meant to (give or take how carefully
+        # we were put down).
+        self.tracker = PoseTracker(self.log, Pose(*arena.start_pose(self.zone)), diagonal(0.3 ** 2, 0.3 ** 2, 20 ** 2))
+        self.mbed.motion_listeners.append(self.tracker.motion)
+        # Plans paths round the cubes we've seen; see `drive_to_point`.
+        self.planner = PathPlanner(self.log)
+        # Stops the robot if it gets stuck part way through a motion.
+        self.stall_detector = StallDetector(self.log, self.mbed, self.vision, current=lambda: self.power.battery.current)
+        # Tells us when the robot has stopped moving; see `settle`.
+        self.settler = SettleDetector(self.log, self.mbed, self.vision)
+        # Looks for markers in several directions; see `sweep`.
+        self.sweeper = Sweeper(self.log, self.wheels, self.vision, self.marker_filter, settle=self.settle, see=self.see)
         self.log.info("Robot initialised")
         self.log.info("Battery(voltage = %s, current = %s)", self.power.battery.voltage, self.power.battery.current)
         switch_state = self.wheels.get_switch_state()
@@ -52,22 +98,89 @@ class CompanionCube(Robot):
         self.log.info("Waiting for start signal...")
         self.wait_start()
         self.log.info("Start signal recieved!")
-        strategies.strategies[self.strategy](self, *args, **kwargs)
+        self.vision.start()
+        self.stall_detector.start()
+        try:
+            strategies.strategies[self.strategy](self, *args, **kwargs)
+            self.wheels.flush()
+        finally:
+            self.stall_detector.stop()
+            self.vision.stop()
+            self.dump_metrics()
         self.log.info("Strategy exited.")
         #self.was_a_triumph()
 
+    def see(self, *args, **kwargs):
+        """
+        Return the visible markers, after finishing any pending turn.
+
+        If the vision worker is running, this returns the markers from the
+        first picture taken after the robot stopped moving, rather than
+        taking a new one. Otherwise (or if any arguments are given), a
+        picture is taken now.
+        """
+        self.wheels.flush()
+        if args or kwargs or not self.vision.running:
+            start = time.time()
+            markers = self.vision.capture(*args, **kwargs)
+            self.marker_filter.add(markers, start)
+            return markers
+        return self.fresh_snapshot().markers
+
+    def fresh_snapshot(self, max_age=None, timeout=5):
+        # type: (float, float) -> Snapshot
+        """
+        Return the latest snapshot of markers taken since the robot stopped moving.
+
+        If `max_age` is given, the picture must also have been started less
+        than `max_age` seconds ago. The same snapshot is never returned
+        twice, so looking again means looking at a new picture. Waits for a
+        picture if need be, for at most `timeout` seconds, then takes one
+        itself.
+        """
+        self.wheels.flush()
+        since = self.mbed.last_motion_end
+        if self.mbed.moving:
+            self.log.warn("Looking for markers while moving; waiting for a new picture")
+            since = time.time()
+        if max_age is not None:
+            since = max(since, time.time() - max_age)
+        after = self.last_snapshot.number if self.last_snapshot is not None else None
+        snapshot = self.vision.snapshot(since, after, timeout)
+        if snapshot is None:
+            # The worker has stopped (or is stuck), so take the picture ourselves.
+            if self.vision.running:
+                self.log.warn("No picture from the vision worker within %s seconds; taking one now", timeout)
+            start = time.time()
+            snapshot = Snapshot(after, start, time.time(), self.vision.capture())
+        self.last_snapshot = snapshot
+        self.marker_filter.add(snapshot.markers, snapshot.start_time)
+        self.log.debug("Using snapshot %s, taken %.3f seconds ago", snapshot.number, time.time() - snapshot.start_time)
+        return snapshot
+
+    def settle(self, max_wait):
+        # type: (float) -> bool
+        """
+        Wait until the robot has stopped moving, for at most `max_wait` seconds.
+
+        Use this instead of sleeping after a motion. Returns whether the
+        robot settled in time (see `SettleDetector`).
+        """
+        self.wheels.flush()
+        return self.settler.wait(max_wait)
+
     def are_we_moving(self, initial_markers, final_markers):
-        # type: (List[Marker], List[Marker]) -> bool
+        # type: (MarkerFrame, MarkerFrame) -> bool
         """
         Checks if two sets of markers are different enough to make it seem like we're moving.
         """
         self.log.debug("Checking if we've moved.")
         similar_markers = 0
+        initial_markers = as_frame(initial_markers)
+        final_markers = as_frame(final_markers)
         self.log.debug("initial_markers: %s", map(attrgetter("info.code"), initial_markers))
         self.log.debug("final_markers: %s", map(attrgetter("info.code"), final_markers))
-        initial_marker_codes = set(map(attrgetter("info.code"), initial_markers))
-        final_marker_codes = set(map(attrgetter("info.code"), final_markers))
-        if not initial_marker_codes.intersection(final_marker_codes):
+        if not initial_markers.codes().intersection(final_markers.codes()):
             self.log.debug("All the markers are different, we've probably moved.")
             return True
         if (initial_markers and not final_markers) or (final_markers and not initial_markers):
@@ -75,10 +188,8 @@ class CompanionCube(Robot):
             self.log.debug("We can see markers before/after and can't see markers after/before, we've probably (emphasis on probably) moved.")
             return True
         for initial_marker in initial_markers:
-            for final_marker in final_markers:
-                if initial_marker.info.code != final_marker.info.code:
-                    # Markers aren't the same, no point comparing them.
-                    continue
+            final_marker = final_markers.code(initial_marker.info.code)
+            if final_marker is not None:
                 # Markers are similar if the difference in distance is less than 0.1 metres and the difference in angle is less than 15 degrees.
                 are_markers_similar = abs(initial_marker.dist - final_marker.dist) < 0.1 and abs(initial_marker.rot_y - final_marker.rot_y) < 15
                 self.log.debug("Markers %s and %s are similar: %s", initial_marker.info.code, final_marker.info.code, are_markers_similar)
@@ -86,20 +197,49 @@ class CompanionCube(Robot):
         self.log.debug("We have moved!" if not similar_markers else "We have not moved!")
         return not similar_markers
 
+    def cube_vector(self, marker):
+        # type: (Marker) -> Vector
+        """
+        Return the Vector from the robot to the centre of a cube, given one of its markers or a MarkerEstimate.
+        """
+        if isinstance(marker, MarkerEstimate):
+            return corrections.correct_all_cube(marker.vector, marker.orientation_rot_y)
+        return corrections.correct_all_cube(marker2vector(marker), marker.orientation.rot_y)
+
     def face_cube(self, marker):
         # type: (Marker) -> float
         """
-        Given a cube marker, face the centre of the cube.
+        Given a cube marker (or a MarkerEstimate of one), face the centre of the cube.
         Returns the distance required to travel on top of that cube
         """
         self.log.info("Facing marker...")
-        vec = marker2vector(marker)
-        vec = corrections.correct_all_cube(vec, marker.orientation.rot_y)
+        vec = self.cube_vector(marker)
         self.log.debug("Turning %s degrees", vec.angle)
         self.wheels.turn(vec.angle)
         return vec.distance + corrections.cube_width
 
-    def move_to_cube(self, marker, crash_continue=False, check_at=1.0, max_safe_distance=3, angle_tolerance=1.0, distance_after=0.0):
+    def confident_estimate(self, code, max_pictures=4):
+        # type: (int, int) -> MarkerEstimate
+        """
+        Look at a marker until the filtered estimate of where it is is good enough to act on.
+
+        Sightings from before the robot's last motions count too (see
+        `MarkerFilter`), so often one picture is enough. Gives up after
+        `max_pictures` pictures, returning the best estimate so far, or None
+        if the marker can't be seen at all.
+        """
+        estimate = None
+        for _ in xrange(max_pictures):
+            self.see_markers(lambda m: m.info.code == code, attempts=1)
+            estimate = self.marker_filter.estimate(code)
+            if self.marker_filter.confident(estimate):
+                break
+        if estimate is not None:
+            self.log.debug("Marker %s is %s metres away at %s degrees (standard deviation %.2f degrees, from %s sightings)",
+                           code, estimate.dist, estimate.rot_y, sqrt(estimate.rot_y_variance), estimate.count)
+        return estimate
+
+    def move_to_cube(self, marker, crash_continue=False, check_at=1.0, max_safe_distance=3, angle_tolerance=1.0, distance_after=0.0, arc=False):
         # type: (Marker, float, float, float) -> None
         """
         Given a cube marker, face and move to the cube.
@@ -108,30 +248,45 @@ class CompanionCube(Robot):
         facing the right way, unless we started less than max_safe_distance away
         from the cube. "The right way" is defined as within angle_tolerance of
         the angle we should be facing.
+
+        If arc is True and the cube is less than max_safe_distance away, drive
+        to it along a smooth arc instead, without stopping to face it first.
         """
         marker_code = marker.info.code
+        if arc:
+            vec = self.cube_vector(marker)
+            distance = vec.distance + corrections.cube_width
+            if distance <= max_safe_distance:
+                self.log.debug("Driving along an arc to cube (%s metres, %s degrees)", distance, vec.angle)
+                try:
+                    self.wheels.drive_to(Vector(distance=distance + distance_after, angle=vec.angle))
+                except MovementInterruptedError:
+                    if not crash_continue:
+                        return 'Crash'
+                    self.log.debug("Failed to drive to cube. Attempting to continue")
+                    self.retry_movement()
+                self.log.debug("Done moving to cube")
+                return 'Ok'
+            self.log.debug("Cube is too far away (%s metres) to drive to in one arc, facing it first", distance)
         distance = self.face_cube(marker)
-        for i in xrange(2):
-            markers = self.find_markers(filter_func=lambda m: m.info.code == marker_code)
-            if not markers:
-                self.log.debug("Can't see the right marker any more (pre-turn, i=%s), hoping we're facing the right way.", i)
-                break
-            marker = markers[0]
-            self.log.debug("facing cube, rot_y = %s", marker.rot_y)
-            distance = self.face_cube(marker)
-            markers = self.find_markers(filter_func=lambda m: m.info.code == marker_code)
-            if not markers:
-                self.log.debug("Can't see the right marker any more (pre-check, i=%s), hoping we're facing the right way.", i)
-                break
-            marker = markers[0]
-            vec = marker2vector(marker)
-            vec = corrections.correct_all_cube(vec, marker.orientation.rot_y)
+        for i in xrange(3):
+            # Sightings from before the turn still count, so this usually only takes one more picture.
+            estimate = self.confident_estimate(marker_code)
+            if estimate is None:
+                markers = self.find_markers(filter_func=lambda m: m.info.code == marker_code)
+                if not markers:
+                    self.log.debug("Can't see the right marker any more (i=%s), hoping we're facing the right way.", i)
+                    break
+                estimate = markers[0]
+            vec = self.cube_vector(estimate)
+            distance = vec.distance + corrections.cube_width
             self.log.debug("Corrected cube angle is %s", vec.angle)
             if abs(vec.angle) <= angle_tolerance:
                 self.log.debug("This is allowed, not facing any more.")
                 break
             else:
-                self.log.debug("This is too far out, going round again (if this is the first time this message appears)")
+                self.log.debug("This is too far out, facing the cube again")
+                distance = self.face_cube(estimate)
         move = self.wheels.move
         if crash_continue:
             move = self.move_continue
@@ -150,12 +305,13 @@ class CompanionCube(Robot):
             except MovementInterruptedError:
                 return 'Crash'
             while True:  # If the robot is over 1 degrees off:
-                markers = self.find_markers(filter_func=lambda m: m.info.code == marker.info.code)
-                if not markers:
-                    return 'Cant see'
-                marker = markers[0]
-                vec = marker2vector(marker)
-                vec = corrections.correct_all_cube(vec, marker.orientation.rot_y)
+                estimate = self.confident_estimate(marker_code)
+                if estimate is None:
+                    markers = self.find_markers(filter_func=lambda m: m.info.code == marker_code)
+                    if not markers:
+                        return 'Cant see'
+                    estimate = markers[0]
+                vec = self.cube_vector(estimate)
                 if abs(vec.angle) <= angle_tolerance:
                     break
                 self.log.debug("Not correctly aligned")
@@ -178,25 +334,123 @@ class CompanionCube(Robot):
         try:
             self.wheels.move(distance)
         except MovementInterruptedError:
-            while True:
-                self.log.debug("Failed to move %sm. Attempting to continue", distance)
-                time.sleep(1)
-                try:
-                    self.wheels.retry()
-                except MovementInterruptedError:
-                    continue
-                else:
-                    return False
+            self.log.debug("Failed to move %sm. Attempting to continue", distance)
+            self.retry_movement()
+            return False
         else:
             return True
 
+    def retry_movement(self, backoff=0.5, max_backoff=4, max_time=20):
+        # type: (float, float, float) -> bool
+        """
+        Keep retrying the last movement until it succeeds, for at most `max_time` seconds; return whether it did.
+
+        Waits for the robot to settle before the first retry. After each
+        failure, waits `backoff` seconds before trying again (in case
+        something is in the way), doubling each time up to `max_backoff`.
+        """
+        self.settle(1)
+        deadline = time.time() + max_time
+        delay = backoff
+        while True:
+            try:
+                self.wheels.retry()
+            except MovementInterruptedError:
+                if time.time() + delay > deadline:
+                    self.log.warn("Giving up on continuing the last movement after %s seconds", max_time)
+                    return False
+                self.log.debug("Failed to continue. Attempting to continue again in %s seconds", delay)
+                time.sleep(delay)
+                delay = min(delay * 2, max_backoff)
+            else:
+                return True
+
+    def localise(self, markers=None):
+        # type: (List[Marker]) -> PoseEstimate
+        """
+        Return where we are, worked out from the arena markers in `markers` (default: what we can see now).
+
+        Returns None if we can't see enough arena markers. See `Localiser`.
+        The estimate also corrects `tracker`.
+        """
+        if markers is None:
+            markers = self.see_markers(lambda m: m.info.marker_type == MARKER_ARENA)
+        estimate = self.localiser.locate(markers)
+        if estimate is not None:
+            self.log.debug("We're at %s, give or take %.2f metres and %.1f degrees (from markers %s, rms %.2f)",
+                           estimate.pose, estimate.position_sd, estimate.heading_sd, estimate.codes, estimate.rms)
+            self.tracker.correct(estimate)
+        return estimate
+
+    def go_home_directly(self, markers=None, max_sd=0.3, max_rms=3):
+        # type: (List[Marker], float, float) -> bool
+        """
+        Drive straight home, if we can tell well enough where we are; return whether we did.
+
+        We need to know our position to within `max_sd` metres, and the
+        markers must agree with each other (to within `max_rms` standard
+        deviations; see `PoseEstimate`).
+        """
+        estimate = self.localise(markers)
+        if estimate is None or estimate.position_sd > max_sd or estimate.rms > max_rms:
+            return False
+        pose = estimate.pose
+        home_x, home_y = arena.home(self.zone)
+        angle = normalise_angle(arena.heading_to(pose.x, pose.y, home_x, home_y) - pose.heading)
+        dist = hypot(home_x - pose.x, home_y - pose.y)
+        self.log.info("Driving straight home: turning %.1f degrees and moving %.2f metres", angle, dist)
+        # The original protocol can't go more than 2.55 metres in one move.
+        # Don't stream the moves behind the turn: if the turn fails, we
+        # mustn't drive off in the wrong direction.
+        self.wheels.run_plan([Motion("turn", angle)] + low_power_moves(dist), window=1)
+        return True
+
+    def note_cubes(self, markers):
+        # type: (List[Marker]) -> None
+        """Tell the path planner where the cubes in `markers` are, if we know where we are well enough to say."""
+        if not self.tracker.confident():
+            return
+        x, y, heading = self.tracker.pose
+        camera_x = x + corrections.webcam_horizontal_offset * sind(heading)
+        camera_y = y + corrections.webcam_horizontal_offset * cosd(heading)
+        for marker in markers:
+            if marker.info.marker_type == MARKER_ARENA:
+                continue
+            # The middle of the cube is half a cube behind the marker.
+            dist = marker.dist + corrections.cube_width / 2
+            bearing = heading + marker.rot_y
+            self.planner.add_obstacle(marker.info.code, camera_x + dist * sind(bearing), camera_y + dist * cosd(bearing))
+
+    def drive_to_point(self, x, y, ignore=()):
+        # type: (float, float, Tuple[int, ...]) -> bool
+        """
+        Drive to (x, y) in the arena by the shortest path round the cubes we know about; return whether we could.
+
+        Cubes whose marker codes are in `ignore` don't count as in the way
+        (e.g. the one we're going to collect). See `PathPlanner`.
+        """
+        pose = self.tracker.pose
+        start = time.time()
+        path = self.planner.plan((pose.x, pose.y), (x, y), ignore)
+        if path is None:
+            self.log.warn("Can't find a way from %s to (%s, %s)", pose, x, y)
+            return False
+        motions = self.planner.motions(pose.heading, path)
+        self.log.info("Planned a path to (%.2f, %.2f) in %.1f ms: %s", x, y, (time.time() - start) * 1000, motions)
+        # Don't stream a leg behind the turn onto it: if the turn fails, we
+        # mustn't drive off in the wrong direction (and into a cube).
+        self.wheels.run_plan(motions, window=1)
+        return True
+
     def move_home_from_A(self):
         # type: () -> None
         """Given we are at our A cube and facing roughly home, get home.
 
-        If we can see either of the two markers inside our home area,
-        we can move home accurately. Otherwise, we will blindly move
-        forwards and hope we're facing in the right direction.
+        If we can see enough arena markers to tell where we are, we drive
+        straight home. Otherwise, if we can see either of the two markers
+        inside our home area, we can move home accurately. Otherwise, we
+        will blindly move forwards and hope we're facing in the right
+        direction.
         """
         right_marker_code = self.zone * 7
         righter_marker_code = (right_marker_code + 1) % 28
@@ -207,9 +461,11 @@ class CompanionCube(Robot):
         other_codes.remove(lefter_marker_code)
         other_codes.remove(right_marker_code)
         other_codes.remove(righter_marker_code)
-        markers = sorted(self.see_markers(lambda m: m.info.marker_type == MARKER_ARENA), key=attrgetter("dist"))
-        marker_codes = [m.info.code for m in markers]
-        self.log.debug("Seen %s arena markers (codes: %s)", len(markers), marker_codes)
+        markers = self.see_markers(lambda m: m.info.marker_type == MARKER_ARENA)
+        marker_codes = markers.codes()
+        self.log.debug("Seen %s arena markers (codes: %s)", len(markers), sorted(marker_codes))
+        if self.go_home_directly(markers):
+            return
 
         walls = [
             list(range(0, 7)),
@@ -223,33 +479,34 @@ class CompanionCube(Robot):
                 or lefter_marker_code in marker_codes or righter_marker_code in marker_codes):
             if left_marker_code in marker_codes:
                 self.log.debug("Can see left marker!")
-                left_marker = filter(lambda m: m.info.code == left_marker_code, markers)[0]
-                self.wheels.turn(left_marker.rot_y + 16)
+                left_marker = markers.code(left_marker_code)
+                angle = left_marker.rot_y + 16
             elif right_marker_code in marker_codes:
                 self.log.debug("Can see right marker!")
-                right_marker = filter(lambda m: m.info.code == right_marker_code, markers)[0]
-                self.wheels.turn(right_marker.rot_y - 16)
+                right_marker = markers.code(right_marker_code)
+                angle = right_marker.rot_y - 16
             elif lefter_marker_code in marker_codes:
                 self.log.debug("Can see lefter marker!")
-                lefter_marker = filter(lambda m: m.info.code == lefter_marker_code, markers)[0]
-                self.wheels.turn(lefter_marker.rot_y + 34)
+                lefter_marker = markers.code(lefter_marker_code)
+                angle = lefter_marker.rot_y + 34
             elif righter_marker_code in marker_codes:
                 self.log.debug("Can see righter marker!")
-                righter_marker = filter(lambda m: m.info.code == righter_marker_code, markers)[0]
-                self.wheels.turn(righter_marker.rot_y - 34)
+                righter_marker = markers.code(righter_marker_code)
+                angle = righter_marker.rot_y - 34
             else:
                 self.log.critical("Python is lying to us! This can't happen.")
+                angle = 0
             # (sqrt(2 * 2.5^2) = 3.5355 metres)
-            self.wheels.low_power_move(1.5)
-            self.wheels.low_power_move(2)
+            # Don't stream the moves behind the turn: if the turn fails, we
+            # mustn't drive off in the wrong direction.
+            self.wheels.run_plan([Motion("turn", angle), Motion("low_power_move", 1.5), Motion("low_power_move", 2)], window=1)
         elif other_codes.intersection(marker_codes):
             bad_marker_codes = other_codes.intersection(marker_codes)
             self.log.warn("Other teams' codes (%s) are visible! We're probably facing into another team's corner :(", bad_marker_codes)
             self.move_home_from_other_A()
         else:
             self.log.warn("Can't see any useful arena markers (ours or theirs), driving forwards and praying...")
-            self.wheels.low_power_move(1.5)
-            self.wheels.low_power_move(2)
+            self.wheels.run_plan([Motion("low_power_move", 1.5), Motion("low_power_move", 2)])
 
     def move_home_from_other_A(self, marker=None):
         # type: () -> None
@@ -278,7 +535,10 @@ class CompanionCube(Robot):
         # - if we can see an arena marker in front of us, drive to 1.5 m from it and repeat/go home
 
         if marker is None:
-            markers = sorted(self.see_markers(lambda m: m.info.marker_type == MARKER_ARENA), key=lambda m: ([walls.index(wall) for wall in walls if m.info.code not in wall][0] in (self.zone, (self.zone - 1) % 4), m.dist))  # Arena markers, sorted by whether they're on one of our walls and then by the closest (the first element will be the closest marker that's on one of our walls)
+            markers = self.see_markers(lambda m: m.info.marker_type == MARKER_ARENA)
+            if self.go_home_directly(markers):
+                return
+            markers = sorted(markers, key=lambda m: ([walls.index(wall) for wall in walls if m.info.code not in wall][0] in (self.zone, (self.zone - 1) % 4), m.dist))  # Arena markers, sorted by whether they're on one of our walls and then by the closest (the first element will be the closest marker that's on one of our walls)
             marker = markers[0]
             self.log.debug("Fixating upon marker %s (%s metres away)", marker.info.code, marker.dist)
         else:
@@ -289,7 +549,10 @@ class CompanionCube(Robot):
         trying_to_move = True
         while (not has_moved) and trying_to_move:
             trying_to_move = True
-            initial_markers = self.see_markers()
+            # Without telemetry, we compare pictures from before and after moving.
+            initial_markers = None
+            if not self.mbed.telemetry_enabled:
+                initial_markers = self.see_markers()
             self.wheels.turn(marker.rot_y)  # Face the marker
             # Find the marker again
             markers = self.see_markers(predicate=lambda m: m.info.code == marker.info.code)
@@ -301,6 +564,7 @@ class CompanionCube(Robot):
             orig_marker_wall = [walls.index(wall) for wall in walls if marker.info.code in wall][0]
             # Move to 1.5 metres away from the marker
             self.log.debug("Moving to 1.5 metres from the marker")
+            first_move_seq = self.mbed.seq
             if marker.dist > 1.55:
                 self.move_continue(marker.dist - 1.5)
             else:
@@ -311,8 +575,13 @@ class CompanionCube(Robot):
                 self.log.error("We moved closer to the marker (maybe) and now can't see it. Moving backwards slightly and trying again.")
                 self.wheels.move(-0.15, ignore_crash=True)
                 continue
-            final_markers = self.see_markers()
-            has_moved = self.are_we_moving(initial_markers, final_markers)
+            if initial_markers is None:
+                # The wheel encoders tell us whether we moved, without taking two more pictures.
+                # (If telemetry stopped part way through, this says we didn't, and we try again.)
+                has_moved = self.mbed.distance_since(first_move_seq) > 0.05
+            else:
+                final_markers = self.see_markers()
+                has_moved = self.are_we_moving(initial_markers, final_markers)
             if not has_moved:
                 self.log.error("We're stuck! Moving back slightly, then trying to move to the marker again forever, since there's nothing else we can do.")
                 self.wheels.move(-0.15, ignore_crash=True)
@@ -379,7 +648,7 @@ class CompanionCube(Robot):
         while not markers:
             self.log.debug("Can't see any matching wall markers (wall, close, not the wall we first saw), going forwards a bit.")
             self.move_continue(1)
-            time.sleep(1)
+            self.settle(1)
             markers = self.see_markers(predicate=lambda m: m.info.marker_type == MARKER_ARENA and m.dist <3 and m.info.code not in walls[orig_marker_wall])
         marker = markers[0]
         self.log.debug("We see %s wall markers.", len(markers))
@@ -388,7 +657,7 @@ class CompanionCube(Robot):
             # We started at a wall opposite our corner, go round again
             self.log.info("Recursing, since we need to go along another wall to get home. If this message appears more than once, something might be wrong.")
             # Pass ourselves a sensible marker.
-            marker = sorted(markers, key=attrgetter("dist"))[0]
+            marker = markers.closest()
             self.move_home_from_other_A(marker=marker)
             self.log.info("Finished recursing, hopefully we're home now. Returning.")
             return
@@ -442,17 +711,17 @@ class CompanionCube(Robot):
         for _ in xrange(4):
             self.wheels.turn(90)
             self.log.debug("Finding cube markers.")
-            markers = sorted(self.see_markers(predicate=lambda m: m.info.marker_type == MARKER_TOKEN_B and 1 < m.dist < 2), key=attrgetter("dist"))
-            if markers:
+            marker = self.see_markers(predicate=lambda m: m.info.marker_type == MARKER_TOKEN_B and 1 < m.dist < 2).closest()
+            if marker is not None:
                 self.log.debug("We see a B cube, driving to it...")
-                self.move_to_cube(markers[0], crash_continue=True)
+                self.move_to_cube(marker, crash_continue=True)
             else:
                 self.log.info("We can't see any B markers at the right distance :( Going to roughly where it should be.")
                 self.move_continue(1.5)
-            markers = sorted(self.see_markers(predicate=lambda m: m.info.marker_type == MARKER_TOKEN_A and 1 < m.dist < 2), key=attrgetter("dist"))
-            if markers:
+            marker = self.see_markers(predicate=lambda m: m.info.marker_type == MARKER_TOKEN_A and 1 < m.dist < 2).closest()
+            if marker is not None:
                 self.log.debug("We see an A cube, driving to it...")
-                self.move_to_cube(markers[0], crash_continue=True)
+                self.move_to_cube(marker, crash_continue=True)
             else:
                 self.log.info("We can't see any A markers at the right distance :( Going to roughly where it should be.")
                 self.move_continue(1.5)
@@ -462,10 +731,10 @@ class CompanionCube(Robot):
         self.move_home_from_A()
         self.log.info("Done getting more cubes.")
 
-    def see_markers(self, predicate=None, attempts=3):
-        # type: (Callable[[Marker], bool], int) -> List[Marker]
+    def see_markers(self, predicate=None, attempts=3, max_age=None):
+        # type: (Callable[[Marker], bool], int, float) -> MarkerFrame
         """
-        Return a list of visible markers that satisfy the given predicate.
+        Return a MarkerFrame of visible markers that satisfy the given predicate.
 
         The predicate will be called on each marker, and should return a
         boolean showing whether the marker should be included in the returned
@@ -478,12 +747,20 @@ class CompanionCube(Robot):
         made, in case of a transient fault with the camera. The number of
         attempts can be changed by altering the attempts parameter, which must
         be greater than zero.
+
+        Each attempt uses a picture taken after the robot last stopped moving,
+        and (if `max_age` is given) less than `max_age` seconds ago; see
+        `fresh_snapshot`. Pictures are taken in the background, so there is
+        often one ready.
         """
         self.log.info("Looking for markers (%s attempts)...", attempts)
         assert attempts > 0
-        markers = []
+        markers = MarkerFrame()
         for i in xrange(attempts):
-            markers = filter(predicate, self.see())
+            if self.vision.running:
+                markers = self.fresh_snapshot(max_age).markers.filter(predicate)
+            else:
+                markers = self.see().filter(predicate)
             if markers:
                 self.log.info("Found %s markers (attempt %s), returning.", len(markers), i + 1)
                 break
@@ -491,8 +768,30 @@ class CompanionCube(Robot):
                 self.log.debug("No markers found (attempt %s), retrying...", i + 1)
         else:
             self.log.warn("No markers found after %s attempts!", attempts)
+        self.note_cubes(markers)
         return markers
 
+    def see_at_distance(self, predicate, dist, dist_tolerance=0.5):
+        # type: (Callable[[Marker], bool], float, float) -> MarkerFrame
+        """
+        Return visible markers that satisfy the predicate, expected `dist` metres away (give or take `dist_tolerance`).
+
+        The first picture is taken at the smallest resolution that should
+        see markers that far away (see `ResolutionPolicy`); if it doesn't
+        see any matching markers, bigger resolutions are tried in turn.
+        """
+        res = self.resolutions.choose(dist, dist_tolerance)
+        while res is not None:
+            start = time.time()
+            markers = self.see(res=res).filter(predicate)
+            self.resolutions.record(res, dist, bool(markers), time.time() - start)
+            if markers:
+                self.log.debug("Found %s matching markers at %sx%s", len(markers), *res)
+                return markers
+            self.log.debug("No matching markers at %sx%s", *res)
+            res = self.resolutions.fallback(res)
+        return MarkerFrame()
+
     def find_closest_marker(self, marker_type):
         # type: (...) -> Marker
         """
@@ -501,8 +800,8 @@ class CompanionCube(Robot):
         If no markers can be found, an IndexError will be raised.
         """
         self.log.info("Finding closest marker of type %s", marker_type)
-        markers = [m for m in self.find_markers(filter_func=lambda marker: marker.info.marker_type == marker_type)]
-        return sorted(markers, key=attrgetter("dist"))[0]
+        markers = as_frame(self.find_markers(filter_func=lambda marker: marker.info.marker_type == marker_type))
+        return markers.by_distance[0]
 
     def find_markers_approx_position(self, marker_type, dist, dist_tolerance=0.5):
         """
@@ -511,27 +810,26 @@ class CompanionCube(Robot):
         The list may be empty, in which case no markers could be seen at that distance.
         """
         self.log.info("Finding marker of type %s approximately %s metres away, give or take %s metres", marker_type, dist, dist_tolerance)
-        markers = []
-        for marker in self.lookForMarkers(max_loop=5):
-            if marker.info.marker_type == marker_type and dist - dist_tolerance <= marker.dist <= dist + dist_tolerance:
-                self.log.debug("Found a MATCHING %s marker (id %s) %s metres away at %s degrees",
-                               marker.info.marker_type, marker.info.code, marker.dist, marker.rot_y)
-                markers.append(marker)
-            else:
-                self.log.debug("Found a non-matching %s marker (id %s) %s metres away at %s degrees",
-                               marker.info.marker_type, marker.info.code, marker.dist, marker.rot_y)
-        # markers = [m for m in self.lookForMarkers(max_loop=5) if m.info.marker_type == marker_type and dist - dist_tolerance <= m.dist <= dist + dist_tolerance]
+        markers = self.see_at_distance(lambda m: m.info.marker_type == marker_type and dist - dist_tolerance <= m.dist <= dist + dist_tolerance,
+                                       dist, dist_tolerance)
+        for marker in markers:
+            self.log.debug("Found a MATCHING %s marker (id %s) %s metres away at %s degrees",
+                           marker.info.marker_type, marker.info.code, marker.dist, marker.rot_y)
         self.log.info("Found %s markers matching criteria", len(markers))
         return markers
 
     def cone_search(self, marker_type=None, marker_id=None, dist=None,
-                    dist_tolerance=0.5, start_angle=-45, stop_angle=45, delta_angle=15):
+                    dist_tolerance=0.5, start_angle=-45, stop_angle=45, delta_angle=15, prior=None):
         # type: (...) -> List[Marker]
         """Search for markers, turning from side to side.
 
         As soon as markers satisfying the passed criteria are found,
         this function exits and returns them.
 
+        If `prior` is given (see `sweep.heading_prior`), the headings are
+        visited in the order most likely to find the markers soonest,
+        instead of from left to right.
+
         The order of this function's arguments is not stable. Callers
         should use keyword args only, never positional args.
         """
@@ -543,8 +841,6 @@ class CompanionCube(Robot):
             self.log.debug("  %s <= dist <= %s", dist - dist_tolerance, dist + dist_tolerance)
         except TypeError:
             self.log.debug("  dist == %s", dist)
-        angles = [0, start_angle] + [delta_angle for _ in range(0, stop_angle - start_angle, delta_angle)]
-        angle_turned = 0
 
         def predicate(marker):
             # type: (Marker) -> bool
@@ -553,91 +849,116 @@ class CompanionCube(Robot):
             correct_dist = dist is None or dist - dist_tolerance <= marker.dist <= dist + dist_tolerance
             return correct_type and correct_id and correct_dist
 
-        for angle in angles:
-            self.wheels.turn(angle)
-            angle_turned += angle
-            markers = self.see_markers(predicate)
-            if markers:
-                self.log.info("Found %s markers matching criteria, stopping search.", len(markers))
-                return markers
-            else:
-                time.sleep(0.5)
+        headings = self.order_headings(cone_headings(start_angle, stop_angle, delta_angle), prior)
+        result = self.sweep(headings, predicate, dist, dist_tolerance, prior=prior)
+        if result.markers:
+            self.log.info("Found %s markers matching criteria, stopping search.", len(result.markers))
+            return result.markers
         self.log.info("Found no markers matching criteria.")
-        self.wheels.turn(-angle_turned)  # Turn back to where we were facing originally.
+        self.wheels.turn(-headings[-1])  # Turn back to where we were facing originally.
         return []
 
-    def cone_search_approx_position(self, marker_type, dist, dist_tolerance=0.5, max_left=45, max_right=45, delta=15, sleep_time=0.5):
+    def sweep(self, headings, predicate, dist=None, dist_tolerance=0.5, wait=0.5, minimum=1, prior=None):
+        # type: (List[float], Callable[[Marker], bool], float, float, float, int, Callable[[float], float]) -> SweepResult
+        """
+        Look for markers that satisfy the predicate at each heading in turn (degrees clockwise from here).
+
+        Stops at the first heading with at least `minimum` matching markers, and returns them
+        and that heading, leaving the robot facing it. If `dist` is given,
+        pictures are taken at a resolution that can see markers that far
+        away (give or take `dist_tolerance`). See `Sweeper` (and for `wait`
+        and `prior`, `Sweeper.sweep`).
+        """
+        options = {} if dist is None else {"res": self.resolutions.choose(dist, dist_tolerance)}
+        return self.sweeper.sweep(headings, predicate, options, wait, minimum, prior)
+
+    def order_headings(self, headings, prior):
+        # type: (List[float], Callable[[float], float]) -> List[float]
+        """Return `headings` sorted by `prior` (see `Sweeper.order`), or unchanged if there isn't one."""
+        if prior is None:
+            return headings
+        ordered = self.sweeper.order(headings, prior)
+        self.log.debug("Searching %s in order of likelihood: %s", headings, ordered)
+        return ordered
+
+    def sweep_around(self, predicate, minimum=1, max_loop=10):
+        # type: (Callable[[Marker], bool], int, int) -> SweepResult
+        """
+        Look straight ahead, then all the way round, until at least `minimum` markers satisfy the predicate.
+
+        Straight ahead gets up to `max_loop` pictures (see `lookForMarkers`);
+        the rest of the circle is covered as planned by `sweep.plan_sweep`,
+        with one picture per heading. Returns the markers found and the
+        heading they were found at, like `sweep`. If nothing is found, the
+        robot turns back to where it started, and the heading is None.
+        """
+        markers = as_frame(self.lookForMarkers(max_loop=max_loop)).filter(predicate)
+        if len(markers) >= minimum:
+            return SweepResult(markers, 0)
+        headings = plan_sweep(180, 180)[1:]  # Straight ahead has been done.
+        self.log.debug("Sweeping round through %s; expected to take %.1f seconds", headings, self.sweeper.expected_time(headings))
+        start = time.time()
+        result = self.sweep(headings, predicate, minimum=minimum)
+        self.log.debug("Sweep took %.1f seconds", time.time() - start)
+        if result.markers:
+            return result
+        self.wheels.turn(normalise_angle(-headings[-1]))
+        return SweepResult(markers, None)
+
+    def cone_search_approx_position(self, marker_type, dist, dist_tolerance=0.5, max_left=45, max_right=45, delta=15, sleep_time=0.5, prior=None):
         # type: (...) -> list
         """
         Search for a specific marker type at an appproximate distance with tolerances
         outside of the visual range of the camera
+
+        See `cone_search` for `prior`.
         """
         self.log.info("Doing a cone based search with extremities (%s, %s) and delta %s for markers of type %s approximately %s metres away, give or take %s metres", max_left, max_right, delta, marker_type, dist, dist_tolerance)
-        angles = [0, -max_left] + ([delta]*(((max_left + max_right) // delta) + 1))
-        for angle in angles:
-            self.wheels.turn(angle)
-            markers = self.find_markers_approx_position(marker_type, dist, dist_tolerance)
-            if markers:
-                self.log.info("Finished marker type cone search and found %s markers of type %s", len(markers), marker_type)
-                return markers
-            time.sleep(sleep_time)
-        self.wheels.turn(-max_right)  # close enough
+        headings = self.order_headings(cone_headings(-max_left, max_right, delta), prior)
+        result = self.sweep(headings, lambda m: m.info.marker_type == marker_type and dist - dist_tolerance <= m.dist <= dist + dist_tolerance,
+                            dist, dist_tolerance, wait=sleep_time, prior=prior)
+        if result.markers:
+            self.log.info("Finished marker type cone search and found %s markers of type %s", len(result.markers), marker_type)
+            return result.markers
+        self.wheels.turn(-headings[-1])
         self.log.info("Finished marker type cone search with no markers found")
         return []
 
-    def cone_search_specific_marker(self, marker_id, max_left=45, max_right=45, delta=15, sleep_time=0.5):
+    def cone_search_specific_marker(self, marker_id, max_left=45, max_right=45, delta=15, sleep_time=0.5, prior=None):
         # type: (...) -> list
         """
         Search for a specific marker outside of the visual range of the camera
+
+        See `cone_search` for `prior`.
         """
         self.log.info("Doing a cone based search with extremities (%s, %s) and delta %s for a marker (id %s)", max_left, max_right, delta, marker_id)
-        angles = [0, -max_left] + ([delta]*(((max_left + max_right) // delta) + 1))
-        for angle in angles:
-            self.wheels.turn(angle)
-            markers = self.see_markers(predicate=lambda marker: marker.info.code == marker_id)
-            if markers:
-                self.log.info("Finished specific marker cone search and found %s markers of id %s", len(markers), marker_id)
-                return markers
-            time.sleep(sleep_time)
-        self.wheels.turn(-max_right)  # close enough
+        headings = self.order_headings(cone_headings(-max_left, max_right, delta), prior)
+        result = self.sweep(headings, lambda marker: marker.info.code == marker_id, wait=sleep_time, prior=prior)
+        if result.markers:
+            self.log.info("Finished specific marker cone search and found %s markers of id %s", len(result.markers), marker_id)
+            return result.markers
+        self.wheels.turn(-headings[-1])
         self.log.info("Finished specific marker cone search with no markers found")
         return []
 
     def find_markers(self, minimum=1, max_loop=10, delta_angle=20, filter_func=lambda marker: True):
         """
         Find at least minimum markers.
-        Try max_loop attempts for each direction.
-        """
+        Try max_loop attempts straight ahead, then sweep round (see `sweep_around`).
 
-        # Scan 0.
+        delta_angle is ignored; the sweep is spaced to suit the camera's field of view.
+        """
         self.log.debug("Searching for markers... (direction = 0)")
-        markers = self.lookForMarkers(max_loop=max_loop)
-        markers = filter(filter_func, markers)
-        if len(markers) >= minimum:
-            # If found correct number of markers, stop and return them
+        markers, heading = self.sweep_around(filter_func, minimum, max_loop)
+        if heading is not None:
+            if heading != 0:
+                self.routeChange = True
             return markers
-        else:
-            angle = delta_angle
-            while angle <= 180:
-                # If the robot cannot see a marker
-                self.log.debug("Searching for markers... (direction = %s)", delta_angle)
-                self.wheels.turn(angle)
-                markers = filter(filter_func, self.lookForMarkers(max_loop=max_loop))
-                if len(markers) >= minimum:
-                    self.routeChange = True
-                    return markers
-                self.wheels.turn(-angle * 2)
-                markers = filter(filter_func, self.lookForMarkers(max_loop=max_loop))
-                if len(markers) >= minimum:
-                    self.routeChange = True
-                    return markers
-                self.wheels.turn(angle)
-                angle += delta_angle
-            self.log.error("Couldn't find the requested marker!")
+        self.log.error("Couldn't find the requested marker!")
         # Current direction is ~360 (no change)
-        self.log.error("Markers (minimum %s) not found with %s loops per direction", minimum, max_loop)
+        self.log.error("Markers (minimum %s) not found with %s loops straight ahead", minimum, max_loop)
         self.routeChange = True
-        return markers 
+        return markers
 
     def lookForMarkers(self, max_loop=float("inf"), sleep_time=0.5):
         """
@@ -646,7 +967,7 @@ class CompanionCube(Robot):
         """
         self.log.warn("Deprecation warning: use see_markers instead!")
         self.log.info("Looking for markers with %s attempts...", max_loop)
-        time.sleep(sleep_time)  # Rest so camera can focus
+        self.settle(sleep_time)  # Rest so camera can focus
         markers = self.see()
         i = 0
         while i <= max_loop and len(markers) == 0:
@@ -658,24 +979,13 @@ class CompanionCube(Robot):
     def find_specific_markers(self, marker_type, delta_angle=20):
         """
         Searches for markers in a similar way to find_markers().
+
+        delta_angle is ignored; the sweep is spaced to suit the camera's field of view.
         """
         self.log.debug("Finding marker of type %s", marker_type)
-        self.log.warn("Not yet implemented")
-        # The maximum number of times to check for a marker from one angle.
+        # The maximum number of times to check for a marker straight ahead.
         max_loop = 5
-        # Get a list of markers that are of the requested type.
-        markers = filter(lambda m: m.info.marker_type == marker_type, self.lookForMarkers(max_loop=max_loop))
-        if len(markers) == 0:
-            # Turn slightly left in case we're facing just right of the marker.
-            self.wheels.turn(-delta_angle)
-            i = 0
-            # Search for markers in a full circle
-            while i <= 360 and len(markers) == 0:
-                markers = filter(lambda m: m.info.marker_type == marker_type, self.lookForMarkers(max_loop=max_loop))
-                if len(markers) == 0:
-                    self.wheels.turn(delta_angle)
-                    i += delta_angle
-        return markers
+        return self.sweep_around(lambda m: m.info.marker_type == marker_type, max_loop=max_loop).markers
 
     def get_vec_to_corner(self, marker):
         """
@@ -730,6 +1040,61 @@ class CompanionCube(Robot):
         else:
             return True
 
+    def load_speed_model(self):
+        """
+        Load the speeds measured on previous runs from the USB stick, if there are any.
+        """
+        path = os.path.join(self.usbkey, "speed_model.json")
+        if not os.path.exists(path):
+            self.log.info("No saved speed model, using the default speeds")
+            return
+        try:
+            self.mbed.speed_model.load(path)
+        except (IOError, OSError, ValueError):
+            self.log.exception("Couldn't load speed model from %s", path)
+        else:
+            self.log.info("Loaded speed model: %s", self.mbed.speed_model.speeds)
+
+    def load_resolution_ranges(self):
+        """
+        Load tuned camera resolution ranges from the USB stick, if there are any.
+
+        The file has the same format as the resolution_stats.json saved at
+        the end of each run, so a tuned copy of that can be used.
+        """
+        path = os.path.join(self.usbkey, "resolution_ranges.json")
+        if not os.path.exists(path):
+            return
+        try:
+            self.resolutions.load(path)
+        except (IOError, OSError, ValueError, KeyError):
+            self.log.exception("Couldn't load resolution ranges from %s", path)
+        else:
+            self.log.info("Loaded resolution ranges: %s", self.resolutions.ranges)
+
+    def dump_metrics(self):
+        """
+        Log a summary of the mbed link's metrics, and save them (and the speed model) to the USB stick.
+        """
+        self.log.info("mbed link metrics: %s", self.mbed.metrics.summary())
+        self.log.info("Vision metrics: %s", self.vision.metrics.summary())
+        self.log.info("Resolution stats: %s", self.resolutions.metrics.summary())
+        self.log.info("Stall detector metrics: %s", self.stall_detector.metrics.summary())
+        self.log.info("Settling: %s", self.settler.report())
+        self.log.info("Sweep metrics: %s", self.sweeper.metrics.summary())
+        self.log.info("Measured speeds: %s", self.mbed.speed_model.speeds)
+        for name, obj in [("mbed_metrics.json", self.mbed.metrics), ("vision_metrics.json", self.vision.metrics),
+                          ("speed_model.json", self.mbed.speed_model), ("resolution_stats.json", self.resolutions),
+                          ("stall_metrics.json", self.stall_detector.metrics), ("settle_metrics.json", self.settler.metrics),
+                          ("sweep_metrics.json", self.sweeper.metrics)]:
+            path = os.path.join(self.usbkey, name)
+            try:
+                obj.dump(path)
+            except (IOError, OSError):
+                self.log.exception("Couldn't save %s", path)
+            else:
+                self.log.info("Saved %s", path)
+
     def init_logger(self):
         """
         Initialise logger.
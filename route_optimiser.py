@@ -0,0 +1,191 @@
+"""Choosing which cubes to collect, and in what order, to get home soonest.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+
+Run this file directly to see the best route from each zone, and how long
+it should take, or with --check to check that `DEFAULT_ORDER` is still the
+best route with the default speeds.
+"""
+
+
+from __future__ import division
+
+import argparse
+import collections
+from itertools import combinations, permutations
+import logging
+from math import hypot
+import time
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import Dict, List, Optional, Tuple
+except ImportError:
+    pass
+
+import arena
+from mbed_link import Motion
+from motion_optimiser import normalise_angle
+from path_planner import PathPlanner
+from speed_model import SpeedModel
+
+
+# How long a match is, in seconds.
+MATCH_TIME = 180
+# How long looking for a cube's markers before driving into it is assumed
+# to take, in seconds, until the vision worker has measured it.
+DEFAULT_CAPTURE_TIME = 0.5
+# The best order to collect the cubes in with the default speeds, which is
+# the same from every zone, since the arena looks the same from each. It
+# takes a while to work out, so it's worked out here (see `check_default_order`).
+DEFAULT_ORDER = ("A", "B1", "C", "B2")
+
+
+class TimingModel(collections.namedtuple("TimingModel", ["seconds_per_degree", "seconds_per_metre", "overhead", "capture_time"])):
+    """
+    How long motions take: `overhead` seconds for every turn or move, plus
+    `seconds_per_degree` or `seconds_per_metre`. Looking for each cube takes
+    `capture_time` seconds.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_speed_model(cls, speed_model, capture_time=DEFAULT_CAPTURE_TIME):
+        # type: (SpeedModel, float) -> TimingModel
+        """Return the timing model that goes with the (calibrated) speeds of the mbed's commands."""
+        return cls(1 / speed_model.speeds["r"], 1 / speed_model.speeds["f"], speed_model.overhead, capture_time)
+
+    def duration(self, motions):
+        # type: (List[Motion]) -> float
+        """Return how long a sequence of turns and moves takes."""
+        total = 0
+        for motion in motions:
+            per_unit = self.seconds_per_degree if motion.kind == "turn" else self.seconds_per_metre
+            total += self.overhead + abs(motion.amount) * per_unit
+        return total
+
+
+# A route through some cubes and home again. `order` is the names of the
+# cubes, in the order they're collected; `legs` are the turns and moves to
+# get to each cube (and home, last); `duration` is how long it should take.
+Route = collections.namedtuple("Route", ["order", "legs", "duration"])
+
+
+class RouteOptimiser(object):
+    """
+    Works out the best order to collect the cubes in, from how long each route should take.
+
+    Each leg of a route is planned round the cubes that haven't been
+    collected yet (see `PathPlanner`), and each cube takes a look before
+    driving into it. Every order of every set of cubes is tried (there are
+    only a few cubes, so this is quick, and legs are cached). The best route
+    collects as many cubes as it can within `time_limit` seconds (leaving
+    `margin` seconds spare), and of those, takes the least time.
+    """
+
+    def __init__(self, log, timing, time_limit=MATCH_TIME, margin=20, planner=None):
+        # type: (..., TimingModel, float, float, PathPlanner) -> None
+        self.log = log
+        self.timing = timing
+        self.time_limit = time_limit
+        self.margin = margin
+        self.planner = planner if planner is not None else PathPlanner(log)
+        self._paths = {}  # type: Dict[tuple, Optional[List[Tuple[float, float]]]]
+
+    def path(self, start, goal, cubes, collected, target):
+        # type: (Tuple[float, float], Tuple[float, float], Dict[str, Tuple[float, float]], frozenset, str) -> Optional[List[Tuple[float, float]]]
+        """Return the path from `start` to `goal`, round every cube not in `collected` (apart from `target`)."""
+        key = (start, goal, collected, target)
+        if key not in self._paths:
+            for name, (x, y) in cubes.items():
+                if name in collected:
+                    self.planner.remove_obstacle(name)
+                else:
+                    self.planner.add_obstacle(name, x, y)
+            self._paths[key] = self.planner.plan(start, goal, ignore=(target,) if target is not None else ())
+        return self._paths[key]
+
+    def route(self, order, start, home, cubes):
+        # type: (Tuple[str, ...], Tuple[float, float, float], Tuple[float, float], Dict[str, Tuple[float, float]]) -> Optional[Route]
+        """Return the route that collects `order` from `start`, then goes `home`, or None if there isn't one."""
+        x, y, heading = start
+        collected = frozenset()
+        legs = []
+        duration = 0
+        for target in order + (None,):
+            goal = cubes[target] if target is not None else home
+            path = self.path((x, y), goal, cubes, collected, target)
+            if path is None:
+                return None
+            motions = PathPlanner.motions(heading, path)
+            legs.append(motions)
+            duration += self.timing.duration(motions)
+            if target is not None:
+                duration += self.timing.capture_time
+                collected |= {target}
+            if len(path) > 1:
+                (from_x, from_y), (x, y) = path[-2], path[-1]
+                heading = arena.heading_to(from_x, from_y, x, y)
+        return Route(order, legs, duration)
+
+    def best(self, start, home, cubes):
+        # type: (Tuple[float, float, float], Tuple[float, float], Dict[str, Tuple[float, float]]) -> Route
+        """Return the best route from `start` through some of `cubes` ({name: (x, y)}) to `home`."""
+        begin = time.time()
+        best = self.route((), start, home, cubes)
+        tried = 0
+        for count in xrange(1, len(cubes) + 1):
+            for chosen in combinations(sorted(cubes), count):
+                for order in permutations(chosen):
+                    tried += 1
+                    route = self.route(order, start, home, cubes)
+                    if route is None or route.duration > self.time_limit - self.margin:
+                        continue
+                    if best is None or (len(route.order), -route.duration) > (len(best.order), -best.duration):
+                        best = route
+        self.log.info("Tried %s routes in %.2f seconds; the best collects %s in %.1f seconds",
+                      tried, time.time() - begin, best.order if best else None, best.duration if best else 0)
+        return best
+
+
+def best_route(log, zone, timing, cubes=None, time_limit=MATCH_TIME):
+    # type: (..., int, TimingModel, List[Tuple[str, str, float, float]], float) -> Route
+    """Return the best route from the start of `zone` through its cubes (default: where they start; see `arena.cubes`) and home."""
+    cubes = arena.cubes(zone) if cubes is None else cubes
+    optimiser = RouteOptimiser(log, timing, time_limit)
+    return optimiser.best(arena.start_pose(zone), arena.home(zone), {name: (x, y) for name, _, x, y in cubes})
+
+
+def check_default_order(log):
+    """Check that `DEFAULT_ORDER` is the best route from every zone with the default speeds."""
+    timing = TimingModel.from_speed_model(SpeedModel())
+    for zone in xrange(4):
+        route = best_route(log, zone, timing)
+        assert route is not None and route.order == DEFAULT_ORDER, \
+            "expected the best route from zone {} to be {}, got {}".format(zone, DEFAULT_ORDER, route.order if route else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--time-limit", type=float, default=MATCH_TIME, help="how long the match is (seconds)")
+    parser.add_argument("--check", action="store_true", help="instead, check that DEFAULT_ORDER is still the best route")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(module)s:%(lineno)d - %(levelname)s: %(message)s")
+    log = logging.getLogger(__name__)
+    if args.check:
+        check_default_order(log)
+        log.info("%s: ok", check_default_order.__name__)
+        return
+    timing = TimingModel.from_speed_model(SpeedModel())
+    log.info("Timing model: %s", timing)
+    for zone in xrange(4):
+        route = best_route(log, zone, timing, time_limit=args.time_limit)
+        log.info("Zone %s: collect %s, taking %.1f seconds", zone, " then ".join(route.order), route.duration)
+        for leg in route.legs:
+            log.info("  %s", ", ".join("{} {:.2f}".format(motion.kind, motion.amount) for motion in leg))
+
+
+if __name__ == "__main__":
+    main()
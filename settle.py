@@ -0,0 +1,101 @@
+"""Waiting until the robot has stopped moving, instead of sleeping for a fixed time.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+"""
+
+
+from __future__ import division
+
+import time
+
+from metrics import Metrics
+from vision import as_frame, frames_agree
+
+
+class SettleDetector(object):
+    """
+    Works out when the robot has stopped moving after a motion.
+
+    The strategy used to sleep for a fixed time after moving, so that the
+    robot stopped rocking (and the camera focused) before it looked for
+    markers. Usually the robot settles much sooner than that, so `wait`
+    returns as soon as two pictures taken after the mbed finished the last
+    motion agree (see `vision.frames_agree`), or neither shows any markers.
+
+    If pictures aren't being taken in the background, there is nothing to
+    compare, so `wait` only counts time since the mbed finished the last
+    motion towards the wait.
+
+    How long each wait took, and how much of the fixed time it saved, are
+    recorded in `metrics` (see `report`).
+    """
+
+    def __init__(self, log, mbed, vision, dist_tolerance=0.01, angle_tolerance=0.5):
+        self.log = log
+        self.mbed = mbed
+        self.vision = vision
+        self.dist_tolerance = dist_tolerance
+        self.angle_tolerance = angle_tolerance
+        # Histograms of how long each wait took ("settle.waited") and how
+        # much shorter it was than `max_wait` ("settle.saved"), and a count of
+        # waits that ran out of time ("settle.timeouts").
+        self.metrics = Metrics()
+
+    def wait(self, max_wait):
+        # type: (float) -> bool
+        """
+        Wait until the robot has settled, for at most `max_wait` seconds, and return whether it did.
+
+        This replaces `time.sleep(max_wait)` after a motion.
+        """
+        start = time.time()
+        deadline = start + max_wait
+        while self.mbed.moving and time.time() < deadline:
+            # Someone else is waiting for the mbed to respond.
+            time.sleep(0.01)
+        if self.vision.running:
+            settled = self.wait_for_pictures(deadline)
+        else:
+            # Time since the motion finished counts as time spent settling.
+            remaining = min(deadline, self.mbed.last_motion_end + max_wait) - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+            settled = not self.mbed.moving
+        waited = time.time() - start
+        self.metrics.record("settle.waited", waited)
+        self.metrics.record("settle.saved", max(0, max_wait - waited))
+        if not settled:
+            self.metrics.increment("settle.timeouts")
+        self.log.debug("%s after %.3f seconds (instead of %s)", "Settled" if settled else "Gave up settling", waited, max_wait)
+        return settled
+
+    def wait_for_pictures(self, deadline):
+        # type: (float) -> bool
+        """Wait until two consecutive pictures taken since the last motion agree, or until `deadline`."""
+        previous = None
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            snapshot = self.vision.snapshot(since=self.mbed.last_motion_end, after=previous.number if previous else None,
+                                            timeout=remaining)
+            if snapshot is None:
+                return False
+            markers = as_frame(snapshot.markers)
+            if previous is not None:
+                if not markers and not previous.markers:
+                    return True
+                if frames_agree(previous.markers, markers, self.dist_tolerance, self.angle_tolerance):
+                    return True
+            previous = snapshot._replace(markers=markers)
+
+    def report(self):
+        # type: () -> str
+        """Return a summary of how much time settling saved, compared with sleeping."""
+        waited = self.metrics.histogram("settle.waited")
+        if waited is None:
+            return "no waits"
+        saved = self.metrics.histogram("settle.saved")
+        return "{} waits took {:.1f} seconds, saving {:.1f} seconds ({} ran out of time)".format(
+            waited.count, waited.total, saved.total, self.metrics.count("settle.timeouts"))
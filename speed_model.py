@@ -0,0 +1,91 @@
+"""A model of how fast the robot moves, used to decide when the mbed has stopped responding.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+"""
+
+
+from __future__ import division
+
+import json
+
+
+# Calibrated speeds of each motion command, in metres or degrees per second.
+# "F" (long moves in the original protocol) moves at the same speed as "f",
+# and the speed of "a" (arcs) is along the arc.
+DEFAULT_SPEEDS = {"f": 0.4, "b": 0.4, "A": 0.2, "l": 90, "r": 90, "a": 0.4}
+# The time taken by every command regardless of its size (accelerating,
+# decelerating and talking to the mbed), in seconds.
+DEFAULT_OVERHEAD = 0.5
+# How long commands that don't move the robot may take, in seconds.
+NON_MOTION_TIMEOUT = 1.0
+
+
+class SpeedModel(object):
+    """
+    Expected durations of mbed commands, refined from measured durations.
+
+    A command's deadline is `factor` times its expected duration plus
+    `margin` seconds. Each measured duration nudges the speed for that
+    command towards the measured speed, by a fraction `learning_rate`.
+    """
+
+    def __init__(self, speeds=None, overhead=DEFAULT_OVERHEAD, factor=2.0, margin=2.0, learning_rate=0.2):
+        self.speeds = dict(DEFAULT_SPEEDS)
+        if speeds is not None:
+            self.speeds.update(speeds)
+        self.overhead = overhead
+        self.factor = factor
+        self.margin = margin
+        self.learning_rate = learning_rate
+
+    @staticmethod
+    def key(command):
+        # type: (str) -> str
+        return "f" if command == "F" else command
+
+    def expected_duration(self, command, amount):
+        # type: (str, float) -> float
+        """
+        Return how long we expect the given command to take, in seconds.
+
+        `amount` is in metres or degrees. Returns None if the command
+        doesn't move the robot.
+        """
+        speed = self.speeds.get(self.key(command))
+        if speed is None or amount is None:
+            return None
+        return self.overhead + abs(amount) / speed
+
+    def allowed_duration(self, command, amount):
+        # type: (str, float) -> float
+        """Return how long the given command may take before we give up on it, in seconds."""
+        expected = self.expected_duration(command, amount)
+        if expected is None:
+            return NON_MOTION_TIMEOUT
+        return expected * self.factor + self.margin
+
+    def record(self, command, amount, duration):
+        # type: (str, float, float) -> None
+        """Refine the speed of a command given how long it actually took."""
+        key = self.key(command)
+        if key not in self.speeds or not amount:
+            return
+        moving_time = duration - self.overhead
+        if moving_time <= 0:
+            # Too short to tell us anything useful.
+            return
+        measured = abs(amount) / moving_time
+        self.speeds[key] += self.learning_rate * (measured - self.speeds[key])
+
+    def dump(self, path):
+        # type: (str) -> None
+        """Save the current speeds to `path`, as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.speeds, f, indent=2, sort_keys=True)
+
+    def load(self, path):
+        # type: (str) -> None
+        """Load speeds saved by `dump`."""
+        with open(path) as f:
+            self.speeds.update(json.load(f))
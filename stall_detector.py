@@ -0,0 +1,249 @@
+"""Noticing that the robot is stuck while it is still trying to move.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+
+Run this file directly to replay a synthetic run into a wall, and see how
+long the detector takes to notice.
+"""
+
+
+from __future__ import division
+
+import argparse
+import logging
+import random
+import threading
+import time
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import Callable, List
+except ImportError:
+    pass
+
+from metrics import Metrics
+from vision import MarkerFrame, Snapshot, as_frame, frames_agree
+
+
+class StallDetector(object):
+    """
+    Watches pictures (and the motor current) while the robot moves, and stops it if it's stuck.
+
+    Two pictures "agree" if they have markers in common, and all of them
+    have moved less than `dist_tolerance` metres and `angle_tolerance`
+    degrees between them (see `vision.frames_agree`). A robot that is moving changes what it
+    sees from one picture to the next, so if the pictures keep agreeing
+    while the mbed is running a motion, the robot is stuck.
+
+    The robot is stalled once pictures have agreed for long enough that,
+    counting the time to take the next picture, the stall was noticed within
+    `latency` seconds of it starting. If the current is at least
+    `stall_current` amps, two agreeing pictures are enough. With telemetry,
+    wheels that have stopped turning (see `Mbed.is_stalled`) count too.
+
+    Pictures started less than `grace` seconds after a motion starts are
+    ignored, since the robot is still speeding up. Once a stall has been
+    noticed, nothing more is noticed until that motion finishes (if the
+    mbed can't stop, or takes a while to).
+
+    `feed` does the detecting, so it can be given synthetic snapshots; the
+    background thread started by `start` feeds it pictures from the vision
+    worker and stops the robot through the mbed.
+    """
+
+    def __init__(self, log, mbed=None, vision=None, current=None, latency=0.5, grace=0.2,
+                 dist_tolerance=0.02, angle_tolerance=1.0, stall_current=4.0):
+        # type: (..., Mbed, VisionWorker, Callable[[], float], float, float, float, float, float) -> None
+        self.log = log
+        self.mbed = mbed
+        self.vision = vision
+        # Returns the current being drawn, in amps (e.g. from `Robot.power.battery`).
+        self.current = current
+        self.latency = latency
+        self.grace = grace
+        self.dist_tolerance = dist_tolerance
+        self.angle_tolerance = angle_tolerance
+        self.stall_current = stall_current
+        # Counters "stall.detections" and "stall.aborts", and a histogram of
+        # how long after the last picture that disagreed each stall was
+        # noticed ("stall.latency").
+        self.metrics = Metrics()
+        self.thread = None
+        self.running = False
+        self.reset()
+
+    def reset(self, motion_start=None):
+        # type: (float) -> None
+        """Forget the pictures seen so far, e.g. because a new motion started at `motion_start`."""
+        self.motion_start = motion_start
+        self.previous = None
+        # The first of the run of pictures that agree with each other.
+        self.still_since = None
+
+    def agree(self, before, after):
+        # type: (MarkerFrame, MarkerFrame) -> bool
+        """Return whether two pictures show the robot in the same place."""
+        return frames_agree(before, after, self.dist_tolerance, self.angle_tolerance)
+
+    def feed(self, snapshot, current=None, wheels_stalled=False):
+        # type: (Snapshot, float, bool) -> bool
+        """
+        Take a picture taken while the robot was meant to be moving, and return whether the robot is stalled.
+
+        `current` is the current being drawn when the picture was taken, in
+        amps, if known; `wheels_stalled` is whether the telemetry says the
+        wheels have stopped turning. Times are taken from the snapshot, not
+        the clock, so a recorded sequence of snapshots gives the same answer
+        whenever it's replayed.
+        """
+        if self.motion_start is not None and snapshot.start_time < self.motion_start + self.grace:
+            return False
+        markers = as_frame(snapshot.markers)
+        if self.previous is None or not self.agree(self.previous.markers, markers):
+            self.still_since = None
+        elif self.still_since is None:
+            self.still_since = self.previous
+        self.previous = snapshot._replace(markers=markers)
+        if wheels_stalled:
+            self.log.debug("Telemetry says the wheels have stopped")
+            return True
+        if self.still_since is None:
+            return False
+        if current is not None and current >= self.stall_current:
+            self.log.debug("Pictures %s to %s agree, drawing %.1f amps", self.still_since.number, snapshot.number, current)
+            return True
+        # The stall started somewhere between the last picture that disagreed
+        # and the first that agreed; by the time the next picture is ready,
+        # it may be `latency` seconds old.
+        frame_time = snapshot.end_time - snapshot.start_time
+        if snapshot.end_time + frame_time - self.still_since.start_time >= self.latency:
+            self.log.debug("Pictures %s to %s agree", self.still_since.number, snapshot.number)
+            return True
+        return False
+
+    def start(self):
+        # type: () -> None
+        """Start watching for stalls in the background."""
+        if self.running:
+            return
+        if not self.mbed.can_stop:
+            self.log.warn("The mbed can't stop part way through a motion; stalls will only be logged")
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="stall detector")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # type: () -> None
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        # type: () -> None
+        last = None
+        moving = False
+        # When the mbed last finished a motion, as of the last stall, so
+        # that the same stall isn't noticed again before the motion finishes.
+        stalled_after = None
+        while self.running:
+            if not self.vision.running:
+                # Without pictures there's nothing to go on (and `snapshot` wouldn't wait).
+                self.log.warn("The vision worker has stopped; no longer watching for stalls")
+                self.running = False
+                return
+            snapshot = self.vision.snapshot(after=last, timeout=0.1)
+            if snapshot is not None:
+                last = snapshot.number
+            if stalled_after is not None:
+                if self.mbed.moving and self.mbed.last_motion_end == stalled_after:
+                    continue
+                stalled_after = None
+                moving = False
+            if not self.mbed.moving:
+                moving = False
+                continue
+            if not moving:
+                moving = True
+                self.reset(time.time())
+            if snapshot is None:
+                continue
+            current = None
+            if self.current is not None:
+                try:
+                    current = self.current()
+                except Exception:
+                    self.log.exception("Couldn't read the current")
+                    self.current = None
+            wheels_stalled = self.mbed.telemetry_enabled and self.mbed.is_stalled(window=self.latency / 2)
+            if self.feed(snapshot, current, wheels_stalled):
+                self.stalled()
+                stalled_after = self.mbed.last_motion_end
+
+    def stalled(self):
+        # type: () -> None
+        """Record a stall, and stop the robot."""
+        since = self.still_since.start_time if self.still_since is not None else self.previous.start_time
+        self.log.warn("Robot seems to be stuck (for %.3f seconds)", time.time() - since)
+        self.metrics.increment("stall.detections")
+        self.metrics.record("stall.latency", time.time() - since)
+        if self.mbed.stop_motion():
+            self.metrics.increment("stall.aborts")
+        self.reset()
+
+
+def synthetic_snapshots(speed=0.5, frame_time=0.1, stall_at=1.0, count=30, noise=0.005):
+    # type: (float, float, float, int, float) -> List[Snapshot]
+    """
+    Make up the pictures taken while driving at `speed` metres per second towards a marker, until getting stuck at `stall_at` seconds.
+
+    Returns one Snapshot per picture, each taking `frame_time` seconds, with
+    a little noise on the marker's distance and angle.
+    """
+    from vision_sim import fake_marker
+    rng = random.Random(0)
+    snapshots = []
+    for number in xrange(count):
+        start = number * frame_time
+        dist = 4 - speed * min(start, stall_at)
+        marker = fake_marker({"code": 3, "dist": dist + rng.uniform(-noise, noise), "rot_y": rng.uniform(-noise, noise) * 10})
+        snapshots.append(Snapshot(number, start, start + frame_time, MarkerFrame([marker])))
+    return snapshots
+
+
+def replay(log, snapshots, stall_at, **kwargs):
+    # type: (..., List[Snapshot], float, ...) -> float
+    """Feed `snapshots` to a StallDetector, and return how long after `stall_at` the stall was noticed (None if it wasn't)."""
+    detector = StallDetector(log, **kwargs)
+    detector.reset(0)
+    for snapshot in snapshots:
+        if detector.feed(snapshot):
+            # The detector decides once a picture is ready.
+            noticed = snapshot.end_time - stall_at
+            if noticed < 0:
+                log.warn("False alarm at picture %s", snapshot.number)
+            return noticed
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.5, help="latency budget (seconds)")
+    parser.add_argument("--speed", type=float, default=0.5, help="speed before stalling (metres per second)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(module)s:%(lineno)d - %(levelname)s: %(message)s")
+    log = logging.getLogger(__name__)
+    for frame_time in (0.05, 0.1, 0.2):
+        snapshots = synthetic_snapshots(speed=args.speed, frame_time=frame_time, stall_at=1.0)
+        noticed = replay(log, snapshots, 1.0, latency=args.latency)
+        if noticed is None:
+            log.info("%.0f ms pictures: stall not noticed", frame_time * 1000)
+        else:
+            log.info("%.0f ms pictures: stall noticed after %.0f ms (budget %.0f ms)", frame_time * 1000, noticed * 1000, args.latency * 1000)
+
+
+if __name__ == "__main__":
+    main()
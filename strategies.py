@@ -10,14 +10,21 @@ from __future__ import division
 from sr.robot import *
 
 from collections import Callable, Hashable
-from math import sqrt
+from math import hypot, sqrt
 import time
 
+import arena
 import corrections
+from mbed_link import Motion
+from route_optimiser import DEFAULT_CAPTURE_TIME, DEFAULT_ORDER, MATCH_TIME, TimingModel, best_route
+from sweep import heading_prior, position_prior
 from vector import marker2vector
 
 strategies = {}
 
+# The marker type of each kind of cube (see `arena.ZONE_0_CUBES`).
+CUBE_MARKER_TYPES = {"A": MARKER_TOKEN_A, "B": MARKER_TOKEN_B, "C": MARKER_TOKEN_C}
+
 
 def strategy(name):
     # type: (Hashable) -> Callable
@@ -36,6 +43,25 @@ def strategy(name):
     return wrap
 
 
+def arena_prior(robot, points, spread=15):
+    # type: (..., list, float) -> Callable
+    """
+    Return a prior over which way to look for something at one of `points` in the arena.
+
+    Headings are relative to where the robot will be facing once any
+    pending turn is done, and worked out from where the tracker thinks we
+    are (see `sweep.position_prior`).
+    """
+    x, y, heading = robot.tracker.pose
+    return position_prior((x, y, heading + robot.wheels.pending_turn), points, spread, robot.tracker.covariance)
+
+
+def cube_prior(robot, kind, spread=15):
+    # type: (..., str, float) -> Callable
+    """Return a prior over which way to look for one of our zone's cubes of `kind` ("A", "B" or "C"), from where they start (see `arena.cubes`)."""
+    return arena_prior(robot, [(x, y) for _, cube_kind, x, y in arena.cubes(robot.zone) if cube_kind == kind], spread)
+
+
 @strategy("b c a")
 def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore_C=False):
     if opposite_direction:
@@ -47,7 +73,7 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
         robot.log.debug("Moving 3.25 metres to next to B")
         initial_walk_successful = robot.move_continue(3.25)
         robot.wheels.turn(-90 * turn_factor)
-        time.sleep(0.2)
+        robot.settle(0.2)
     else:
         robot.log.info("Skipping initial walk, presumably someone put the wrong USB stick in...")
         initial_walk_successful = True
@@ -55,11 +81,8 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
         markers = robot.find_markers_approx_position(MARKER_TOKEN_B, 1.5)
     else:
         robot.log.warn("Initial walk had a problem, doing a cone search since we don't know where we are.")
-        if opposite_direction:
-            angles = {"start_angle"}
-        else:
-            angles = {}
-        markers = robot.cone_search(marker_type=MARKER_TOKEN_B, dist=1.5, dist_tolerance=1, **angles)
+        # B should still be roughly in front of us, but we don't know how far we got.
+        markers = robot.cone_search(marker_type=MARKER_TOKEN_B, dist=1.5, dist_tolerance=1, prior=cube_prior(robot, "B", spread=30))
     if markers:
         robot.log.debug("Found %s B cubes, moving to the 0th one (code %s)", len(markers), markers[0].info.code)
         marker = markers[0]
@@ -67,7 +90,7 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
         validMovement = robot.move_to_cube(marker)
         if validMovement == 'Crash':
             robot.log.debug("Moving 1.0 metres backwards to get a better view of B because of a collision")
-            time.sleep(1)
+            robot.settle(1)
             robot.move_continue(-1)
             hasB = False
             robot.log.debug("Trying to find B again")
@@ -84,7 +107,7 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
                 validMovement = robot.move_to_cube(marker)
                 if validMovement == 'Crash':
                     robot.log.debug("Moving 0.2 metres backwards to unhook from a collision")
-                    time.sleep(1)
+                    robot.settle(1)
                     robot.wheels.move(-0.2, ignore_crash=True)
                     hasB = False
 
@@ -99,7 +122,8 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
             # Idiot check -- did we turn the wrong way?
             robot.log.debug("Checking to see if someone put the wrong USB stick in...")
             robot.wheels.turn(180)
-            markers = robot.cone_search(marker_type=MARKER_TOKEN_B, dist=1.5, start_angle=-30, stop_angle=30)
+            # If we went the wrong way, the cubes aren't where we think they are, so just look behind us.
+            markers = robot.cone_search(marker_type=MARKER_TOKEN_B, dist=1.5, start_angle=-30, stop_angle=30, prior=heading_prior(0, spread=20))
             if markers:
                 robot.log.warn("Someone put the wrong USB stick in the robot! Starting again in the other direction.")
                 route_b_c_a(robot, opposite_direction=not opposite_direction, skip_initial_walk=True)
@@ -110,7 +134,7 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
                 robot.wheels.turn(180)  # Turn back to face the original direction.
             robot.log.debug("Turning to roughly A cube")
             robot.wheels.turn(-45 * turn_factor)
-            Amarkers = robot.cone_search_approx_position(MARKER_TOKEN_A, dist=1.8, dist_tolerance = 0.7)
+            Amarkers = robot.cone_search_approx_position(MARKER_TOKEN_A, dist=1.8, dist_tolerance = 0.7, prior=cube_prior(robot, "A", spread=20))
             if Amarkers:
                 marker_id = Amarkers[0].info.code
                 robot.log.info("Having not found B nor C cube, and found an A cube, turning to face A cube (%s) exactly", marker_id)
@@ -122,7 +146,8 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
                 # sqrt(a^2 / 2) = b
                 robot.move_continue(sqrt(Amarkers[0].dist**2 / 2))
                 robot.wheels.turn(90 * turn_factor)
-                Amarkers = robot.cone_search_specific_marker(marker_id, max_left=30, max_right=30)
+                # We saw this cube before moving, so we know quite well where it is.
+                Amarkers = robot.cone_search_specific_marker(marker_id, max_left=30, max_right=30, prior=cube_prior(robot, "A", spread=10))
                 if Amarkers:
                     marker = Amarkers[0]
                     robot.move_to_cube(marker, crash_continue=True)
@@ -158,14 +183,15 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
             if Bmarkers == []:
                 robot.log.debug("Cannot see a B, turning to roughly A cube")
                 robot.wheels.turn(-45 * turn_factor)
-                markers = robot.cone_search_approx_position(MARKER_TOKEN_A, 2.12, max_left=30, max_right=30)
+                markers = robot.cone_search_approx_position(MARKER_TOKEN_A, 2.12, max_left=30, max_right=30, prior=cube_prior(robot, "A", spread=20))
             else:
                 robot.log.debug("Found %s B cubes, moving to the 0th one", len(Bmarkers))
                 marker = Bmarkers[0]
                 robot.move_to_cube(marker, crash_continue=True)
                 robot.log.debug("turning to roughly A cube")
                 robot.wheels.turn(-90 * turn_factor)
-                markers = robot.cone_search_approx_position(MARKER_TOKEN_A, 1.5, max_left=30, max_right=30)
+                # We've just reached B, so we know quite well where A is from here.
+                markers = robot.cone_search_approx_position(MARKER_TOKEN_A, 1.5, max_left=30, max_right=30, prior=cube_prior(robot, "A", spread=10))
             robot.log.info("Moving to A cube")
             if markers:
                 marker = markers[0]
@@ -223,7 +249,7 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
             validMovement = robot.move_to_cube(marker)
             if validMovement == 'Crash':
                 robot.log.debug("Moving 0.5 metres backwards to get a better view of C because of a collision")
-                time.sleep(1)
+                robot.settle(1)
                 robot.wheels.move(-0.5, ignore_crash=True)
                 robot.log.debug("Trying to find C again")
                 markers = robot.find_markers_approx_position(MARKER_TOKEN_C, 1.5, 2)
@@ -234,14 +260,14 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
                     validMovement = robot.move_to_cube(markers[0])
                     if validMovement == 'Crash':
                         robot.log.debug("Moving 0.2 metres backwards to unhook from a collision")
-                        time.sleep(1)
+                        robot.settle(1)
                         robot.wheels.move(-0.2, ignore_crash=True)
                         robot.log.warn("Cannot see C cube, attempting to get an A cube")
                         robot.wheels.turn(-117 * turn_factor)
                     else:
                         robot.log.info("Got B, got C and searching for A")
                         robot.wheels.turn(-135 * turn_factor)
-                markers = robot.cone_search_approx_position(MARKER_TOKEN_A, dist=1.3)
+                markers = robot.cone_search_approx_position(MARKER_TOKEN_A, dist=1.3, prior=cube_prior(robot, "A", spread=20))
                 if markers:
                     marker = markers[0]
                     robot.move_to_cube(marker, crash_continue=True)
@@ -254,7 +280,7 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
             else:
                 robot.log.debug("Has B and C so turning to roughly A cube")
                 robot.wheels.turn(-135 * turn_factor)
-                markers = robot.cone_search(marker_type=MARKER_TOKEN_A, dist=2.12, start_angle=-30, stop_angle=30)
+                markers = robot.cone_search(marker_type=MARKER_TOKEN_A, dist=2.12, start_angle=-30, stop_angle=30, prior=cube_prior(robot, "A", spread=10))
                 if markers:
                     marker = markers[0]
                     robot.log.info("Moving to A cube")
@@ -263,7 +289,7 @@ def route_b_c_a(robot, opposite_direction=False, skip_initial_walk=False, ignore
                 else:
                     robot.log.info("Can't see A cube, going to roughly where it should be.")
                     robot.move_continue(2.12)
-                time.sleep(1)
+                robot.settle(1)
                 robot.move_home_from_A()
                 robot.log.info("Home?")
 
@@ -344,6 +370,76 @@ def route_a_c_b(robot, initial_distance):
     robot.log.error("NOT IMPLEMENTED - GO HOME")
 
 
+def follow_route(robot, order, cubes, approach=1.0):
+    """
+    Collect the cubes named in `order` (see `route_optimiser.Route`), then go home.
+
+    `cubes` are where we expect each cube to be (see `arena.cubes`). We
+    drive to `approach` metres short of each cube by the planned path, look
+    for it, and drive into it; if we can't see it, we drive to where it
+    should be. Cubes we've collected come with us, so they aren't in the way.
+    """
+    places = {name: (kind, x, y) for name, kind, x, y in cubes}
+    # The codes of the markers on the cubes we've driven into.
+    collected = ()
+    for name in order:
+        kind, x, y = places[name]
+        robot.log.info("Going to get cube %s (%s) at (%.2f, %.2f)", name, kind, x, y)
+        pose = robot.tracker.pose
+        dist = hypot(x - pose.x, y - pose.y)
+        if dist > approach:
+            robot.drive_to_point(x - (x - pose.x) / dist * approach, y - (y - pose.y) / dist * approach, ignore=collected)
+        vec = robot.tracker.vector_to(x, y)
+        robot.wheels.turn(vec.angle)
+        markers = robot.cone_search(marker_type=CUBE_MARKER_TYPES[kind], dist=vec.distance, dist_tolerance=0.75,
+                                    start_angle=-30, stop_angle=30, prior=arena_prior(robot, [(x, y)]))
+        if markers:
+            marker = min(markers, key=lambda m: m.dist)
+            robot.move_to_cube(marker, crash_continue=True)
+            collected += (marker.info.code,)
+        else:
+            robot.log.warn("Can't see cube %s, going to where it should be", name)
+            robot.move_continue(vec.distance)
+        robot.localise()
+    home_x, home_y = arena.home(robot.zone)
+    if not robot.drive_to_point(home_x, home_y, ignore=collected):
+        robot.log.warn("Can't plan a way home, going straight there")
+        vec = robot.tracker.vector_to(home_x, home_y)
+        robot.wheels.turn(vec.angle)
+        robot.move_continue(vec.distance)
+
+
+def generated_strategy(order):
+    # type: (tuple) -> Callable
+    """Return a strategy that collects the cubes named in `order` from the robot's zone (see `follow_route`)."""
+    def follow(robot, *args, **kwargs):
+        follow_route(robot, order, arena.cubes(robot.zone))
+    return follow
+
+
+@strategy("optimised")
+def route_optimised(robot, time_limit=MATCH_TIME, *args, **kwargs):
+    """
+    Work out the quickest route through our zone's cubes and home, then follow it.
+
+    The route uses the robot's calibrated speeds and picture times (see
+    `route_optimiser`). If there isn't one, we fall back to "b c a".
+    """
+    capture = robot.vision.metrics.histogram("vision.capture")
+    timing = TimingModel.from_speed_model(robot.mbed.speed_model, capture.mean if capture is not None else DEFAULT_CAPTURE_TIME)
+    route = best_route(robot.log, robot.zone, timing, arena.cubes(robot.zone), time_limit)
+    if route is None:
+        robot.log.warn("Can't find a route through the cubes; falling back to \"b c a\"")
+        route_b_c_a(robot)
+        return
+    robot.log.info("Best route: %s, expected to take %.1f seconds", " then ".join(route.order), route.duration)
+    generated_strategy(route.order)(robot)
+
+
+# Registered as "optimised <order>", so that it can be chosen without working it out.
+strategies["optimised " + " ".join(DEFAULT_ORDER)] = generated_strategy(DEFAULT_ORDER)
+
+
 @strategy("align cubes")
 def test_align_markers(robot):
     robot.check_cube_alignment()
@@ -357,8 +453,7 @@ def test_marker_print(robot):
 
 @strategy("test move 4 metres")
 def move_4_metres(robot):
-    robot.wheels.move(2)
-    robot.wheels.move(2)
+    robot.wheels.run_plan([Motion("move", 2), Motion("move", 2)])
 
 
 @strategy("test 4 metre square")
@@ -382,14 +477,15 @@ def test_move(robot):
 
 @strategy("test turn 10 times")
 def turn_10_times(robot):
+    # Bypass the motion optimiser, which would (rightly) do nothing.
     for i in xrange(20):
-        robot.wheels.turn(180)
+        robot.mbed.turn(180)
 
 
 @strategy("test turn once")
 def turn_once(robot):
-    robot.wheels.turn(180)
-    robot.wheels.turn(180)
+    robot.mbed.turn(180)
+    robot.mbed.turn(180)
 
 
 @strategy("test webcam rotational placement correction calibration")
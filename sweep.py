@@ -0,0 +1,464 @@
+"""Looking for markers in several directions, turning while the last picture is processed.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+
+Run this file directly to time a pipelined sweep against a turn, sleep,
+look sweep, on the simulated mbed with a fake camera, or with --check to
+check that priors worked out from the arena depend on the zone.
+"""
+
+
+from __future__ import division
+
+import argparse
+import collections
+import logging
+from math import ceil, degrees, exp, floor, hypot, sqrt
+import time
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import Callable, List, Set, Tuple
+except ImportError:
+    pass
+
+import arena
+from metrics import Metrics
+from motion_optimiser import normalise_angle
+from vision import MarkerFrame, as_frame
+
+
+# The webcam's horizontal field of view, in degrees.
+CAMERA_FOV = 60
+# How much neighbouring pictures in a planned sweep overlap, in degrees,
+# since markers right at the edge of a picture often aren't recognised.
+SWEEP_OVERLAP = 10
+# How long finding markers in a picture is assumed to take, in seconds,
+# until the vision worker has measured it.
+DEFAULT_LOOK_TIME = 0.3
+
+# The result of a sweep: the matching markers (a MarkerFrame, empty if there
+# weren't any), and the heading they were seen at, in degrees clockwise from
+# where the robot was facing when the sweep started (None if there weren't any).
+SweepResult = collections.namedtuple("SweepResult", ["markers", "heading"])
+
+
+class Sweeper(object):
+    """
+    Turns to each of a list of headings in turn, looking for matching markers.
+
+    A picture only needs the robot to keep still while the camera takes it;
+    finding the markers in it takes much longer. So, once a picture has
+    started (and `exposure_time` seconds have passed), the robot starts
+    turning to the next heading while the vision worker finds the markers.
+    If the picture had matching markers, the robot turns back to where it
+    took it.
+
+    Pictures are only used if they started at least `settle_time` seconds
+    after the robot stopped turning.
+
+    If the vision worker isn't running, the sweep turns, calls `settle`,
+    then calls `see` at each heading instead.
+    """
+
+    def __init__(self, log, wheels, vision, marker_filter=None, settle=None, see=None, settle_time=0.05, exposure_time=0.1):
+        # type: (..., MotionOptimiser, VisionWorker, MarkerFilter, Callable[[float], ...], Callable[..., List], float, float) -> None
+        self.log = log
+        self.wheels = wheels
+        self.vision = vision
+        self.marker_filter = marker_filter
+        self.settle = settle if settle is not None else time.sleep
+        self.see = see if see is not None else vision.capture
+        self.settle_time = settle_time
+        self.exposure_time = exposure_time
+        # Histograms of how long sweeps take ("sweep.duration") and, for
+        # sweeps with a prior, how long they were expected to take to find
+        # something ("sweep.expected"), and counts of sweeps ("sweeps"),
+        # headings looked at ("sweep.headings") and sweeps that found
+        # something ("sweep.found").
+        self.metrics = Metrics()
+
+    def sweep(self, headings, predicate=None, options=None, wait=0.5, minimum=1, prior=None):
+        # type: (List[float], Callable[[Marker], bool], dict, float, int, Callable[[float], float]) -> SweepResult
+        """
+        Look for markers that satisfy `predicate` at each heading in turn, stopping at the first that has at least `minimum`.
+
+        `headings` are in degrees clockwise from where the robot is facing.
+        `options` are keyword arguments to `see` (e.g. `res`). `wait` is the
+        longest to wait for the robot to settle, if the vision worker isn't
+        running.
+
+        If matching markers are found, the robot is left facing the heading
+        they were seen at (once pending turns are flushed), so their angles
+        are still right. Otherwise, it is left at the last heading.
+
+        If `prior` is given (see `expected_search_time`), how long the sweep
+        was expected to take to find something is logged alongside how long
+        it actually took. The headings are still visited in the order given;
+        use `order` to sort them by the prior first.
+        """
+        start = time.time()
+        self.metrics.increment("sweeps")
+        expected = self.expected_time(headings, prior) if prior is not None else None
+        if expected is not None:
+            self.metrics.record("sweep.expected", expected)
+        if self.vision.running:
+            result = self.pipelined_sweep(headings, predicate, options or {}, minimum)
+        else:
+            result = self.sequential_sweep(headings, predicate, options or {}, wait, minimum)
+        self.metrics.record("sweep.duration", time.time() - start)
+        if result.heading is not None:
+            self.metrics.increment("sweep.found")
+            self.log.info("Found %s matching markers at %s degrees, after %.3f seconds", len(result.markers), result.heading, time.time() - start)
+            if expected is not None:
+                self.log.info("Expected to find them after %.3f seconds", expected)
+        else:
+            self.log.info("Found no matching markers at %s headings, after %.3f seconds", len(headings), time.time() - start)
+        return result
+
+    def pipelined_sweep(self, headings, predicate, options, minimum=1):
+        # type: (List[float], Callable[[Marker], bool], dict, int) -> SweepResult
+        since = self.vision.set_options(**options) if options else 0
+        try:
+            self.wheels.flush()
+            current = 0
+            pending = self.wheels.start_turn(headings[0]) if headings else None
+            for i, heading in enumerate(headings):
+                if pending is not None:
+                    pending.wait()
+                current = heading
+                self.metrics.increment("sweep.headings")
+                started = self.vision.picture_started(max(since, self.wheels.mbed.last_motion_end + self.settle_time))
+                if started is None:
+                    self.log.warn("Vision worker stopped in the middle of a sweep")
+                    break
+                number, picture_start = started
+                # Keep still until the camera has the frame.
+                delay = picture_start + self.exposure_time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                pending = self.wheels.start_turn(headings[i + 1] - heading) if i + 1 < len(headings) else None
+                snapshot = self.vision.picture(number)
+                if snapshot is None:
+                    self.log.warn("Lost picture %s taken at %s degrees", number, heading)
+                    continue
+                # Add the sightings before the next turn is finished, so they are moved with the robot.
+                if self.marker_filter is not None:
+                    self.marker_filter.add(snapshot.markers, snapshot.start_time)
+                markers = as_frame(snapshot.markers).filter(predicate)
+                self.log.debug("Picture %s at %s degrees has %s matching markers", number, heading, len(markers))
+                if markers and len(markers) >= minimum:
+                    if pending is not None:
+                        pending.wait()
+                        current = headings[i + 1]
+                    self.wheels.turn(heading - current)
+                    return SweepResult(markers, heading)
+        finally:
+            if options:
+                self.vision.set_options()
+        return SweepResult(MarkerFrame(), None)
+
+    def sequential_sweep(self, headings, predicate, options, wait, minimum=1):
+        # type: (List[float], Callable[[Marker], bool], dict, float, int) -> SweepResult
+        current = 0
+        for heading in headings:
+            self.wheels.turn(heading - current)
+            current = heading
+            self.wheels.flush()
+            self.metrics.increment("sweep.headings")
+            self.settle(wait)
+            markers = as_frame(self.see(**options)).filter(predicate)
+            if markers and len(markers) >= minimum:
+                return SweepResult(markers, heading)
+        return SweepResult(MarkerFrame(), None)
+
+    def step_time(self, amount):
+        # type: (float) -> float
+        """Return how long we expect to take from one picture to the next, turning `amount` degrees in between."""
+        histogram = self.vision.metrics.histogram("vision.capture")
+        look = histogram.mean if histogram is not None else DEFAULT_LOOK_TIME
+        turn = self.wheels.mbed.speed_model.expected_duration("r", amount) if amount else 0
+        if self.vision.running:
+            # The turn overlaps with finding the markers in the last picture.
+            return max(turn + self.settle_time + self.exposure_time, look)
+        return turn + look
+
+    def expected_time(self, headings, prior=None, fov=CAMERA_FOV):
+        # type: (List[float], Callable[[float], float], float) -> float
+        """Return how long a sweep through `headings` is expected to take to find something, if it's there (see `expected_search_time`)."""
+        return expected_search_time(headings, self.step_time, prior, fov)
+
+    def order(self, headings, prior, fov=CAMERA_FOV):
+        # type: (List[float], Callable[[float], float], float) -> List[float]
+        """Return `headings` in the order that finds something soonest, given `prior` (see `order_headings`)."""
+        return order_headings(headings, self.step_time, prior, fov)
+
+
+def plan_sweep(left, right, fov=CAMERA_FOV, overlap=SWEEP_OVERLAP):
+    # type: (float, float, float, float) -> List[float]
+    """
+    Plan the headings to look at to see everything from `left` degrees anticlockwise to `right` degrees clockwise of here.
+
+    The plan looks straight ahead first (heading 0). The other headings are
+    spread evenly, at most `fov - overlap` degrees apart, and no heading is
+    looked at twice. To turn as little as possible, the plan covers the
+    nearer side first, then turns across to the other; if the two sides
+    cover the whole circle, it just turns clockwise all the way round.
+
+    Returns headings in degrees clockwise from here, in the order to visit them.
+    """
+    step = fov - overlap
+    if left + right >= 360 - overlap:
+        count = int(ceil(360 / step))
+        return [i * 360 / count for i in xrange(count)]
+
+    def side(extent):
+        # The headings needed beyond the straight-ahead picture, out to `extent` degrees.
+        beyond = extent - fov / 2
+        if beyond <= 0:
+            return []
+        count = int(ceil(beyond / step))
+        return [i * beyond / count for i in xrange(1, count + 1)]
+
+    lefts = [-heading for heading in side(left)]
+    rights = side(right)
+    if lefts and (not rights or -lefts[-1] <= rights[-1]):
+        return [0] + lefts + rights
+    return [0] + rights + lefts
+
+
+def heading_prior(expected, spread=15, floor=0.05):
+    # type: (float, float, float) -> Callable[[float], float]
+    """
+    Return a prior for something expected at `expected` degrees clockwise, give or take `spread` degrees.
+
+    The prior is a normal distribution over heading (wrapped round the
+    circle), plus `floor` times its peak everywhere, so that no heading is
+    ruled out entirely (the robot may not be quite where we think it is).
+    Priors can be combined by adding them (see `combine_priors`).
+    """
+    def prior(heading):
+        # type: (float) -> float
+        offset = normalise_angle(heading - expected)
+        return exp(-(offset / spread) ** 2 / 2) + floor
+    return prior
+
+
+def combine_priors(*weighted_priors):
+    # type: (*Tuple[float, Callable[[float], float]]) -> Callable[[float], float]
+    """Return a prior that is the weighted sum of some (weight, prior) pairs, e.g. for several cubes that might be seen."""
+    def prior(heading):
+        # type: (float) -> float
+        return sum(weight * component(heading) for weight, component in weighted_priors)
+    return prior
+
+
+def position_prior(pose, points, spread=15, covariance=None, floor=0.05):
+    # type: (Tuple[float, float, float], List[Tuple[float, float]], float, List[List[float]], float) -> Callable[[float], float]
+    """
+    Return a prior for something at one of `points` in the arena, seen from `pose` (x, y, heading; see `arena`).
+
+    Headings are relative to `pose`'s heading, as for `heading_prior`.
+    Nearer points are more likely (each is weighted by one over its
+    distance). If `covariance` (of the pose, as for `PoseTracker`) is given,
+    the less sure we are of the pose, the wider the prior.
+    """
+    x, y, heading = pose
+    weighted = []
+    for point_x, point_y in points:
+        dist = max(hypot(point_x - x, point_y - y), 0.1)
+        width = spread
+        if covariance is not None:
+            # How far off the heading to the point could be, from how far off the position could be.
+            position_spread = degrees(sqrt(max(covariance[0][0], covariance[1][1])) / dist)
+            width = sqrt(spread ** 2 + covariance[2][2] + position_spread ** 2)
+        expected = normalise_angle(arena.heading_to(x, y, point_x, point_y) - heading)
+        weighted.append((1 / dist, heading_prior(expected, width, floor)))
+    return combine_priors(*weighted)
+
+
+def order_headings(headings, step_time, prior, fov=CAMERA_FOV):
+    # type: (List[float], Callable[[float], float], Callable[[float], float], float) -> List[float]
+    """
+    Return `headings` in the order that finds something soonest, given a prior over where it is.
+
+    Visiting each heading adds the chance that the target is in the part of
+    the picture that hasn't been seen yet, and costs the time to turn there
+    and take the picture (`step_time`, as for `expected_search_time`).
+    Starting from heading 0, the next heading is always the one with the
+    most chance per second. This is the best order when every picture takes
+    as long whatever the turn before it, and close to it otherwise. A heading
+    given twice is only visited once. Headings that add nothing new
+    come last, nearest first.
+    """
+    half = fov / 2
+    remaining = []
+    for heading in headings:
+        if heading not in remaining:
+            remaining.append(heading)
+    ordered = []
+    seen = set()
+    current = 0
+
+    def new_degrees(heading):
+        # type: (float) -> Set[int]
+        return set(int(normalise_angle(degree)) for degree in xrange(int(floor(heading - half)), int(ceil(heading + half)))) - seen
+
+    while remaining:
+        def rate(heading):
+            # type: (float) -> Tuple[float, float]
+            chance = sum(prior(degree) for degree in new_degrees(heading))
+            turn = normalise_angle(heading - current)
+            return chance / max(step_time(turn), 1e-6), -abs(turn)
+        heading = max(remaining, key=rate)
+        remaining.remove(heading)
+        ordered.append(heading)
+        seen.update(new_degrees(heading))
+        current = heading
+    return ordered
+
+
+def sweep_rotation(headings):
+    # type: (List[float]) -> float
+    """Return how far the robot turns, in total, to visit `headings` in order (from heading 0)."""
+    total = 0
+    current = 0
+    for heading in headings:
+        total += abs(heading - current)
+        current = heading
+    return total
+
+
+def expected_search_time(headings, step_time, prior=None, fov=CAMERA_FOV):
+    # type: (List[float], Callable[[float], float], Callable[[float], float], float) -> float
+    """
+    Return how long a sweep through `headings` is expected to take to find something, if it's there.
+
+    `step_time(amount)` is how long it takes from one picture to the next,
+    turning `amount` degrees in between. `prior(heading)` is how likely the
+    target is to be at each heading (degrees clockwise, from -180 to 180);
+    by default, it's equally likely to be anywhere the sweep looks. Each
+    degree counts as found by the first picture that sees it. Returns None
+    if the target can't be anywhere the sweep looks.
+    """
+    elapsed = 0
+    current = 0
+    seen = set()
+    found = 0
+    expected = 0
+    for heading in headings:
+        elapsed += step_time(normalise_angle(heading - current))
+        current = heading
+        new = set(int(normalise_angle(degree)) for degree in xrange(int(floor(heading - fov / 2)), int(ceil(heading + fov / 2)))) - seen
+        seen.update(new)
+        probability = sum(prior(degree) for degree in new) if prior is not None else len(new)
+        found += probability
+        expected += probability * elapsed
+    return expected / found if found else None
+
+
+def cone_headings(start_angle, stop_angle, delta_angle, first=0):
+    # type: (float, float, float, float) -> List[float]
+    """
+    Return the headings a cone search from `start_angle` to `stop_angle` looks at, every `delta_angle` degrees.
+
+    The search looks straight ahead (`first`) before starting.
+    """
+    headings = [first]
+    heading = start_angle
+    while heading <= stop_angle:
+        headings.append(heading)
+        heading += delta_angle
+    return headings
+
+
+def benchmark(log, frame_time=0.15, match_at=None):
+    """Time a cone search from -45 to 45 degrees (finding a marker at `match_at` degrees, if given), both ways."""
+    from mbed_link import Mbed
+    from mbed_sim import MbedSimulator
+    from motion_optimiser import MotionOptimiser
+    from vision import VisionWorker
+    from vision_sim import fake_marker
+
+    sim = MbedSimulator(log)
+    sim.start()
+    link_log = logging.getLogger("mbed_link")
+    link_log.setLevel(logging.WARNING)
+    mbed = Mbed(link_log, port=sim.port)
+    wheels = MotionOptimiser(link_log, mbed)
+    heading = [0]
+    mbed.motion_listeners.append(lambda motion: heading.__setitem__(0, heading[0] + (motion.amount if motion and motion.kind == "turn" else 0)))
+
+    def camera(**options):
+        seen_at = heading[0]
+        time.sleep(frame_time)
+        if match_at is not None and abs(seen_at - match_at) < 1:
+            return [fake_marker({"code": 3, "dist": 1.5, "rot_y": 0})]
+        return []
+
+    worker = VisionWorker(log, camera)
+    worker.start()
+    headings = cone_headings(-45, 45, 15)
+    results = {}
+    sweeper = Sweeper(log, wheels, worker)
+    # The old way: turn, sleep, then use the first picture taken after stopping.
+    sequential = Sweeper(log, wheels, worker, settle=time.sleep,
+                         see=lambda **options: worker.snapshot(since=mbed.last_motion_end).markers)
+    for name, run in [("turn, sleep, look", lambda: sequential.sequential_sweep(headings, None, {}, 0.5)),
+                      ("pipelined", lambda: sweeper.sweep(headings))]:
+        start = time.time()
+        result = run()
+        results[name] = time.time() - start
+        log.info("%s: %.2f seconds, found markers at %s", name, results[name], result.heading)
+        wheels.turn(-heading[0])
+        wheels.flush()
+    worker.stop()
+    sim.stop()
+    return results
+
+
+def check_zone_priors(log):
+    """Check that the order a full sweep looks in for each zone's A cube comes from where the arena says it is."""
+    headings = plan_sweep(180, 180)
+
+    def step_time(turn):
+        return DEFAULT_LOOK_TIME + abs(turn) / 90
+
+    def a_cube(zone):
+        return [(x, y) for _, kind, x, y in arena.cubes(zone) if kind == "A"]
+
+    # From the middle of the arena, each zone's A cube is in a different direction...
+    middle = (arena.ARENA_SIZE / 2, arena.ARENA_SIZE / 2, 0)
+    orders = [tuple(order_headings(headings, step_time, position_prior(middle, a_cube(zone)))) for zone in xrange(4)]
+    for zone, order in enumerate(orders):
+        log.info("From the middle, zone %s's A cube: %s", zone, order)
+    assert len(set(orders)) == 4, "expected a different order for each zone"
+    # ...but from each zone's start, it's in the same direction.
+    orders = [tuple(order_headings(headings, step_time, position_prior(arena.start_pose(zone), a_cube(zone)))) for zone in xrange(4)]
+    log.info("From each zone's start: %s", orders[0])
+    assert len(set(orders)) == 1, "expected the same order from each zone's start, got {}".format(orders)
+    # Turning to 350 degrees is a short turn anticlockwise, not most of the way round.
+    order = order_headings([90, 350], step_time, lambda heading: 1)
+    assert order == [350, 90], "expected to look just left of ahead first, got {}".format(order)
+    wrapped, unwrapped = expected_search_time([350, 5], step_time), expected_search_time([-10, 5], step_time)
+    assert abs(wrapped - unwrapped) < 1e-9, "expected 350 and -10 degrees to take as long, got {} and {}".format(wrapped, unwrapped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frame-time", type=float, default=0.15, help="time to find markers in a picture (seconds)")
+    parser.add_argument("--match-at", type=float, help="heading to put a marker at (degrees)")
+    parser.add_argument("--check", action="store_true", help="instead, check the priors worked out from the arena")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(module)s:%(lineno)d - %(levelname)s: %(message)s")
+    log = logging.getLogger(__name__)
+    if args.check:
+        check_zone_priors(log)
+        return
+    benchmark(log, args.frame_time, args.match_at)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ from __future__ import division
 
 from math import sin, asin, cos, degrees, radians
 
+
 def sind(x):
     # type: (float) -> float
     """Return the sine of x degrees."""
@@ -25,3 +26,29 @@ def asind(x):
     # type: (float) -> float
     """Return the arc sine of x, in degrees."""
     return degrees(asin(x))
+
+
+def arc_length(chord, angle):
+    # type: (float, float) -> float
+    """
+    Return the length of the circular arc from the origin to a point.
+
+    The point is `chord` away, `angle` degrees from the direction the arc
+    starts in, so the arc turns through `2 * angle` degrees in total.
+    """
+    if angle == 0:
+        return abs(chord)
+    theta = radians(abs(angle))
+    return abs(chord) * theta / sin(theta)
+
+
+def arc_radius(chord, angle):
+    # type: (float, float) -> float
+    """
+    Return the radius of the arc described in `arc_length`.
+
+    Returns infinity for a straight line.
+    """
+    if angle == 0:
+        return float("inf")
+    return abs(chord) / (2 * sind(abs(angle)))
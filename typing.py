@@ -6,3 +6,4 @@ from __future__ import division
 
 Callable = None
 List = None
+Tuple = None
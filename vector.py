@@ -11,6 +11,18 @@ from sr.robot import *
 
 import collections
 
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List
+except ImportError:
+    pass
+
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for VectorArray.
+    np = None
+
 
 class Vector(collections.namedtuple("Vector", ["distance", "angle"])):
     __slots__ = ()
@@ -25,3 +37,43 @@ def marker2vector(marker):
     Given a Marker, return a Vector from the camera to the marker.
     """
     return Vector(distance=marker.centre.polar.length, angle=marker.centre.polar.rot_y)
+
+
+class VectorArray(object):
+    """
+    Many Vectors at once, stored as NumPy arrays of distances and angles.
+
+    Indexing or iterating gives Vectors. Requires NumPy.
+    """
+
+    def __init__(self, distance, angle):
+        if np is None:
+            raise ImportError("VectorArray requires NumPy")
+        self.distance = np.asarray(distance, dtype=float)
+        self.angle = np.asarray(angle, dtype=float)
+        assert self.distance.shape == self.angle.shape
+
+    @classmethod
+    def from_vectors(cls, vectors):
+        # type: (List[Vector]) -> VectorArray
+        vectors = list(vectors)
+        return cls([vec.distance for vec in vectors], [vec.angle for vec in vectors])
+
+    def to_vectors(self):
+        # type: () -> List[Vector]
+        return list(self)
+
+    def __len__(self):
+        return len(self.distance)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return VectorArray(self.distance[index], self.angle[index])
+        return Vector(distance=float(self.distance[index]), angle=float(self.angle[index]))
+
+    def __iter__(self):
+        for distance, angle in zip(self.distance, self.angle):
+            yield Vector(distance=float(distance), angle=float(angle))
+
+    def __repr__(self):
+        return "VectorArray(distance={!r}, angle={!r})".format(self.distance, self.angle)
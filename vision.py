@@ -0,0 +1,446 @@
+"""Taking pictures in the background, so that markers are ready when we need them.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+"""
+
+
+from __future__ import division
+
+from bisect import bisect_left, bisect_right
+import collections
+import multiprocessing
+from operator import attrgetter
+import Queue
+import threading
+import time
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import Callable, List, Tuple
+except ImportError:
+    pass
+
+from metrics import Metrics
+
+
+# How many recent snapshots the vision worker keeps (see `VisionWorker.picture`).
+HISTORY_SIZE = 16
+# How long the vision process may take to take a picture for `capture`, in
+# seconds, and how often to check that it's still alive while waiting.
+CAPTURE_TIMEOUT = 10
+CAPTURE_POLL_INTERVAL = 0.5
+
+# The markers seen in one picture (a MarkerFrame). `number` counts up from
+# 0 with each picture; `start_time` and `end_time` are when the picture
+# started and finished being taken and processed.
+Snapshot = collections.namedtuple("Snapshot", ["number", "start_time", "end_time", "markers"])
+
+
+class MarkerFrame(list):
+    """
+    The markers seen in one picture, indexed by code, type and distance.
+
+    This is a list of markers, in the order `see` returned them, so it can
+    be used anywhere a list of markers can. It shouldn't be modified, since
+    the indexes aren't updated.
+    """
+
+    def __init__(self, markers=()):
+        # type: (List[Marker]) -> None
+        super(MarkerFrame, self).__init__(markers)
+        self.by_code = {marker.info.code: marker for marker in self}
+        self.by_distance = sorted(self, key=attrgetter("dist"))
+        self.distances = [marker.dist for marker in self.by_distance]
+        self.by_type = collections.defaultdict(list)
+        for marker in self.by_distance:
+            self.by_type[marker.info.marker_type].append(marker)
+
+    def code(self, code):
+        # type: (int) -> Marker
+        """Return the marker with the given code, or None if it wasn't seen."""
+        return self.by_code.get(code)
+
+    def codes(self):
+        # type: () -> set
+        return set(self.by_code)
+
+    def of_type(self, marker_type):
+        # type: (str) -> List[Marker]
+        """Return the markers of the given type, closest first."""
+        return list(self.by_type.get(marker_type, []))
+
+    def closest(self, marker_type=None):
+        # type: (str) -> Marker
+        """Return the closest marker (of the given type, if any), or None if there aren't any."""
+        markers = self.by_distance if marker_type is None else self.by_type.get(marker_type)
+        return markers[0] if markers else None
+
+    def within(self, min_dist=0, max_dist=float("inf"), min_angle=-180, max_angle=180, marker_type=None):
+        # type: (float, float, float, float, str) -> List[Marker]
+        """Return the markers between the given distances and angles (rot_y) (of the given type, if any), closest first."""
+        start = bisect_left(self.distances, min_dist)
+        end = bisect_right(self.distances, max_dist)
+        return [marker for marker in self.by_distance[start:end]
+                if min_angle <= marker.rot_y <= max_angle and (marker_type is None or marker.info.marker_type == marker_type)]
+
+    def filter(self, predicate=None):
+        # type: (Callable[[Marker], bool]) -> MarkerFrame
+        """Return a MarkerFrame of the markers that satisfy `predicate` (all of them if it's None)."""
+        if predicate is None:
+            return MarkerFrame(self)
+        return MarkerFrame(marker for marker in self if predicate(marker))
+
+
+def as_frame(markers):
+    # type: (List[Marker]) -> MarkerFrame
+    """Return `markers` as a MarkerFrame, without copying it if it already is one."""
+    return markers if isinstance(markers, MarkerFrame) else MarkerFrame(markers)
+
+
+def frames_agree(before, after, dist_tolerance, angle_tolerance):
+    # type: (MarkerFrame, MarkerFrame, float, float) -> bool
+    """
+    Return whether two pictures show the robot in the same place.
+
+    They do if they have markers in common, and every marker they have in
+    common has moved less than `dist_tolerance` metres and `angle_tolerance`
+    degrees between them.
+    """
+    common = before.codes().intersection(after.codes())
+    if not common:
+        return False
+    for code in common:
+        old, new = before.code(code), after.code(code)
+        if abs(old.dist - new.dist) >= dist_tolerance or abs(old.rot_y - new.rot_y) >= angle_tolerance:
+            return False
+    return True
+
+
+class VisionWorker(object):
+    """
+    Calls `see` over and over in a background thread, keeping the latest result.
+
+    Instead of taking a picture and waiting for it to be processed, callers
+    ask for the latest snapshot taken after some time (usually, after the
+    robot stopped moving). Often, one has already been taken by the time
+    they ask.
+
+    Only one picture is taken at a time: `capture` takes one straight away
+    (e.g. at a different resolution) in between the worker's pictures.
+
+    To overlap finding markers with moving, callers can wait for a picture
+    to start (`picture_started`), move once the camera has the frame, and
+    then get that picture's snapshot (`picture`).
+    """
+
+    def __init__(self, log, see):
+        # type: (..., Callable[..., List]) -> None
+        self.log = log
+        self.see = see
+        # Histograms of how long pictures take ("vision.capture") and how
+        # long callers wait for one ("vision.wait").
+        self.metrics = Metrics()
+        self.latest = None
+        # The most recent snapshots, oldest first.
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        # The (number, start_time) of the last picture started.
+        self.started = None
+        # Keyword arguments to `see` for the worker's pictures (see `set_options`).
+        self.options = {}
+        self.capture_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        # type: () -> None
+        """Start taking pictures in the background."""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="vision worker")
+        self.thread.daemon = True
+        self.thread.start()
+        self.log.info("Started taking pictures in the background")
+
+    def stop(self):
+        # type: () -> None
+        """Stop taking pictures, once the current one is done."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.condition:
+            self.condition.notify_all()
+
+    def run(self):
+        # type: () -> None
+        number = 0
+        while self.running:
+            with self.capture_lock:
+                options = self.options
+                start = time.time()
+                self.picture_starting(number, start)
+                try:
+                    markers = MarkerFrame(self.see(**options))
+                except Exception:
+                    self.log.exception("Failed to take a picture")
+                    markers = None
+                end = time.time()
+            if markers is None:
+                # Wait before trying again without holding the camera.
+                time.sleep(0.1)
+                continue
+            self.metrics.record("vision.capture", end - start)
+            self.add_snapshot(Snapshot(number, start, end, markers))
+            number += 1
+
+    def picture_starting(self, number, start):
+        # type: (int, float) -> None
+        with self.condition:
+            self.started = (number, start)
+            self.condition.notify_all()
+
+    def add_snapshot(self, snapshot):
+        # type: (Snapshot) -> None
+        with self.condition:
+            self.latest = snapshot
+            self.history.append(snapshot)
+            self.condition.notify_all()
+
+    def set_options(self, **options):
+        # type: (...) -> float
+        """
+        Take the worker's pictures with the given keyword arguments to `see` (e.g. `res`) from now on.
+
+        Returns the time from which pictures are started with the new options.
+        """
+        self.options = options
+        return time.time()
+
+    def picture_started(self, since, timeout=None):
+        # type: (float, float) -> Tuple[int, float]
+        """
+        Wait until a picture has started at or after `since`, and return its (number, start_time).
+
+        Returns None if none starts within `timeout` seconds, or the worker stops.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.started is None or self.started[1] < since:
+                remaining = None if deadline is None else deadline - time.time()
+                if not self.running or (remaining is not None and remaining <= 0):
+                    return None
+                self.condition.wait(remaining)
+            return self.started
+
+    def picture(self, number, timeout=None):
+        # type: (int, float) -> Snapshot
+        """
+        Wait for the snapshot of picture `number`, and return it.
+
+        Returns None if it doesn't arrive within `timeout` seconds, the worker
+        stops, or it is too old to be remembered.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.latest is None or self.latest.number < number:
+                remaining = None if deadline is None else deadline - time.time()
+                if not self.running or (remaining is not None and remaining <= 0):
+                    return None
+                self.condition.wait(remaining)
+            for snapshot in self.history:
+                if snapshot.number == number:
+                    return snapshot
+        return None
+
+    def snapshot(self, since=0, after=None, timeout=None):
+        # type: (float, int, float) -> Snapshot
+        """
+        Return the latest snapshot whose picture was started at or after `since`.
+
+        If `after` is given, the snapshot must also be newer than snapshot
+        number `after`. Waits for a suitable snapshot if there isn't one
+        yet, for at most `timeout` seconds; returns None if none arrives.
+        """
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+        with self.condition:
+            while not self.suitable(self.latest, since, after):
+                if not self.running:
+                    return None
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            snapshot = self.latest
+        self.metrics.record("vision.wait", time.time() - start)
+        return snapshot
+
+    @staticmethod
+    def suitable(snapshot, since, after):
+        # type: (Snapshot, float, int) -> bool
+        return snapshot is not None and snapshot.start_time >= since and (after is None or snapshot.number > after)
+
+    def capture(self, *args, **kwargs):
+        # type: (...) -> List
+        """Take a picture now (passing any arguments to `see`), in between the worker's pictures."""
+        with self.capture_lock:
+            return MarkerFrame(self.see(*args, **kwargs))
+
+
+class VisionProcess(VisionWorker):
+    """
+    Like VisionWorker, but takes pictures (and finds markers in them) in a separate process.
+
+    Finding markers is CPU-bound, so in a thread it competes with the
+    strategy for the interpreter lock; in another process, it gets a core
+    of its own. The process is forked from this one, so `see` needn't be
+    picklable, but the markers it returns must be. Only markers are sent
+    back, so frames never leave the child process. Since only the forking
+    thread survives a fork, start it before starting any other threads.
+    """
+
+    def __init__(self, log, see):
+        # type: (..., Callable[..., List]) -> None
+        super(VisionProcess, self).__init__(log, see)
+        self.process = None
+        self.conn = None
+        # Markers from `capture`, passed from the receiving thread.
+        self.captured = Queue.Queue()
+
+    def start(self):
+        # type: () -> None
+        """Start taking pictures in another process."""
+        if self.running:
+            return
+        self.running = True
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=capture_loop, args=(self.log, self.see, child_conn), name="vision process")
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        if self.options:
+            self.conn.send(("options", self.options))
+        self.thread = threading.Thread(target=self.run, name="vision receiver")
+        self.thread.daemon = True
+        self.thread.start()
+        self.log.info("Started taking pictures in process %s", self.process.pid)
+
+    def stop(self):
+        # type: () -> None
+        """Stop the vision process, once the current picture is done."""
+        if not self.running:
+            return
+        self.running = False
+        try:
+            self.conn.send(("stop",))
+        except (IOError, EOFError):
+            pass
+        self.process.join()
+        self.thread.join()
+        self.conn.close()
+        with self.condition:
+            self.condition.notify_all()
+
+    def run(self):
+        # type: () -> None
+        """Receive snapshots from the vision process (in a thread)."""
+        while True:
+            try:
+                message = self.conn.recv()
+            except (IOError, EOFError):
+                break
+            if message[0] == "snapshot":
+                # Index the markers here, rather than sending the indexes through the pipe.
+                snapshot = message[1]._replace(markers=MarkerFrame(message[1].markers))
+                received = time.time()
+                self.metrics.record("vision.capture", snapshot.end_time - snapshot.start_time)
+                self.metrics.record("vision.transfer", received - snapshot.end_time)
+                self.add_snapshot(snapshot)
+            elif message[0] == "started":
+                self.picture_starting(*message[1:])
+            elif message[0] == "captured":
+                self.captured.put(message[1])
+        if self.running:
+            self.log.error("Vision process died")
+            self.running = False
+            with self.condition:
+                self.condition.notify_all()
+
+    def set_options(self, **options):
+        # type: (...) -> float
+        """Have the vision process take pictures with the given keyword arguments to `see` from now on."""
+        self.options = options
+        if self.running:
+            self.conn.send(("options", options))
+        return time.time()
+
+    def capture(self, *args, **kwargs):
+        # type: (...) -> List
+        """
+        Have the vision process take a picture now (passing any arguments to `see`).
+
+        If the vision process isn't running, or dies before sending the
+        markers back, the picture is taken in this process instead. If it
+        takes more than `CAPTURE_TIMEOUT` seconds, no markers are returned.
+        """
+        with self.capture_lock:
+            if self.running:
+                # Anything left over is from a picture we gave up waiting for.
+                while not self.captured.empty():
+                    self.captured.get_nowait()
+                try:
+                    self.conn.send(("capture", args, kwargs))
+                except (IOError, EOFError):
+                    self.log.exception("Couldn't ask the vision process to take a picture")
+                else:
+                    deadline = time.time() + CAPTURE_TIMEOUT
+                    while self.running and self.process.is_alive():
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.log.error("Vision process didn't take a picture within %s seconds", CAPTURE_TIMEOUT)
+                            return MarkerFrame()
+                        try:
+                            return MarkerFrame(self.captured.get(timeout=min(remaining, CAPTURE_POLL_INTERVAL)))
+                        except Queue.Empty:
+                            pass
+                    self.log.error("Vision process died; taking the picture here instead")
+            return MarkerFrame(self.see(*args, **kwargs))
+
+
+def capture_loop(log, see, conn):
+    """
+    Take pictures until told to stop, sending the snapshots down `conn` (in the vision process).
+
+    Requests to take a picture with particular arguments, and to change the
+    arguments for the rest of the pictures, are handled in between pictures.
+    """
+    number = 0
+    options = {}
+    while True:
+        while conn.poll():
+            message = conn.recv()
+            if message[0] == "stop":
+                return
+            if message[0] == "options":
+                options = message[1]
+                continue
+            _, args, kwargs = message
+            try:
+                markers = see(*args, **kwargs)
+            except Exception:
+                log.exception("Failed to take a picture")
+                markers = []
+            conn.send(("captured", markers))
+        start = time.time()
+        conn.send(("started", number, start))
+        try:
+            markers = see(**options)
+        except Exception:
+            log.exception("Failed to take a picture")
+            time.sleep(0.1)
+            continue
+        conn.send(("snapshot", Snapshot(number, start, time.time(), markers)))
+        number += 1
@@ -0,0 +1,162 @@
+"""A fake camera that replays recorded markers, for exercising vision.py without a robot.
+
+This file is part of the code for the Hills Road/Systemetric entry to
+the 2017 Student Robotics competition "Easy as ABC".
+
+A recording is a JSON list of frames, each of which is an object with the
+time taken to find the markers ("duration", in seconds) and the markers
+found ("markers", a list of objects with "code", "marker_type", "dist" and
+"rot_y"). Replaying a frame burns CPU for its duration, like real marker
+detection.
+
+Run this file directly to compare the frame rate and latency of the
+in-process and multi-process vision workers, and how much work the
+strategy gets done in the meantime.
+"""
+
+
+from __future__ import division
+
+import argparse
+import collections
+import json
+import logging
+import random
+import time
+
+try:
+    # noinspection PyUnresolvedReferences
+    from typing import List
+except ImportError:
+    pass
+
+from vision import VisionProcess, VisionWorker
+
+
+# Just enough of sr.robot's Marker for vision.py (and picklable, for VisionProcess).
+FakeMarkerInfo = collections.namedtuple("FakeMarkerInfo", ["code", "marker_type"])
+FakeMarker = collections.namedtuple("FakeMarker", ["info", "dist", "rot_y"])
+
+
+def fake_marker(recorded):
+    # type: (dict) -> FakeMarker
+    return FakeMarker(FakeMarkerInfo(recorded["code"], recorded.get("marker_type", "arena")), recorded["dist"], recorded["rot_y"])
+
+
+class FakeCamera(object):
+    """
+    Replays a recording of frames, in a loop.
+
+    Call the camera (like `Robot.see`) to get the markers from the next frame.
+    """
+
+    def __init__(self, frames):
+        # type: (List[dict]) -> None
+        self.frames = frames
+        self.index = 0
+
+    @classmethod
+    def load(cls, path):
+        # type: (str) -> FakeCamera
+        """Load a recording saved by `dump`."""
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @classmethod
+    def synthetic(cls, count=50, duration=0.1, seed=None):
+        # type: (int, float, int) -> FakeCamera
+        """Make up a recording of `count` frames, each taking about `duration` seconds to process."""
+        rng = random.Random(seed)
+        frames = []
+        for _ in xrange(count):
+            markers = [{"code": rng.randrange(28), "dist": rng.uniform(0.5, 5), "rot_y": rng.uniform(-30, 30)}
+                       for _ in xrange(rng.randrange(4))]
+            frames.append({"duration": duration * rng.uniform(0.8, 1.2), "markers": markers})
+        return cls(frames)
+
+    def dump(self, path):
+        # type: (str) -> None
+        with open(path, "w") as f:
+            json.dump(self.frames, f, indent=2)
+
+    def __call__(self, *args, **kwargs):
+        # type: (...) -> List
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        end = time.time() + frame["duration"]
+        # Spin rather than sleep: real marker detection needs the CPU.
+        while time.time() < end:
+            pass
+        return [fake_marker(marker) for marker in frame["markers"]]
+
+
+def strategy_work(duration):
+    # type: (float) -> int
+    """Do pretend strategy work for `duration` seconds, returning how much got done."""
+    end = time.time() + duration
+    iterations = 0
+    while time.time() < end:
+        iterations += 1
+    return iterations
+
+
+def benchmark(log, worker, duration):
+    # type: (..., VisionWorker, float) -> dict
+    """
+    Run `worker` for `duration` seconds while doing strategy work, and return statistics.
+
+    The strategy asks for a new snapshot after every 50 ms of work, like a
+    strategy that plans between looking.
+    """
+    worker.start()
+    # Wait for the first picture, so that start-up time isn't counted.
+    worker.snapshot()
+    start = time.time()
+    work = 0
+    latencies = []
+    snapshots = 0
+    last = None
+    while time.time() - start < duration:
+        work += strategy_work(0.05)
+        snapshot = worker.snapshot(after=last)
+        if snapshot is None:
+            break
+        latencies.append(time.time() - snapshot.start_time)
+        if last is not None:
+            snapshots += snapshot.number - last
+        last = snapshot.number
+    elapsed = time.time() - start
+    worker.stop()
+    latencies.sort()
+    return {
+        "fps": snapshots / elapsed,
+        "latency_mean": sum(latencies) / len(latencies),
+        "latency_p90": latencies[int(len(latencies) * 0.9)],
+        "work_per_second": work / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--recording", help="JSON recording to replay (default: a synthetic one)")
+    parser.add_argument("--frame-time", type=float, default=0.1, help="processing time of synthetic frames (seconds)")
+    parser.add_argument("--duration", type=float, default=5, help="how long to run each mode for (seconds)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(module)s:%(lineno)d - %(levelname)s: %(message)s")
+    log = logging.getLogger(__name__)
+    if args.recording:
+        camera = FakeCamera.load(args.recording)
+    else:
+        camera = FakeCamera.synthetic(duration=args.frame_time, seed=0)
+    baseline = strategy_work(args.duration) / args.duration
+    log.info("Strategy work with no vision: %.0f iterations per second", baseline)
+    for name, cls in [("in-process", VisionWorker), ("multi-process", VisionProcess)]:
+        stats = benchmark(log, cls(log, camera), args.duration)
+        log.info("%s: %.1f frames per second, latency mean %.1f ms, p90 %.1f ms, strategy work %.0f%% of baseline",
+                 name, stats["fps"], stats["latency_mean"] * 1000, stats["latency_p90"] * 1000,
+                 stats["work_per_second"] / baseline * 100)
+
+
+if __name__ == "__main__":
+    main()